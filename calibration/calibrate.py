@@ -1,18 +1,16 @@
 import sys
 import time
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit, leastsq
 from socketIO_client import SocketIO, BaseNamespace
-from scipy.linalg import lstsq
-import scipy, scipy.optimize
 import asyncio
 from threading import Thread
 import json
 import optparse
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
-from matplotlib.ticker import LinearLocator, FormatStrFormatter
+
+# scipy and matplotlib take seconds to import on a Raspberry Pi, they are
+# only imported by the fits and graphs that use them so listing names or
+# fitting without graphs start quickly; check with
+# python experiment/importtime.py --entry-points calibrate
 
 VALID_FIT_TYPES = ['sigmoid', 'linear', 'constant', '3d']
 
@@ -61,6 +59,7 @@ def three_dim(data, c0, c1, c2, c3, c4, c5):
     return c0 + c1*x + c2*y + c3*x**2 + c4*x*y + c5*y**2
 
 def sigmoid_fit(calibration, fit_name, params, graph = True):
+    from scipy.optimize import curve_fit
     coefficients = []
 
     # For single param calibrations, just take the first value from the returned dictionary
@@ -79,6 +78,7 @@ def sigmoid_fit(calibration, fit_name, params, graph = True):
     return create_fit(coefficients, fit_name, "sigmoid", time.time(), params)
 
 def linear_fit(calibration, fit_name, params, graph = True):
+    from scipy.optimize import curve_fit
     coefficients = []
 
     # For single param calibrations, just take the first value from the returned dictionary
@@ -107,6 +107,7 @@ def constant_fit(calibration, fit_name, params):
     return create_fit(coefficients, fit_name, "constant", time.time(), params)
 
 def three_dimension_fit(calibration, fit_name, params, graph = True):
+    from scipy.optimize import curve_fit
     initial_parameters = [1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
     coefficients = []
     datas = []
@@ -126,7 +127,7 @@ def three_dimension_fit(calibration, fit_name, params, graph = True):
 
         data = [x_data, y_data, z_data]
 
-        fitted_parameters, pcov = scipy.optimize.curve_fit(three_dim, [x_data, y_data], z_data, p0 = initial_parameters)
+        fitted_parameters, pcov = curve_fit(three_dim, [x_data, y_data], z_data, p0 = initial_parameters)
 
         modelPredictions = three_dim(data, *fitted_parameters)
         absError = modelPredictions - z_data
@@ -148,6 +149,7 @@ def three_dimension_fit(calibration, fit_name, params, graph = True):
     return create_fit(coefficients, fit_name, '3d', time.time(), params)
 
 def graph_2d_data(func, measured_data, medians, standard_deviations, coefficients, fit_name, fit_type, space_min, space_max, space_step):
+    import matplotlib.pyplot as plt
     linear_space = np.linspace(space_min, space_max, space_step)
     fig, ax = plt.subplots(4, 4)
     fig.suptitle("Fit Name: " + fit_name)
@@ -161,6 +163,9 @@ def graph_2d_data(func, measured_data, medians, standard_deviations, coefficient
     plt.show()
 
 def graph_3d_data(func, datas, coefficients, fit_name):
+    import matplotlib.pyplot as plt
+    # registers the 3d projection with older matplotlib versions
+    from mpl_toolkits.mplot3d import Axes3D
     fig = plt.figure()
     fig.suptitle("Fit Name: " + fit_name)
     for i, data in enumerate(datas):
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the broadcast processing of the DPU against synthetic
+experiments of different ages, to see how each step scales with the size
+of the data files.
+
+For each experiment size (1 hour, 1 week and 1 month of broadcasts every
+20 s by default) a turbidostat experiment directory is generated, resumed
+like eVOLVER.py does, and transform_data, save_data, turbidostat,
+chemostat, calc_growth_rate, tail_to_np and the whole on_broadcast are
+timed separately. Results are written as json; pass a previous result
+file with --compare to see regressions between versions.
+
+    python experiment/benchmark.py -o results.json
+    python experiment/benchmark.py --sizes hour week --compare results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+import numpy as np
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'template')
+sys.path.insert(0, TEMPLATE_DIR)
+
+import eVOLVER
+import custom_script
+
+BROADCAST_INTERVAL = 20
+SIZES = {'hour': 3600, 'week': 7 * 24 * 3600, 'month': 30 * 24 * 3600}
+STAGES = ['transform_data', 'save_data', 'turbidostat', 'chemostat',
+          'calc_growth_rate', 'calc_growth_rate_from_file', 'tail_to_np',
+          'on_broadcast']
+RESULTS_VERSION = 1
+
+OD_COEFFICIENTS = [62721, 1000, 0.5, -2]
+TEMP_COEFFICIENTS = [-0.02, 62.0]
+CALIBRATIONS = [
+    {'calibrationType': 'od',
+     'fits': [{'name': 'od_cal', 'type': 'sigmoid', 'params': ['od_135'],
+               'coefficients': [OD_COEFFICIENTS] * 16, 'active': True}]},
+    {'calibrationType': 'temperature',
+     'fits': [{'name': 'temp_cal', 'type': 'linear', 'params': ['temp'],
+               'coefficients': [TEMP_COEFFICIENTS] * 16, 'active': True}]},
+    {'calibrationType': 'pump',
+     'fits': [{'name': 'pump_cal', 'type': 'constant', 'params': ['pump'],
+               'coefficients': [1.0] * 48, 'active': True}]},
+]
+
+# turbidostat cycles between these ODs in the synthetic experiments
+LOWER_OD = 0.2
+UPPER_OD = 0.4
+GROWTH_RATE = 0.6
+
+
+class FakeIO:
+    _url = 'benchmark'
+
+
+def raw_od(od):
+    a, b, c, d = OD_COEFFICIENTS
+    return a + (b - a) / (1 + 10 ** ((c - od) * d))
+
+
+def raw_temp(temp):
+    return (temp - TEMP_COEFFICIENTS[1]) / TEMP_COEFFICIENTS[0]
+
+
+def write_series(path, header, times, values, fmt='{0},{1}'):
+    with open(path, 'w') as f:
+        for line in header:
+            f.write(line + '\n')
+        f.write(''.join(fmt.format(t, v) + '\n'
+                        for t, v in zip(times.tolist(), values.tolist())))
+
+
+def make_experiment(save_path, duration, rng):
+    """
+    Writes a turbidostat experiment that has been running for duration
+    seconds into save_path, in the layout eVOLVER.py leaves behind.
+    """
+    name = custom_script.EXP_NAME
+    data_dir = os.path.join(save_path, name)
+    for directory in ['OD', 'temp', 'temp_config', 'pump_log', 'ODset',
+                      'growthrate', 'chemo_config', 'od_135_raw',
+                      'temp_raw']:
+        os.makedirs(os.path.join(data_dir, directory))
+    shutil.copy(os.path.join(TEMPLATE_DIR, 'custom_script.py'), save_path)
+
+    rows = duration // BROADCAST_INTERVAL
+    times = np.round(np.arange(1, rows + 1) * BROADCAST_INTERVAL / 3600, 4)
+    cycle = np.log(UPPER_OD / LOWER_OD) / GROWTH_RATE
+    for x in eVOLVER.VIALS:
+        header = ['Experiment: {0} vial {1}, {2}'.format(name, x,
+                                                         time.strftime('%c'))]
+        # phase shifted sawtooth between the turbidostat thresholds
+        phase = (times + x * cycle / 16) % cycle
+        od = LOWER_OD * np.exp(GROWTH_RATE * phase)
+        od = od + rng.normal(0, 0.005, rows)
+        temp = 30 + rng.normal(0, 0.05, rows)
+        dilutions = times[1:][np.diff(phase) < 0]
+
+        def path(param, directory=None):
+            return eVOLVER.vial_file_path(data_dir, x, param, directory)
+
+        write_series(path('OD'), header, times, od)
+        write_series(path('temp'), [], times, temp)
+        write_series(path('od_135_raw'), header, times,
+                     raw_od(od).astype(int))
+        write_series(path('temp_raw'), header, times,
+                     raw_temp(temp).astype(int))
+        write_series(path('temp_config'), header, np.zeros(1),
+                     np.array([custom_script.TEMP_INITIAL[x]]))
+        write_series(path('pump_log'), header, np.append(0, dilutions),
+                     np.append(0, np.full(len(dilutions), 3.47)))
+        odsets = np.repeat(dilutions, 2)
+        values = np.tile([LOWER_OD, UPPER_OD], len(dilutions))
+        write_series(path('ODset'), header, np.append(0, odsets),
+                     np.append(0, values))
+        write_series(path('gr', 'growthrate'), header,
+                     np.append(0, dilutions),
+                     np.append(0, np.full(len(dilutions), GROWTH_RATE)))
+        with open(path('chemo_config'), 'w') as f:
+            f.write('0,0,0\n0,0,0\n')
+
+    with open(os.path.join(data_dir, name + '.pickle'), 'wb') as f:
+        pickle.dump([time.time() - duration, np.zeros(len(eVOLVER.VIALS))],
+                    f)
+    return rows
+
+
+def make_broadcast(rng, od=0.3, temp=30.0):
+    vials = len(eVOLVER.VIALS)
+    od = od + rng.normal(0, 0.005, vials)
+    temp = temp + rng.normal(0, 0.05, vials)
+    set_temp = raw_temp(np.array(custom_script.TEMP_INITIAL, dtype=float))
+    return {'data': {'od_135': [str(int(v)) for v in raw_od(od)],
+                     'temp': [str(int(v)) for v in raw_temp(temp)]},
+            'config': {'temp': {'value': [str(int(v)) for v in set_temp]},
+                       'stir': {'value': ['8'] * vials},
+                       'pump': {'value': ['--'] * 48}}}
+
+
+def open_experiment(save_path, log_name):
+    """
+    Resumes the experiment in save_path the way eVOLVER.py does, with the
+    socket replaced by a sink for the commands.
+    """
+    eVOLVER.SAVE_PATH = save_path
+    namespace = eVOLVER.EvolverNamespace(FakeIO(), '/dpu-evolver')
+    namespace.emit = lambda *args, **kw: None
+    namespace.start_time = namespace.initialize_exp(
+        eVOLVER.VIALS, None, log_name, False, 0, 'localhost', True)
+    namespace.on_activecalibrations(CALIBRATIONS)
+    return namespace
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {'repeat': repeat, 'min': float(times.min()),
+            'median': float(np.median(times)), 'mean': float(times.mean()),
+            'max': float(times.max())}
+
+
+def run_stages(namespace, rng, repeat):
+    vials = eVOLVER.VIALS
+    clock = [namespace.last_elapsed_time or
+             (time.time() - namespace.start_time) / 3600]
+
+    def elapsed():
+        clock[0] = round(clock[0] + BROADCAST_INTERVAL / 3600, 4)
+        return clock[0]
+
+    broadcast = make_broadcast(rng)
+    data = namespace.transform_data(make_broadcast(rng), vials)
+    state = namespace.controller_state
+    od_paths = [eVOLVER.vial_file_path(namespace.data_dir, x, 'OD')
+                for x in vials]
+
+    def save_data():
+        now = elapsed()
+        namespace.save_data(data['transformed']['od'], now, vials, 'OD')
+        namespace.save_data(data['transformed']['temp'], now, vials, 'temp')
+        namespace.save_data(data['data']['od_135'], now, vials, 'od_135_raw')
+        namespace.save_data(data['data']['temp'], now, vials, 'temp_raw')
+        namespace.writer.commit()
+
+    def controller(function):
+        def run():
+            namespace.commands.begin(broadcast['config'])
+            function(namespace, data, vials, elapsed())
+            namespace.writer.commit()
+            namespace.commands.flush()
+        return run
+
+    def calc_growth_rate():
+        now = elapsed()
+        for x in vials:
+            start = state.odset_time[x]
+            if not namespace.growth_rate.tracking(x, start):
+                namespace.growth_rate.reset(x, start)
+            namespace.calc_growth_rate(x, start, now)
+        namespace.writer.commit()
+
+    def calc_growth_rate_from_file():
+        # the fallback of a curve started before the experiment was resumed
+        namespace._growth_rate_from_file(0, state.odset_time[0])
+
+    def tail_to_np():
+        for path in od_paths:
+            namespace.tail_to_np(path, 10)
+
+    def on_broadcast():
+        namespace.on_broadcast(make_broadcast(rng))
+
+    stages = {
+        'transform_data':
+            lambda: namespace.transform_data(make_broadcast(rng), vials),
+        'save_data': save_data,
+        'turbidostat': controller(custom_script.turbidostat),
+        'chemostat': controller(custom_script.chemostat),
+        'calc_growth_rate': calc_growth_rate,
+        'calc_growth_rate_from_file': calc_growth_rate_from_file,
+        'tail_to_np': tail_to_np,
+        'on_broadcast': on_broadcast,
+    }
+    return dict((stage, measure(stages[stage], repeat)) for stage in STAGES)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+def scaling(sizes):
+    """
+    Log-log slope of the median time against the number of rows per data
+    file for each stage: ~0 means the stage does not depend on the age of
+    the experiment, ~1 that it reads whole files.
+    """
+    names = sorted(sizes, key=lambda name: sizes[name]['rows'])
+    if len(names) < 2:
+        return {}
+    rows = np.log([sizes[name]['rows'] for name in names])
+    result = {}
+    for stage in STAGES:
+        medians = [sizes[name]['stages'][stage]['median'] for name in names]
+        slope = np.polyfit(rows, np.log(medians), 1)[0]
+        result[stage] = {'exponent': float(slope),
+                         'ratio': medians[-1] / medians[0]}
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=TEMPLATE_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size_names, repeat, workdir, seed):
+    rng = np.random.default_rng(seed)
+    log_name = os.path.join(workdir, 'benchmark.log')
+    sizes = {}
+    for name in size_names:
+        save_path = os.path.join(workdir, name)
+        print('generating {0} of data...'.format(name), flush=True)
+        rows = make_experiment(save_path, SIZES[name], rng)
+        print('timing...', flush=True)
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            namespace = open_experiment(save_path, log_name)
+            stages = run_stages(namespace, rng, repeat)
+            namespace.writer.close()
+        sizes[name] = {
+            'duration': SIZES[name], 'rows': int(rows),
+            'od_file_bytes': os.path.getsize(eVOLVER.vial_file_path(
+                namespace.data_dir, 0, 'OD')),
+            'data_bytes': directory_size(namespace.data_dir),
+            'stages': stages}
+        shutil.rmtree(save_path)
+    eVOLVER.flush_logging()
+    return {'version': RESULTS_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'broadcast_interval': BROADCAST_INTERVAL,
+            'sizes': sizes,
+            'scaling': scaling(sizes)}
+
+
+def report(results, previous=None):
+    names = list(results['sizes'])
+    print('\nmedian time per call (ms)')
+    print('{0:28}'.format('') +
+          ''.join('{0:>12}'.format(name) for name in names) +
+          '{0:>10}'.format('scaling'))
+    for stage in STAGES:
+        line = '{0:28}'.format(stage)
+        for name in names:
+            line += '{0:12.3f}'.format(
+                results['sizes'][name]['stages'][stage]['median'] * 1000)
+        if stage in results['scaling']:
+            line += '{0:10.2f}'.format(results['scaling'][stage]['exponent'])
+        print(line)
+    print('{0:28}'.format('rows per file') +
+          ''.join('{0:12d}'.format(results['sizes'][name]['rows'])
+                  for name in names))
+    if previous is None:
+        return
+    print('\nchange against {0} (new/old median)'.format(
+        previous.get('revision') or 'previous results'))
+    for stage in STAGES:
+        line = '{0:28}'.format(stage)
+        for name in names:
+            try:
+                old = previous['sizes'][name]['stages'][stage]['median']
+            except KeyError:
+                line += '{0:>12}'.format('n/a')
+                continue
+            new = results['sizes'][name]['stages'][stage]['median']
+            line += '{0:12.2f}'.format(new / old)
+        print(line)
+
+
+def get_options():
+    description = 'Time the broadcast processing steps of the DPU'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES),
+                        default=list(SIZES),
+                        help='Experiment ages to benchmark (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='Calls timed per step and size (default: '
+                             '%(default)s)')
+    parser.add_argument('-o', '--output',
+                        help='Write the results to this json file')
+    parser.add_argument('--compare',
+                        help='Json results of an earlier run to compare '
+                             'against')
+    parser.add_argument('--workdir',
+                        help='Directory for the generated experiments '
+                             '(default: a temporary directory)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the synthetic data (default: '
+                             '%(default)s)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = get_options()
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+    if options.workdir:
+        os.makedirs(options.workdir, exist_ok=True)
+        results = run(options.sizes, options.repeat, options.workdir,
+                      options.seed)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(options.sizes, options.repeat, workdir,
+                          options.seed)
+    report(results, previous)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for an eVOLVER, to run and load test the DPU without
+hardware. Serves the /dpu-evolver socket.io namespace like the eVOLVER
+server does and broadcasts synthetic od_135, od_90 and temp readings
+produced by a simple growth model that responds to the pump and
+temperature commands it receives. Every command is recorded.
+
+Broadcasts can be sent far faster than the eVOLVER's 20 s to load test the
+DPU; each one advances the model by --step simulated seconds. The DPU
+still measures elapsed time by the wall clock, so time based settings of
+the custom script (e.g. the turbidostat pump_wait) are not sped up.
+
+The server needs python-socketio and aiohttp, which the DPU itself does
+not; install them with pip install -r requirements-dev.txt.
+
+    python experiment/evolver_server.py --interval 0.1 --record commands.jsonl
+    python experiment/template/eVOLVER.py -i 127.0.0.1 -y
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+import numpy as np
+import socketio
+from aiohttp import web
+
+NAMESPACE = '/dpu-evolver'
+VIALS = 16
+
+# synthetic calibrations, the raw readings are generated from their inverse
+OD_135_COEFFICIENTS = [62721, 1000, 0.5, -2]
+OD_90_COEFFICIENTS = [2000, 30000]
+TEMP_COEFFICIENTS = [-0.02, 62.0]
+PUMP_FLOW_RATE = 1.0
+# OD values of the standards in the synthetic OD calibration
+CALIBRATION_ODS = [0.0, 0.05, 0.1, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.5]
+
+
+class BroadcastManager(socketio.AsyncManager):
+    """
+    python-socketio 4 (the last version speaking the protocol of the
+    socketIO_client used by the DPU) passes bare coroutines to
+    asyncio.wait(), which Python 3.11 no longer accepts.
+    """
+
+    async def emit(self, event, data, namespace, room=None, skip_sid=None,
+                   callback=None, **kwargs):
+        if namespace not in self.rooms or room not in self.rooms[namespace]:
+            return
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        emits = []
+        for sid in self.get_participants(namespace, room):
+            if sid not in skip_sid:
+                ack_id = None
+                if callback is not None:
+                    ack_id = self._generate_ack_id(sid, namespace, callback)
+                emits.append(self.server._emit_internal(sid, event, data,
+                                                        namespace, ack_id))
+        await asyncio.gather(*emits)
+
+
+class GrowthModel:
+    """
+    Logistic growth in every vial, diluted by one-shot pump commands and by
+    the recurring chemostat pump program, with vial temperatures relaxing
+    towards their setpoints. Time only advances with step().
+    """
+
+    def __init__(self, vials=VIALS, doubling_time=1.5, max_od=1.8,
+                 initial_od=0.05, volume=25.0, noise=0.002, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.vials = vials
+        # per vial spread so that the vials are not all identical
+        self.rate = (np.log(2) / doubling_time *
+                     self.rng.uniform(0.8, 1.2, vials))
+        self.max_od = max_od
+        self.volume = volume
+        self.noise = noise
+        self.od = np.full(vials, initial_od)
+        self.temp = np.full(vials, 25.0)
+        self.set_temp = np.full(vials, 30.0)
+        self.chemo_bolus = np.zeros(vials)
+        self.chemo_period = np.zeros(vials)
+
+    def step(self, seconds):
+        hours = seconds / 3600
+        growth = np.exp(self.rate * hours)
+        self.od = (self.max_od * self.od * growth /
+                   (self.max_od + self.od * (growth - 1)))
+        running = self.chemo_period > 0
+        dilution = np.zeros(self.vials)
+        dilution[running] = (self.chemo_bolus[running] * PUMP_FLOW_RATE /
+                             self.volume * seconds /
+                             self.chemo_period[running])
+        self.od *= np.exp(-dilution)
+        self.temp += (self.set_temp - self.temp) * (1 - np.exp(-seconds / 300))
+
+    def bolus(self, vial, seconds):
+        added = seconds * PUMP_FLOW_RATE
+        self.od[vial] *= self.volume / (self.volume + added)
+
+    def readings(self):
+        od = np.maximum(self.od + self.rng.normal(0, self.noise, self.vials),
+                        0)
+        a, b, c, d = OD_135_COEFFICIENTS
+        od_135 = a + (b - a) / (1 + 10 ** ((c - od) * d))
+        od_90 = OD_90_COEFFICIENTS[0] + OD_90_COEFFICIENTS[1] * od
+        temp = ((self.temp + self.rng.normal(0, 0.05, self.vials) -
+                 TEMP_COEFFICIENTS[1]) / TEMP_COEFFICIENTS[0])
+        return {'od_135': [str(int(x)) for x in od_135],
+                'od_90': [str(int(x)) for x in od_90],
+                'temp': [str(int(x)) for x in temp]}
+
+
+def make_calibrations(rng):
+    """
+    Calibration records in the format of the eVOLVER server: raw replicate
+    readings of a set of standards plus the active fits.
+    """
+    def replicates(values):
+        return [[[int(v + noise) for noise in rng.normal(0, 50, 3)]
+                 for v in vial] for vial in values]
+
+    ods = np.array(CALIBRATION_ODS)
+    a, b, c, d = OD_135_COEFFICIENTS
+    od_135 = a + (b - a) / (1 + 10 ** ((c - ods) * d))
+    od_90 = OD_90_COEFFICIENTS[0] + OD_90_COEFFICIENTS[1] * ods
+    temps = np.array([20.0, 30.0, 40.0])
+    temp_raw = (temps - TEMP_COEFFICIENTS[1]) / TEMP_COEFFICIENTS[0]
+    def fit(name, fit_type, coefficients, params):
+        return {'name': name, 'coefficients': coefficients, 'type': fit_type,
+                'timeFit': time.time(), 'active': True, 'params': params}
+    return {
+        'od_cal': {
+            'name': 'od_cal', 'calibrationType': 'od',
+            'measuredData': [ods.tolist()] * VIALS,
+            'raw': [{'param': 'od_135',
+                     'vialData': replicates([od_135] * VIALS)},
+                    {'param': 'od_90',
+                     'vialData': replicates([od_90] * VIALS)}],
+            'fits': [fit('od_cal_sigmoid', 'sigmoid',
+                         [OD_135_COEFFICIENTS] * VIALS, ['od_135'])]},
+        'temp_cal': {
+            'name': 'temp_cal', 'calibrationType': 'temperature',
+            'measuredData': [temps.tolist()] * VIALS,
+            'raw': [{'param': 'temp',
+                     'vialData': replicates([temp_raw] * VIALS)}],
+            'fits': [fit('temp_cal_linear', 'linear',
+                         [TEMP_COEFFICIENTS] * VIALS, ['temp'])]},
+        'pump_cal': {
+            'name': 'pump_cal', 'calibrationType': 'pump',
+            'measuredData': [], 'raw': [],
+            'fits': [fit('pump_cal_constant', 'constant',
+                         [PUMP_FLOW_RATE] * 48, ['pump'])]},
+    }
+
+
+class EvolverServer:
+    """
+    The /dpu-evolver namespace: broadcasts every interval seconds, each
+    broadcast advancing the growth model by step seconds, and handles the
+    command and calibration events of the real eVOLVER server.
+    """
+
+    def __init__(self, model, interval=20.0, step=20.0, record=None):
+        self.model = model
+        self.interval = interval
+        self.step = step
+        self.calibrations = make_calibrations(model.rng)
+        self.config = {
+            'temp': {'value': self._raw_temperatures(model.set_temp)},
+            'stir': {'value': ['8'] * VIALS},
+            'pump': {'value': ['--'] * 48},
+        }
+        self.broadcasts = 0
+        self.commands = 0
+        self.record = open(record, 'a') if record else None
+        self.sio = socketio.AsyncServer(async_mode='aiohttp',
+                                        client_manager=BroadcastManager())
+        for event in ['connect', 'disconnect', 'command', 'getactivecal',
+                      'getcalibrationnames', 'getcalibration',
+                      'setfitcalibration']:
+            self.sio.on(event, getattr(self, 'on_' + event),
+                        namespace=NAMESPACE)
+
+    @staticmethod
+    def _raw_temperatures(temps):
+        return [str(int((t - TEMP_COEFFICIENTS[1]) / TEMP_COEFFICIENTS[0]))
+                for t in temps]
+
+    async def on_connect(self, sid, environ):
+        print('DPU connected: {0}'.format(sid), flush=True)
+
+    async def on_disconnect(self, sid):
+        print('DPU disconnected: {0}'.format(sid), flush=True)
+
+    async def on_command(self, sid, data):
+        self.commands += 1
+        if self.record is not None:
+            self.record.write(json.dumps({'time': time.time(), 'sid': sid,
+                                          'command': data}) + '\n')
+            self.record.flush()
+        param = data.get('param')
+        values = data.get('value', [])
+        if param == 'pump' and not data.get('recurring', True):
+            for vial, value in enumerate(values[:VIALS]):
+                if value not in ('--', None) and float(value) > 0:
+                    self.model.bolus(vial, float(value))
+            return
+        if param in self.config:
+            current = self.config[param]['value']
+            for i, value in enumerate(values[:len(current)]):
+                if value != '--':
+                    current[i] = str(value)
+        if param == 'temp':
+            raw = np.array([float(v) for v in self.config['temp']['value']])
+            self.model.set_temp = raw * TEMP_COEFFICIENTS[0] + \
+                TEMP_COEFFICIENTS[1]
+        elif param == 'pump':
+            for vial, value in enumerate(self.config['pump']['value'][:VIALS]):
+                bolus, _, period = str(value).partition('|')
+                if period:
+                    self.model.chemo_bolus[vial] = float(bolus)
+                    self.model.chemo_period[vial] = float(period)
+
+    async def on_getactivecal(self, sid, data=None):
+        active = []
+        for calibration in self.calibrations.values():
+            fits = [fit for fit in calibration['fits'] if fit['active']]
+            if fits:
+                active.append(dict(calibration, fits=fits))
+        await self.sio.emit('activecalibrations', active, room=sid,
+                            namespace=NAMESPACE)
+
+    async def on_getcalibrationnames(self, sid, data=None):
+        names = [{'name': name, 'calibrationType': c['calibrationType']}
+                 for name, c in self.calibrations.items()]
+        await self.sio.emit('calibrationnames', names, room=sid,
+                            namespace=NAMESPACE)
+
+    async def on_getcalibration(self, sid, data):
+        calibration = self.calibrations.get(data.get('name'))
+        await self.sio.emit('calibration', calibration, room=sid,
+                            namespace=NAMESPACE)
+
+    async def on_setfitcalibration(self, sid, data):
+        calibration = self.calibrations.get(data.get('name'))
+        if calibration is None:
+            return
+        fit = data['fit']
+        calibration['fits'] = [f for f in calibration['fits']
+                               if f['name'] != fit['name']] + [fit]
+        print('fit {0} added to {1}'.format(fit['name'], data['name']),
+              flush=True)
+
+    async def broadcast_loop(self):
+        next_time = time.monotonic()
+        while True:
+            self.model.step(self.step)
+            await self.sio.emit('broadcast',
+                                {'data': self.model.readings(),
+                                 'config': self.config,
+                                 'ip': 'localhost',
+                                 'timestamp': time.time()},
+                                namespace=NAMESPACE)
+            self.broadcasts += 1
+            next_time += self.interval
+            await asyncio.sleep(max(0, next_time - time.monotonic()))
+
+    async def start(self, app):
+        self.task = asyncio.ensure_future(self.broadcast_loop())
+
+    async def stop(self, app):
+        self.task.cancel()
+        print('{0} broadcasts sent, {1} commands received'.format(
+            self.broadcasts, self.commands), flush=True)
+        if self.record is not None:
+            self.record.close()
+
+    def run(self, host, port):
+        app = web.Application()
+        self.sio.attach(app)
+        app.on_startup.append(self.start)
+        app.on_shutdown.append(self.stop)
+        web.run_app(app, host=host, port=port, print=None)
+
+
+def get_options():
+    description = 'Serve a simulated eVOLVER for the DPU to connect to'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--host', default='0.0.0.0',
+                        help='Interface to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=8081,
+                        help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=20,
+                        help='Real seconds between broadcasts, can be far '
+                             'below the 20 s of an eVOLVER (default: '
+                             '%(default)s)')
+    parser.add_argument('--step', type=float, default=20,
+                        help='Simulated seconds each broadcast advances the '
+                             'growth model by (default: %(default)s)')
+    parser.add_argument('--doubling-time', type=float, default=1.5,
+                        help='Doubling time in hours (default: %(default)s)')
+    parser.add_argument('--initial-od', type=float, default=0.05,
+                        help='Starting OD of all vials (default: '
+                             '%(default)s)')
+    parser.add_argument('--seed', type=int,
+                        help='Random seed for reproducible runs')
+    parser.add_argument('--record',
+                        help='Append every command received to this file, '
+                             'one json object per line')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = get_options()
+    model = GrowthModel(doubling_time=options.doubling_time,
+                        initial_od=options.initial_od, seed=options.seed)
+    server = EvolverServer(model, options.interval, options.step,
+                           options.record)
+    print('simulated eVOLVER on port {0}, broadcasting every {1} s'.format(
+        options.port, options.interval), flush=True)
+    try:
+        server.run(options.host, options.port)
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Reports how long the DPU's entry points, eVOLVER.py and calibrate.py,
+take to import, from the output of python -X importtime in a fresh
+interpreter. For each of them the median total import time over the runs,
+the modules it imports directly that take the longest (cumulative time,
+so with everything they import themselves) and the heavy libraries that
+got imported are listed, next to the wall time of the whole interpreter
+start. Heavy libraries such as scipy and matplotlib should only show up
+when a code path actually needs them.
+
+Both entry points are timed by default, each imported from its own
+directory (experiment/template and calibration), so the tool can be run
+from anywhere in the repository. --entry-points picks one of them, e.g.
+calibrate for calibration/calibrate.py, and -r/--repeat sets how many
+fresh interpreters the medians are taken over:
+
+    python experiment/importtime.py -o startup.json
+    python experiment/importtime.py --compare startup.json
+    python experiment/importtime.py --entry-points calibrate -r 10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+ENTRY_POINTS = {
+    'eVOLVER': os.path.join(ROOT, 'experiment', 'template'),
+    'calibrate': os.path.join(ROOT, 'calibration'),
+}
+# libraries that take seconds to import on a Raspberry Pi
+HEAVY = ['scipy', 'matplotlib', 'mpl_toolkits', 'pandas']
+RESULTS_VERSION = 1
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_importtime(output):
+    """
+    [(module, depth, self_us, cumulative_us)] from the stderr of
+    python -X importtime, depth 0 for modules imported at the top level.
+    """
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # the header
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), depth, int(fields[0]), int(fields[1])))
+    return rows
+
+
+def direct_imports(rows, module):
+    """
+    Rows of the modules imported directly by module; importtime lists a
+    module after everything it imports.
+    """
+    children = []
+    for row in rows:
+        if row[1] == 0:
+            if row[0] == module:
+                return children
+            children = []
+        elif row[1] == 1:
+            children.append(row)
+    return []
+
+
+def import_once(module, directory):
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import {0}'.format(module)],
+        cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError('importing {0} failed:\n{1}'.format(
+            module, process.stderr.strip().splitlines()[-1]))
+    return wall, parse_importtime(process.stderr)
+
+
+def measure(module, directory, repeat, top):
+    walls = []
+    totals = []
+    children = {}
+    loaded = set()
+    for _ in range(repeat):
+        wall, rows = import_once(module, directory)
+        walls.append(wall)
+        totals.append(sum(row[3] for row in rows if row[1] == 0) / 1e6)
+        for name, _, _, cumulative in direct_imports(rows, module):
+            children.setdefault(name, []).append(cumulative / 1e6)
+        loaded.update(row[0].split('.')[0] for row in rows)
+    slowest = sorted(((statistics.median(times), name)
+                      for name, times in children.items()), reverse=True)
+    return {'wall': statistics.median(walls),
+            'imports': statistics.median(totals),
+            'slowest': [[name, seconds] for seconds, name in slowest[:top]],
+            'heavy': [name for name in HEAVY if name in loaded]}
+
+
+def run(names, repeat, top):
+    results = {'version': RESULTS_VERSION,
+               'revision': git_revision(),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'repeat': repeat,
+               'entry_points': {}}
+    for name in names:
+        print('importing {0}...'.format(name), file=sys.stderr)
+        results['entry_points'][name] = measure(name, ENTRY_POINTS[name],
+                                                repeat, top)
+    return results
+
+
+def report(results, previous=None):
+    for name, result in results['entry_points'].items():
+        print('{0}: {1:.3f} s imports, {2:.3f} s with interpreter start'
+              .format(name, result['imports'], result['wall']))
+        for module, seconds in result['slowest']:
+            print('    {0:32}{1:8.3f} s'.format(module, seconds))
+        print('    heavy libraries imported: {0}'.format(
+            ', '.join(result['heavy']) or 'none'))
+        if previous is None:
+            continue
+        try:
+            old = previous['entry_points'][name]
+        except KeyError:
+            continue
+        print('    change against {0} (new/old): imports {1:.2f}, with '
+              'interpreter start {2:.2f}'.format(
+                  previous.get('revision') or 'previous results',
+                  result['imports'] / old['imports'],
+                  result['wall'] / old['wall']))
+
+
+def get_options():
+    description = 'Time the imports of the DPU entry points'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--entry-points', nargs='+',
+                        choices=list(ENTRY_POINTS), default=list(ENTRY_POINTS),
+                        help='Entry points to time (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Fresh interpreters per entry point (default: '
+                             '%(default)s)')
+    parser.add_argument('--top', type=int, default=8,
+                        help='Slowest direct imports listed per entry point '
+                             '(default: %(default)s)')
+    parser.add_argument('-o', '--output',
+                        help='Write the results to this json file')
+    parser.add_argument('--compare',
+                        help='Json results of an earlier run to compare '
+                             'against')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = get_options()
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+    results = run(options.entry_points, options.repeat, options.top)
+    report(results, previous)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Recomputes the OD series of a recorded experiment with another
+calibration fit, e.g. one refitted with calibration/calibrate.py, from the
+raw readings eVOLVER.py saves with every broadcast (the <param>_raw
+directories).
+
+The raw files of all vials are read in step, a chunk of rows at a time,
+and each chunk is calibrated for all vials and timepoints at once with
+the fit (sigmoid, linear or 3d), so memory use only depends on the chunk
+size, not on the length of the experiment. The result is written as
+<output>/OD/vialN_OD.txt in the format of the experiment's OD files.
+If the recording was blanked, the blank is recomputed with the new fit
+from each vial's first valid OD; the DPU does not blank with invalid
+readings either.
+
+The fit json can be a single fit (like od_cal.json or what calibrate.py
+sends to the eVOLVER) or a calibration with a list of fits, from which
+--fit-name picks one (default: the active one).
+
+    python experiment/recalibrate.py experiment/template/data new_fit.json \\
+        -o /tmp/recalibrated
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import itertools
+
+import numpy as np
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'template')
+sys.path.insert(0, TEMPLATE_DIR)
+
+from calibrations import compile_fit, apply_fit, THREE_DIMENSION
+from datafiles import vial_file_path
+
+CHUNK_ROWS = 16384
+
+
+def load_fit(path, name=None):
+    with open(path) as f:
+        fit = json.load(f)
+    if 'fits' not in fit:
+        return fit
+    fits = fit['fits']
+    if name is not None:
+        fits = [fit for fit in fits if fit.get('name') == name]
+    elif len(fits) > 1:
+        fits = [fit for fit in fits if fit.get('active')]
+    if len(fits) != 1:
+        raise ValueError('{0} has {1} matching fits, pick one with '
+                         '--fit-name'.format(path, len(fits)))
+    return fits[0]
+
+
+def parse_rows(lines):
+    """
+    (n x 2) array of the (elapsed_time, value) rows in lines, values that
+    are not numbers become NaN.
+    """
+    if not lines:
+        return np.empty((0, 2))
+    try:
+        return np.loadtxt(lines, delimiter=',', usecols=(0, 1), ndmin=2)
+    except ValueError:
+        rows = []
+        for line in lines:
+            elapsed_time, _, value = line.strip().partition(',')
+            try:
+                value = float(value)
+            except ValueError:
+                value = np.nan
+            rows.append((float(elapsed_time), value))
+        return np.asarray(rows, dtype=np.float64)
+
+
+class RawChunks:
+    """
+    Reads the <param>_raw files of the vials of an experiment in chunks of
+    up to 'rows' rows, yielding the (n,) elapsed times and a (vials, n)
+    array of readings per parameter. The files of all vials and parameters
+    have to hold the same broadcasts.
+    """
+
+    def __init__(self, exp_dir, params, vials, rows=CHUNK_ROWS):
+        self.params = params
+        self.vials = vials
+        self.rows = rows
+        self.headers = {}
+        self.files = []
+        self.lines = []
+        for param in params:
+            for x in range(vials):
+                f = open(vial_file_path(exp_dir, x, param + '_raw'))
+                self.files.append(f)
+                first = f.readline()
+                try:
+                    float(first.split(',')[0])
+                except ValueError:
+                    self.headers.setdefault(x, first.rstrip('\n'))
+                    self.lines.append(f)
+                else:
+                    # no header, the first line is data
+                    self.lines.append(itertools.chain([first], f))
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def __iter__(self):
+        while True:
+            chunks = []
+            for lines in self.lines:
+                lines = itertools.islice(lines, self.rows)
+                chunks.append(parse_rows([line for line in lines
+                                          if line.strip()]))
+            n = min(len(chunk) for chunk in chunks)
+            if n == 0:
+                return
+            if any(len(chunk) != n for chunk in chunks):
+                print('raw files end at different rows, stopping at the '
+                      'shortest', file=sys.stderr)
+            times = np.stack([chunk[:n, 0] for chunk in chunks])
+            if not (times == times[0]).all():
+                column = np.flatnonzero((times != times[0]).any(axis=0))[0]
+                raise ValueError('raw files do not hold the same broadcasts '
+                                 '(elapsed time {0})'.format(
+                                     times[0, column]))
+            values = np.stack([chunk[:n, 1] for chunk in chunks])
+            yield times[0], dict(
+                (param, values[i * self.vials:(i + 1) * self.vials])
+                for i, param in enumerate(self.params))
+            if any(len(chunk) != n for chunk in chunks):
+                return
+
+
+def recorded_blank(exp_dir):
+    pickle_path = os.path.join(exp_dir, os.path.basename(exp_dir) +
+                               '.pickle')
+    if not os.path.exists(pickle_path):
+        return None
+    with open(pickle_path, 'rb') as f:
+        _, od_initial = pickle.load(f)
+    return np.asarray(od_initial, dtype=np.float64)
+
+
+def first_finite(values):
+    """
+    Column of the first finite value of each row of values, and the value
+    (NaN for rows without any).
+    """
+    finite = np.isfinite(values)
+    columns = np.argmax(finite, axis=1)
+    first = values[np.arange(len(values)), columns]
+    return columns, np.where(finite.any(axis=1), first, np.nan)
+
+
+def recalibrate(exp_dir, fit, output, param='OD', blank=True,
+                chunk_rows=CHUNK_ROWS):
+    """
+    Writes the series of fit applied to the raw data of exp_dir to
+    output/<param>. Returns the number of rows per vial.
+    """
+    coefficients = compile_fit(fit)
+    vials = len(coefficients)
+    params = list(fit['params'][:2 if fit['type'] == THREE_DIMENSION
+                                else 1])
+    if blank:
+        recorded = recorded_blank(exp_dir)
+        # only blank again if the recording was blanked
+        blank = recorded is not None and np.any(recorded != 0)
+    reader = RawChunks(exp_dir, params, vials, chunk_rows)
+    os.makedirs(os.path.join(output, param), exist_ok=True)
+    outputs = []
+    for x in range(vials):
+        header = reader.headers.get(x)
+        existing = vial_file_path(exp_dir, x, param)
+        if os.path.exists(existing):
+            with open(existing) as f:
+                header = f.readline().rstrip('\n')
+        f = open(vial_file_path(output, x, param), 'w')
+        if header is not None:
+            f.write(header + '\n')
+        outputs.append(f)
+    rows = 0
+    offset = np.full(vials, np.nan)
+    try:
+        for times, raw in reader:
+            values = apply_fit(fit['type'], coefficients, raw[params[0]],
+                               raw.get(params[1]) if len(params) > 1
+                               else None)
+            if blank:
+                # readings before a vial's blank are not finite, so they
+                # stay NaN whatever is subtracted
+                missing = np.flatnonzero(np.isnan(offset))
+                columns, offset[missing] = first_finite(values[missing])
+                for x, column in zip(missing, columns):
+                    if rows + column > 0 and np.isfinite(offset[x]):
+                        print('vial {0} blanked with its first valid OD, at '
+                              'elapsed time {1}'.format(x, times[column]),
+                              file=sys.stderr)
+                values = values - offset[:, np.newaxis]
+            times = times.tolist()
+            for f, vial_values in zip(outputs, values.tolist()):
+                f.write(''.join('{0},{1}\n'.format(t, v) for t, v in
+                                zip(times, vial_values)))
+            rows += len(times)
+    finally:
+        reader.close()
+        for f in outputs:
+            f.close()
+    if blank and rows:
+        for x in np.flatnonzero(np.isnan(offset)):
+            print('vial {0} has no valid OD with this fit to blank with, its '
+                  'series is all NaN'.format(x), file=sys.stderr)
+    return rows
+
+
+def get_options():
+    description = ('Recompute the OD of a recorded experiment with another '
+                   'calibration fit')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('experiment',
+                        help='Directory of the recorded experiment (e.g. '
+                             'experiment/template/data)')
+    parser.add_argument('fit', help='Json file with the fit to apply')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Directory to write the new series to')
+    parser.add_argument('--fit-name',
+                        help='Fit to use from a calibration with several')
+    parser.add_argument('--param', default='OD',
+                        help='Name of the series written (default: '
+                             '%(default)s)')
+    parser.add_argument('--no-blank', action='store_true', default=False,
+                        help='Do not blank the new OD even if the recording '
+                             'was blanked')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS,
+                        help='Rows per vial read at a time (default: '
+                             '%(default)s)')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Replace an earlier series in the output '
+                             'directory')
+    options = parser.parse_args()
+    options.experiment = os.path.realpath(options.experiment)
+    options.output = os.path.realpath(options.output)
+    if not os.path.isdir(options.experiment):
+        parser.error('no experiment directory {0}'.format(options.experiment))
+    if options.output == options.experiment:
+        parser.error('the output would overwrite the recorded experiment')
+    if (os.path.exists(os.path.join(options.output, options.param)) and
+            not options.overwrite):
+        parser.error('{0} exists, use --overwrite to replace it'.format(
+            os.path.join(options.output, options.param)))
+    return options
+
+
+if __name__ == '__main__':
+    options = get_options()
+    try:
+        fit = load_fit(options.fit, options.fit_name)
+        start = time.perf_counter()
+        rows = recalibrate(options.experiment, fit, options.output,
+                           options.param, not options.no_blank,
+                           options.chunk_rows)
+    except (ValueError, KeyError, OSError) as e:
+        print('recalibrate: {0}'.format(e), file=sys.stderr)
+        sys.exit(1)
+    print('recalibrated {0} rows per vial with {1} fit {2} in {3:.1f} s, '
+          'results in {4}'.format(rows, fit['type'], fit.get('name'),
+                                  time.perf_counter() - start,
+                                  os.path.join(options.output,
+                                               options.param)))
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Replays a recorded experiment through the DPU's calibration and
+controller code as fast as the CPU allows, to try out changes to the
+custom script or the controllers against real history.
+
+The raw sensor readings eVOLVER.py saves with every broadcast (the
+<param>_raw directories, e.g. od_135_raw and temp_raw) are streamed back,
+one broadcast at a time, through the same on_broadcast() that handles
+live broadcasts, with the elapsed time of the recording as a virtual
+clock. The temperature setpoints the eVOLVER reports with a broadcast are
+rebuilt from the recorded temp_config and the temperature calibration,
+and are then updated by the commands the replay emits. The replay writes
+its OD, temperature, ODset, pump_log, growth rate and chemo_config files
+into a new experiment directory under the output directory, and the
+commands it would have sent to commands.jsonl.
+
+The replay is open loop: the recorded readings do not react to the
+dilutions of the replayed controllers, so only the decisions up to the
+first one that differs from the recording can be compared one to one.
+Scheduled actions due between broadcasts run at the next broadcast, and
+changes made from the GUI during the recording are not replayed.
+
+    python experiment/replay.py experiment/template/data -o /tmp/replay
+    python experiment/replay.py experiment/template/data -o /tmp/replay \\
+        --script my_script.py --mode chemostat
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import argparse
+import contextlib
+
+import numpy as np
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'template')
+sys.path.insert(0, TEMPLATE_DIR)
+
+import eVOLVER
+from datafiles import vial_file_path, read_appended
+from scriptreload import ScriptReloader
+
+CALIBRATION_TYPES = [('od', 'od', eVOLVER.OD_CAL_FILE),
+                     ('temperature', 'temp', eVOLVER.TEMP_CAL_FILE),
+                     ('pump', 'pump', eVOLVER.PUMP_CAL_FILE)]
+# pump slots of a fluidic command
+PUMP_SLOTS = 48
+
+
+class FakeIO:
+    _url = 'replay'
+
+
+class ReplayNamespace(eVOLVER.EvolverNamespace):
+    """
+    The namespace of eVOLVER.py with a virtual clock instead of the wall
+    clock and a simulated eVOLVER configuration instead of the socket:
+    commands are recorded and applied to config, which is what the next
+    broadcast reports back.
+    """
+
+    virtual_time = 0.0
+
+    def __init__(self, *args, **kw):
+        self.sent = []
+        self.config = {'temp': {'value': ['--'] * len(eVOLVER.VIALS)},
+                       'stir': {'value': ['--'] * len(eVOLVER.VIALS)},
+                       'pump': {'value': ['--'] * PUMP_SLOTS}}
+        super().__init__(*args, **kw)
+
+    def elapsed(self):
+        return self.virtual_time
+
+    def emit(self, event, *args, **kw):
+        if event != 'command':
+            return
+        command = args[0]
+        self.sent.append((self.virtual_time, command))
+        param = command.get('param')
+        if param not in self.config:
+            return
+        if param == 'pump' and not command.get('recurring'):
+            # one-shot dilutions leave the configuration alone
+            return
+        values = self.config[param]['value']
+        for i, value in enumerate(command['value'][:len(values)]):
+            if value != '--':
+                values[i] = value
+
+    def broadcast(self, data):
+        """
+        A broadcast with the given raw readings ({param: [values]}) and
+        the current configuration.
+        """
+        return {'data': data,
+                'config': dict((param, {'value': list(values['value'])})
+                               for param, values in self.config.items())}
+
+
+class RawReader:
+    """
+    Streams the rows of the <param>_raw files of an experiment, all vials
+    and parameters in step, one broadcast at a time and without loading
+    the files. Rows are matched by their elapsed time, files with rows the
+    others lack (e.g. a parameter added by a later calibration) are
+    skipped ahead.
+    """
+
+    def __init__(self, exp_dir, params, vials):
+        self.params = params
+        self.vials = vials
+        self.files = [(param, x, open(vial_file_path(exp_dir, x,
+                                                     param + '_raw')))
+                      for param in params for x in vials]
+
+    def close(self):
+        for _, _, f in self.files:
+            f.close()
+
+    @staticmethod
+    def _next_row(f):
+        for line in f:
+            elapsed_time, _, value = line.strip().partition(',')
+            try:
+                return float(elapsed_time), value
+            except ValueError:
+                # the header
+                continue
+        return None
+
+    def __iter__(self):
+        rows = [self._next_row(f) for _, _, f in self.files]
+        while all(row is not None for row in rows):
+            elapsed_time = max(row[0] for row in rows)
+            behind = [i for i, row in enumerate(rows)
+                      if row[0] < elapsed_time]
+            if behind:
+                for i in behind:
+                    rows[i] = self._next_row(self.files[i][2])
+                continue
+            data = dict((param, [None] * len(self.vials))
+                        for param in self.params)
+            for (param, x, _), row in zip(self.files, rows):
+                data[param][x] = row[1]
+            yield elapsed_time, data
+            rows = [self._next_row(f) for _, _, f in self.files]
+
+
+def load_setpoints(exp_dir, vials):
+    """
+    (elapsed_time, vial, temperature) changes of the recorded temp_config,
+    in time order.
+    """
+    changes = []
+    for x in vials:
+        path = vial_file_path(exp_dir, x, 'temp_config')
+        if not os.path.exists(path):
+            continue
+        rows, _ = read_appended(path, 0)
+        for elapsed_time, value in rows[:, :2].tolist():
+            if np.isfinite(value):
+                changes.append((elapsed_time, x, value))
+    changes.sort(key=lambda change: change[0])
+    return changes
+
+
+def load_calibrations(directory):
+    calibrations = []
+    for calibration_type, kind, file_name in CALIBRATION_TYPES:
+        path = os.path.join(directory, file_name)
+        if not os.path.exists(path):
+            raise ValueError('no {0} calibration in {1}'.format(kind,
+                                                                 directory))
+        with open(path) as f:
+            fit = json.load(f)
+        calibrations.append({'calibrationType': calibration_type,
+                             'fits': [dict(fit, active=True)]})
+    return calibrations
+
+
+def load_blank(exp_dir):
+    """
+    The OD blank of the recording, None if it has none.
+    """
+    pickle_path = os.path.join(exp_dir, os.path.basename(exp_dir) +
+                               '.pickle')
+    if not os.path.exists(pickle_path):
+        return None
+    with open(pickle_path, 'rb') as f:
+        _, od_initial = pickle.load(f)
+    return od_initial
+
+
+def open_replay(options):
+    eVOLVER.SAVE_PATH = options.output
+    namespace = ReplayNamespace(FakeIO(), '/dpu-evolver')
+    # checkpoints only at the end
+    namespace.checkpointer.interval = float('inf')
+    if options.script or options.mode:
+        reloader = ScriptReloader(options.script or eVOLVER.CUSTOM_SCRIPT_PATH,
+                                  eVOLVER.custom_script,
+                                  required=eVOLVER.CUSTOM_FUNCTIONS.values())
+        script = reloader.load()
+        if script is None:
+            raise ValueError('could not load {0}'.format(reloader.path))
+        if options.mode:
+            script.OPERATION_MODE = options.mode
+        namespace.script = script
+    experiment_params = None
+    if options.parameters:
+        with open(options.parameters) as f:
+            experiment_params = json.load(f)
+    log_name = os.path.join(namespace.data_dir, 'evolver.log')
+    namespace.initialize_exp(eVOLVER.VIALS, experiment_params, log_name,
+                             options.quiet, 0, 'replay', True)
+    namespace.start_time = 0
+    with contextlib.redirect_stdout(None):
+        namespace.on_activecalibrations(
+            load_calibrations(options.calibrations))
+    namespace.use_blank = options.blank
+    if not options.blank:
+        od_initial = load_blank(options.experiment)
+        if od_initial is None:
+            od_initial = np.zeros(len(eVOLVER.VIALS))
+        namespace.OD_initial = np.asarray(od_initial, dtype=np.float64)
+    return namespace
+
+
+def replay(namespace, options):
+    engine = namespace.calibrations.engine()
+    params = engine.od_params[:2 if engine.od_type == eVOLVER.THREE_DIMENSION
+                              else 1] + engine.temp_params[:1]
+    changes = load_setpoints(options.experiment, eVOLVER.VIALS)
+    setpoints = np.full(len(eVOLVER.VIALS), np.nan)
+    next_change = 0
+    first = True
+    reader = RawReader(options.experiment, params, eVOLVER.VIALS)
+    broadcasts = 0
+    start = time.perf_counter()
+    try:
+        for elapsed_time, data in reader:
+            if options.until is not None and elapsed_time > options.until:
+                break
+            # setpoints of the recording up to this broadcast
+            changed = []
+            while (next_change < len(changes) and
+                   changes[next_change][0] <= elapsed_time):
+                _, x, value = changes[next_change]
+                setpoints[x] = value
+                changed.append(x)
+                next_change += 1
+            if changed:
+                if first:
+                    # the replayed experiment starts from the recorded
+                    # setpoints
+                    known = np.flatnonzero(np.isfinite(setpoints)).tolist()
+                    namespace.temp_setpoints.set(setpoints[known], 0, known)
+                    first = False
+                raw = engine.raw_temperature(np.nan_to_num(setpoints))
+                for x in set(changed):
+                    namespace.config['temp']['value'][x] = raw[x]
+            namespace.virtual_time = elapsed_time
+            with contextlib.redirect_stdout(None):
+                namespace.on_broadcast(namespace.broadcast(data))
+            broadcasts += 1
+            if options.progress and broadcasts % options.progress == 0:
+                print('{0} broadcasts, {1:.1f} hours replayed'.format(
+                    broadcasts, elapsed_time), file=sys.stderr)
+    finally:
+        reader.close()
+        with contextlib.redirect_stdout(None):
+            namespace.stop_exp()
+        namespace.write_metrics()
+    return broadcasts, time.perf_counter() - start
+
+
+def write_commands(namespace, path):
+    with open(path, 'w') as f:
+        for elapsed_time, command in namespace.sent:
+            f.write(json.dumps({'elapsed_time': elapsed_time,
+                                'command': command}) + '\n')
+
+
+def get_options():
+    description = 'Replay a recorded experiment through the DPU offline'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('experiment',
+                        help='Directory of the recorded experiment (e.g. '
+                             'experiment/template/data)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Directory to write the replayed experiment to')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Replace an earlier replay in the output '
+                             'directory')
+    parser.add_argument('--calibrations',
+                        help='Directory with the od_cal.json, temp_cal.json '
+                             'and pump_cal.json to calibrate with (default: '
+                             'the one the experiment directory is in)')
+    parser.add_argument('--script',
+                        help='Custom script to run instead of '
+                             'template/custom_script.py, e.g. a copy saved '
+                             'in the experiment directory')
+    parser.add_argument('--mode',
+                        help='Operation mode to run instead of the script\'s '
+                             'OPERATION_MODE')
+    parser.add_argument('--parameters',
+                        help='eVOLVER_parameters.json of an experiment '
+                             'started from the GUI')
+    parser.add_argument('--blank', action='store_true', default=False,
+                        help='Blank the OD with the first replayed broadcast '
+                             'instead of using the blank of the recording')
+    parser.add_argument('--until', type=float,
+                        help='Stop at this elapsed time (hours)')
+    parser.add_argument('--progress', type=int, default=10000,
+                        help='Broadcasts between progress reports, 0 for '
+                             'none (default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+                        help='Do not write the log file of the replay')
+    options = parser.parse_args()
+    options.experiment = os.path.realpath(options.experiment)
+    options.output = os.path.realpath(options.output)
+    if not os.path.isdir(options.experiment):
+        parser.error('no experiment directory {0}'.format(options.experiment))
+    if options.calibrations is None:
+        options.calibrations = os.path.dirname(options.experiment)
+    data_dir = os.path.join(options.output, eVOLVER.EXP_NAME)
+    if data_dir == options.experiment:
+        parser.error('the replay would overwrite the recorded experiment')
+    if os.path.exists(data_dir):
+        if not options.overwrite:
+            parser.error('{0} exists, use --overwrite to replace '
+                         'it'.format(data_dir))
+        shutil.rmtree(data_dir)
+    os.makedirs(options.output, exist_ok=True)
+    return options
+
+
+if __name__ == '__main__':
+    options = get_options()
+    try:
+        namespace = open_replay(options)
+    except ValueError as e:
+        print('replay: {0}'.format(e), file=sys.stderr)
+        sys.exit(1)
+    broadcasts, seconds = replay(namespace, options)
+    write_commands(namespace, os.path.join(options.output, 'commands.jsonl'))
+    eVOLVER.stop_logging()
+    hours = namespace.last_elapsed_time or 0
+    print('replayed {0} broadcasts ({1:.1f} hours) in {2:.1f} s, {3:.0f}x '
+          'real time'.format(broadcasts, hours, seconds,
+                             hours * 3600 / seconds if seconds else 0))
+    counters = namespace.metrics.snapshot()['counters']
+    print('{0} commands, {1} pump events, {2} readings rejected by the '
+          'sensor QC'.format(len(namespace.sent), counters['pump_events'],
+                             counters['qc_rejections']))
+    print('results in {0}'.format(namespace.data_dir))
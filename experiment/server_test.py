@@ -1,3 +1,4 @@
+import sys
 import socket
 from socketIO_client import SocketIO, BaseNamespace
 import asyncio
@@ -8,7 +9,8 @@ import time
 STIR_VALUES = [[0] * 16, [8] * 16] # flip between on and off
 TEMP_VALUES = [4095] * 16 # always off
 
-EVOLVER_IP = '192.168.1.8'
+# defaults to the simulated eVOLVER of evolver_server.py
+EVOLVER_IP = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
 EVOLVER_PORT = 8081
 evolver_ns = None
 socketIO = None
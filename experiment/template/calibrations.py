@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import logging
+
+import numpy as np
+
+SIGMOID = 'sigmoid'
+LINEAR = 'linear'
+THREE_DIMENSION = '3d'
+
+# number of coefficients each fit type needs per vial
+FIT_COEFFICIENTS = {SIGMOID: 4, LINEAR: 2, THREE_DIMENSION: 6}
+# OD fit types a running experiment accepts; apply_fit also does linear
+# ones, e.g. for recalibrate.py
+OD_FIT_TYPES = [SIGMOID, THREE_DIMENSION]
+
+logger = logging.getLogger('eVOLVER')
+
+
+def compile_fit(fit):
+    """
+    Turns the 'coefficients' list of a calibration fit into a
+    (vials x coefficients) float matrix, checking it has enough columns
+    for the fit type.
+    """
+    coefficients = np.asarray(fit['coefficients'], dtype=np.float64)
+    needed = FIT_COEFFICIENTS.get(fit['type'])
+    if needed is not None:
+        if coefficients.ndim != 2 or coefficients.shape[1] < needed:
+            raise ValueError('%s fit %s needs %d coefficients per vial' %
+                             (fit['type'], fit.get('name'), needed))
+        coefficients = coefficients[:, :needed]
+    return coefficients
+
+
+def apply_fit(fit_type, coefficients, raw, raw_2=None):
+    """
+    Calibrated values of raw readings with a compiled fit (see
+    compile_fit). raw (and raw_2, the second parameter of 3d fits) are
+    (vials,) arrays, or (vials, n) arrays of n readings per vial; values
+    that do not calibrate to a finite number come out as NaN.
+    """
+    c = coefficients
+    raw = np.asarray(raw, dtype=np.float64)
+    if raw.ndim == 2:
+        # one row of coefficients per vial, along the readings
+        c = c[:, :, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if fit_type == SIGMOID:
+            values = c[:, 2] - (np.log10((c[:, 1] - c[:, 0]) /
+                                         (raw - c[:, 0]) - 1) / c[:, 3])
+        elif fit_type == LINEAR:
+            values = raw * c[:, 0] + c[:, 1]
+        elif fit_type == THREE_DIMENSION:
+            raw_2 = np.asarray(raw_2, dtype=np.float64)
+            values = (c[:, 0] + c[:, 1] * raw + c[:, 2] * raw_2 +
+                      c[:, 3] * raw ** 2 + c[:, 4] * raw * raw_2 +
+                      c[:, 5] * raw_2 ** 2)
+        else:
+            raise ValueError('unsupported fit type %s' % fit_type)
+    values[~np.isfinite(values)] = np.nan
+    return values
+
+
+def to_float_array(values):
+    """
+    Converts a broadcast list (numbers or numeric strings, possibly 'NaN')
+    into a float64 array. Unparsable entries become NaN.
+    """
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        result = np.empty(len(values))
+        for i, value in enumerate(values):
+            try:
+                result[i] = float(value)
+            except (TypeError, ValueError):
+                result[i] = np.nan
+        return result
+
+
+class Calibrated:
+    """
+    Result of calibrating one broadcast. All arrays are indexed by vial;
+    invalid readings are NaN and flagged False in the corresponding mask.
+    """
+
+    def __init__(self, od, temp, set_temp):
+        self.od = od
+        self.temp = temp
+        self.set_temp = set_temp
+        self.od_valid = np.isfinite(od)
+        self.temp_valid = np.isfinite(temp)
+
+    @property
+    def valid(self):
+        return self.od_valid & self.temp_valid
+
+
+class CalibrationEngine:
+    """
+    Compiles an OD and a temperature calibration fit into coefficient
+    matrices once, then calibrates all vials of a broadcast in a single
+    numpy pass.
+    """
+
+    def __init__(self, od_cal, temp_cal):
+        self.od_type = od_cal['type']
+        self.od_params = list(od_cal['params'])
+        self.temp_params = list(temp_cal['params'])
+        self.od_coefficients = compile_fit(od_cal)
+        self.temp_coefficients = compile_fit(dict(temp_cal, type=LINEAR))
+
+    def od(self, raw, raw_2=None):
+        if self.od_type not in OD_FIT_TYPES:
+            logger.error('OD calibration not of supported type!')
+            return np.full(np.shape(raw), np.nan)
+        return apply_fit(self.od_type, self.od_coefficients, raw, raw_2)
+
+    def temperature(self, raw):
+        c = self.temp_coefficients
+        return np.asarray(raw, dtype=np.float64) * c[:, 0] + c[:, 1]
+
+    def raw_temperature(self, temps):
+        """
+        Inverse of temperature(): the raw values to send to the eVOLVER
+        to reach the given temperatures.
+        """
+        c = self.temp_coefficients
+        raw = (np.asarray(temps, dtype=np.float64) - c[:, 1]) / c[:, 0]
+        return [str(int(x)) for x in raw]
+
+    def transform(self, od, temp, set_temp, od_2=None):
+        return Calibrated(self.od(od, od_2),
+                          self.temperature(temp),
+                          self.temperature(set_temp))
+
+    @classmethod
+    def stack(cls, engines):
+        """
+        Engine calibrating the vials of several engines (e.g. one per
+        eVOLVER unit) at once, their vials one after the other. All engines
+        need the same OD fit type.
+        """
+        od_types = set(engine.od_type for engine in engines)
+        if len(od_types) != 1:
+            raise ValueError('cannot stack OD fits of types %s' %
+                             ', '.join(sorted(od_types)))
+        stacked = cls.__new__(cls)
+        stacked.od_type = engines[0].od_type
+        stacked.od_params = engines[0].od_params
+        stacked.temp_params = engines[0].temp_params
+        stacked.od_coefficients = np.vstack([engine.od_coefficients
+                                             for engine in engines])
+        stacked.temp_coefficients = np.vstack([engine.temp_coefficients
+                                               for engine in engines])
+        return stacked
+
+
+def transform_batch(engines, inputs):
+    """
+    Calibrates several broadcasts in one numpy pass per OD fit type.
+    inputs[i] holds the (od, temp, set_temp, od_2) arrays for engines[i];
+    returns the Calibrated results in the same order.
+    """
+    results = [None] * len(engines)
+    by_type = {}
+    for i, engine in enumerate(engines):
+        by_type.setdefault(engine.od_type, []).append(i)
+    for indices in by_type.values():
+        stacked = CalibrationEngine.stack([engines[i] for i in indices])
+        columns = list(zip(*[inputs[i] for i in indices]))
+        od, temp, set_temp = [np.concatenate(column) for column in columns[:3]]
+        od_2 = None
+        if stacked.od_type == THREE_DIMENSION:
+            od_2 = np.concatenate(columns[3])
+        calibrated = stacked.transform(od, temp, set_temp, od_2)
+        start = 0
+        for i in indices:
+            end = start + len(inputs[i][0])
+            results[i] = Calibrated(calibrated.od[start:end],
+                                    calibrated.temp[start:end],
+                                    calibrated.set_temp[start:end])
+            start = end
+    return results
+
+
+class CalibrationStore:
+    """
+    Keeps the active od, temperature and pump fits parsed and validated in
+    memory. Fits received from the eVOLVER are installed directly with
+    update(); the json files on disk are only re-read when their mtime
+    changes (checked at most every check_interval seconds), which covers
+    edits made outside of the DPU.
+    """
+
+    def __init__(self, paths, check_interval=30):
+        # paths: {'od': od_cal.json, 'temp': temp_cal.json, 'pump': ...}
+        self.paths = paths
+        self.check_interval = check_interval
+        self._fits = {}
+        self._arrays = {}
+        self._mtimes = {}
+        self._engine = None
+        self._last_check = None
+
+    def _install(self, kind, fit):
+        if kind == 'pump':
+            coefficients = np.asarray(fit['coefficients'], dtype=np.float64)
+        elif kind == 'temp':
+            coefficients = compile_fit(dict(fit, type=LINEAR))
+        else:
+            coefficients = compile_fit(fit)
+        if not fit.get('params'):
+            raise ValueError('%s fit %s has no params' % (kind, fit.get('name')))
+        self._fits[kind] = fit
+        self._arrays[kind] = coefficients
+        if kind in ('od', 'temp'):
+            self._engine = None
+
+    def _discard(self, kind):
+        self._fits.pop(kind, None)
+        self._arrays.pop(kind, None)
+        if kind in ('od', 'temp'):
+            self._engine = None
+
+    def update(self, kind, fit):
+        """
+        Installs a fit received from the eVOLVER and persists it to disk.
+        Returns False if the fit failed validation.
+        """
+        path = self.paths[kind]
+        with open(path, 'w') as f:
+            json.dump(fit, f)
+        self._mtimes[kind] = os.stat(path).st_mtime_ns
+        try:
+            self._install(kind, fit)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error('invalid %s calibration: %s', kind, e)
+            self._discard(kind)
+            return False
+        return True
+
+    def refresh(self, force=False):
+        """
+        Reloads calibration files that changed on disk since they were last
+        read. Cheap to call on every broadcast.
+        """
+        now = time.monotonic()
+        if (not force and self._last_check is not None and
+                now - self._last_check < self.check_interval and
+                len(self._fits) == len(self.paths)):
+            return
+        self._last_check = now
+        for kind, path in self.paths.items():
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self._mtimes.pop(kind, None)
+                self._discard(kind)
+                continue
+            if self._mtimes.get(kind) == mtime:
+                continue
+            self._mtimes[kind] = mtime
+            logger.info('loading %s calibration from %s', kind, path)
+            try:
+                with open(path) as f:
+                    self._install(kind, json.load(f))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error('invalid %s calibration in %s: %s', kind, path, e)
+                self._discard(kind)
+
+    def ready(self):
+        return all(kind in self._fits for kind in self.paths)
+
+    def missing(self):
+        return [kind for kind in self.paths if kind not in self._fits]
+
+    def fit(self, kind):
+        return self._fits[kind]
+
+    def coefficients(self, kind):
+        return self._arrays[kind]
+
+    def engine(self):
+        if self._engine is None:
+            self._engine = CalibrationEngine(self._fits['od'],
+                                             self._fits['temp'])
+        return self._engine
+
+    def flow_rate(self):
+        return self._arrays['pump']
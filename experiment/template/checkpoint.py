@@ -0,0 +1,62 @@
+import os
+import time
+import pickle
+import logging
+
+logger = logging.getLogger('eVOLVER')
+
+CHECKPOINT_VERSION = 1
+
+
+def atomic_pickle(obj, path):
+    """
+    Pickles obj to path through a temporary file and a rename, so a crash
+    leaves either the old or the new file, never a truncated one.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpointer:
+    """
+    Writes a versioned snapshot of the experiment runtime state at most
+    every 'interval' seconds (the first save() is never delayed).
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self._last_save = None
+
+    def due(self):
+        return (self._last_save is None or
+                time.monotonic() - self._last_save >= self.interval)
+
+    def save(self, state):
+        state = dict(state, version=CHECKPOINT_VERSION, saved=time.time())
+        atomic_pickle(state, self.path)
+        self._last_save = time.monotonic()
+        logger.debug('checkpoint %d saved to %s', state.get('sequence', 0),
+                     self.path)
+
+    def load(self):
+        """
+        The last snapshot, or None if there is none or it can't be used.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.error('could not read checkpoint %s: %s', self.path, e)
+            return None
+        if state.get('version') != CHECKPOINT_VERSION:
+            logger.warning('ignoring checkpoint %s with version %s',
+                           self.path, state.get('version'))
+            return None
+        return state
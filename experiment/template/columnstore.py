@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import logging
+import argparse
+
+import numpy as np
+
+from calibrations import to_float_array
+
+logger = logging.getLogger('eVOLVER')
+
+# file layout: a 16 byte header followed by fixed width rows of float64,
+# [elapsed_time, vial0, vial1, ...], one row per broadcast
+MAGIC = b'EVCOLS01'
+HEADER = struct.Struct('<8sII')  # magic, number of vials, reserved
+
+STORE_DIR = 'binary'
+
+
+class ColumnStore:
+    """
+    Optional binary storage for experiment data, kept next to the per-vial
+    text files. Each parameter is a single append-only file holding one
+    row per broadcast with all vials as float64, so a whole series can be
+    memory-mapped instead of parsed.
+    """
+
+    def __init__(self, exp_dir, vials=16, directory=STORE_DIR):
+        self.store_dir = os.path.join(exp_dir, directory)
+        self.vials = vials
+        self.row_size = 8 * (vials + 1)
+        self._pending = {}
+        self._files = {}
+
+    def path(self, parameter):
+        return os.path.join(self.store_dir, parameter + '.bin')
+
+    def parameters(self):
+        if not os.path.isdir(self.store_dir):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.store_dir)
+                      if name.endswith('.bin'))
+
+    def _check_header(self, f, path):
+        magic, vials, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a column store file' % path)
+        if vials != self.vials:
+            raise ValueError('%s holds %d vials, expected %d' %
+                             (path, vials, self.vials))
+
+    def _open(self, parameter):
+        f = self._files.get(parameter)
+        if f is not None:
+            return f
+        os.makedirs(self.store_dir, exist_ok=True)
+        path = self.path(parameter)
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+            with open(path, 'wb') as new_file:
+                new_file.write(HEADER.pack(MAGIC, self.vials, 0))
+        f = open(path, 'r+b')
+        self._check_header(f, path)
+        # drop a partially written row left behind by a crash
+        size = f.seek(0, os.SEEK_END)
+        rows = (size - HEADER.size) // self.row_size
+        end = HEADER.size + rows * self.row_size
+        if end != size:
+            logger.warning('truncating partial row at the end of %s', path)
+            f.truncate(end)
+            f.seek(end)
+        self._files[parameter] = f
+        return f
+
+    def append(self, parameter, elapsed_time, values):
+        row = np.empty(self.vials + 1)
+        row[0] = elapsed_time
+        row[1:] = to_float_array(values)
+        self._pending.setdefault(parameter, []).append(row)
+
+    def commit(self):
+        pending, self._pending = self._pending, {}
+        for parameter, rows in pending.items():
+            f = self._open(parameter)
+            f.write(np.asarray(rows, dtype='<f8').tobytes())
+            f.flush()
+
+    def close(self):
+        self.commit()
+        for f in self._files.values():
+            os.fsync(f.fileno())
+            f.close()
+        self._files = {}
+
+    def read(self, parameter):
+        """
+        Memory-mapped (broadcasts x vials + 1) view of a parameter; column 0
+        is the elapsed time in hours. Nothing is parsed or copied.
+        """
+        path = self.path(parameter)
+        with open(path, 'rb') as f:
+            self._check_header(f, path)
+        rows = (os.path.getsize(path) - HEADER.size) // self.row_size
+        if rows == 0:
+            return np.empty((0, self.vials + 1))
+        return np.memmap(path, dtype='<f8', mode='r', offset=HEADER.size,
+                         shape=(rows, self.vials + 1))
+
+    def series(self, parameter):
+        """
+        (times, values) views of a parameter, values shaped (broadcasts x vials).
+        """
+        data = self.read(parameter)
+        return data[:, 0], data[:, 1:]
+
+    def export_text(self, parameter, out_dir, header=None):
+        """
+        Regenerates the legacy vialN_<parameter>.txt files in out_dir.
+        header is an optional first line, e.g. the "Experiment: ..." line of
+        the OD files, formatted with the vial number as {0}.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        times, values = self.series(parameter)
+        # raw readings arrive as integers, keep them that way in the text files
+        if parameter.endswith('_raw'):
+            format_value = _format_raw
+        else:
+            format_value = '{0}'.format
+        time_strings = ['{0}'.format(t) for t in times.tolist()]
+        for vial in range(self.vials):
+            file_name = "vial{0}_{1}.txt".format(vial, parameter)
+            with open(os.path.join(out_dir, file_name), 'w') as f:
+                if header is not None:
+                    f.write(header.format(vial) + '\n')
+                f.writelines('{0},{1}\n'.format(t, format_value(v)) for t, v
+                             in zip(time_strings, values[:, vial].tolist()))
+
+
+def _format_raw(value):
+    if value.is_integer():
+        return '{0}'.format(int(value))
+    return '{0}'.format(value)
+
+
+def get_options():
+    description = ('Regenerate the per-vial text files of an experiment from '
+                   'its binary column store')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('exp_dir', help='Experiment data directory')
+    parser.add_argument('-p', '--parameter', action='append',
+                        help='Parameter to export, can be given several '
+                             'times (default: all)')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='Directory to write the <parameter>/vialN_'
+                             '<parameter>.txt files to')
+    parser.add_argument('--vials', type=int, default=16,
+                        help='Number of vials (default: %(default)s)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = get_options()
+    store = ColumnStore(options.exp_dir, options.vials)
+    for parameter in options.parameter or store.parameters():
+        out_dir = os.path.join(options.output_dir, parameter)
+        store.export_text(parameter, out_dir)
+        print('exported {0} to {1}'.format(parameter, out_dir))
@@ -0,0 +1,112 @@
+import time
+import logging
+
+logger = logging.getLogger('eVOLVER')
+
+# value of a vial/pump slot that is left as it is
+UNCHANGED = '--'
+
+
+class CommandCoalescer:
+    """
+    Sits between the namespace and the socket for 'command' messages.
+
+    The config the eVOLVER reports with every broadcast is taken as the
+    last acknowledged setting of each parameter (begin()). Commands sent
+    during a broadcast cycle are held and merged per parameter, later
+    values winning vial by vial, then emitted once at the end of the cycle
+    (flush()). Commands that would not change anything are suppressed, and
+    a recurring command (temp, stir, chemostat pumps) is not re-emitted for
+    the same parameter within min_interval seconds; it stays pending and is
+    merged into the next cycle instead. One-shot pump commands are never
+    held back. Outside a broadcast cycle commands are emitted right away.
+    """
+
+    def __init__(self, emit, min_interval=0):
+        self.emit = emit
+        self.min_interval = min_interval
+        self.acked = {}
+        self.emitted = 0
+        self.suppressed = 0
+        self.merged = 0
+        self.deferred = 0
+        self._pending = {}
+        self._last_emit = {}
+        self._in_cycle = False
+
+    def begin(self, config):
+        """
+        Starts a broadcast cycle, config being the broadcast's 'config'.
+        """
+        for param, entry in (config or {}).items():
+            if isinstance(entry, dict) and 'value' in entry:
+                self.acked[param] = [str(v) for v in entry['value']]
+        self._in_cycle = True
+
+    def send(self, param, value, immediate=False, recurring=True, **fields):
+        """
+        Queues a command; fields are extra entries of the message.
+        """
+        key = (param, recurring)
+        command = self._pending.get(key)
+        if command is None:
+            command = dict(fields, param=param, value=list(value),
+                           immediate=immediate, recurring=recurring)
+            self._pending[key] = command
+        else:
+            self.merged += 1
+            merged_value = command['value']
+            for i, v in enumerate(value):
+                if v != UNCHANGED:
+                    if i < len(merged_value):
+                        merged_value[i] = v
+                    else:
+                        merged_value.append(v)
+            command.update(fields)
+            command['immediate'] = command['immediate'] or immediate
+        if not self._in_cycle:
+            self.flush()
+
+    def is_noop(self, param, value, recurring=True):
+        """
+        True if sending value would not change the eVOLVER's settings.
+        """
+        if not recurring:
+            return all(v == UNCHANGED for v in value)
+        acked = self.acked.get(param)
+        if acked is None:
+            return False
+        for i, v in enumerate(value):
+            if v == UNCHANGED:
+                continue
+            if i >= len(acked) or str(v) != acked[i]:
+                return False
+        return True
+
+    def flush(self):
+        """
+        Ends the broadcast cycle, emitting the merged commands.
+        """
+        now = time.monotonic()
+        for key, command in list(self._pending.items()):
+            param, recurring = key
+            if self.is_noop(param, command['value'], recurring):
+                logger.debug('suppressing no-op %s command', param)
+                self.suppressed += 1
+                del self._pending[key]
+                continue
+            last = self._last_emit.get(key)
+            if (recurring and last is not None and
+                    now - last < self.min_interval):
+                self.deferred += 1
+                continue
+            del self._pending[key]
+            self._last_emit[key] = now
+            self.emitted += 1
+            self.emit(command)
+        self._in_cycle = False
+
+    def report(self):
+        logger.info('commands: %d emitted, %d suppressed as no-ops, %d '
+                    'merged, %d deferred', self.emitted, self.suppressed,
+                    self.merged, self.deferred)
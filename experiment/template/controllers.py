@@ -0,0 +1,284 @@
+import numpy as np
+
+from commands import UNCHANGED
+
+# slots in a fluidic (pump) message and offset of the efflux pump of a vial
+PUMP_SLOTS = 48
+EFFLUX_OFFSET = 16
+
+
+class ControllerInputs:
+    """
+    What an array based controller decides on, as (vials,) arrays ordered
+    like vials, the vials it controls:
+
+    od_history  last 'history' OD values of each vial, (vials, history),
+                oldest first; ready is False until there are enough
+    od          latest OD
+    flow_rate   influx pump flow rates (ml/s)
+    odset, odset_time, curves, last_pump
+                turbidostat state, see ControllerState
+    chemo_phase, chemo_rate
+                chemostat state, see ControllerState
+
+    config() gives per-vial settings from the experiment parameters of the
+    GUI with a fallback to the custom script's values.
+    """
+
+    def __init__(self, eVOLVER, vials, elapsed_time, history=1):
+        self.vials = np.asarray(vials, dtype=int)
+        self.elapsed_time = elapsed_time
+        self.experiment_params = eVOLVER.experiment_params
+        self.od_history = eVOLVER.recent('OD', history)[self.vials]
+        self.ready = self.od_history.shape[1] == history
+        if self.od_history.shape[1]:
+            self.od = self.od_history[:, -1]
+        else:
+            self.od = np.full(len(self.vials), np.nan)
+        self.flow_rate = np.asarray(eVOLVER.get_flow_rate(),
+                                    dtype=np.float64)[self.vials]
+        state = eVOLVER.controller_state
+        self.odset = state.odset[self.vials]
+        self.odset_time = state.odset_time[self.vials]
+        self.curves = state.odset_lines[self.vials] / 2
+        self.last_pump = state.last_pump[self.vials]
+        self.chemo_phase = state.chemo_phase[self.vials]
+        self.chemo_rate = state.chemo_rate[self.vials]
+
+    def config(self, key, default):
+        """
+        A per-vial setting: key of the experiment parameters'
+        vial_configuration if the GUI started the experiment, else default
+        (a scalar, or a list indexed by vial number).
+        """
+        if self.experiment_params is not None:
+            default = [vial[key] for vial in
+                       self.experiment_params['vial_configuration']]
+        values = np.asarray(default, dtype=np.float64)
+        if values.ndim == 0:
+            return np.full(len(self.vials), float(values))
+        return values[self.vials]
+
+
+def window_median(history, min_valid=None):
+    """
+    Median of each row of a (vials, n) window of values, ignoring NaN
+    (e.g. readings rejected by the sensor QC), and whether it is known:
+    only rows with at least min_valid finite values (default: most of the
+    window) have one, the others are NaN.
+    """
+    history = np.asarray(history, dtype=np.float64)
+    if min_valid is None:
+        min_valid = history.shape[1] // 2 + 1
+    known = np.isfinite(history).sum(axis=1) >= max(min_valid, 1)
+    median = np.full(len(history), np.nan)
+    if known.any():
+        median[known] = np.nanmedian(history[known], axis=1)
+    return median, known
+
+
+def pumped(influx, efflux):
+    """
+    Mask of the vials given pump times, i.e. with influx or efflux; a
+    dilution whose influx rounded to 0 still runs its efflux pump.
+    """
+    influx = np.asarray(influx, dtype=np.float64)
+    efflux = np.asarray(efflux, dtype=np.float64)
+    return (influx > 0) | (efflux > 0)
+
+
+def pump_message(vials, influx, efflux):
+    """
+    48 value fluidic message running the influx and efflux pumps of vials
+    for the given seconds; the pumps of vials with neither are left
+    unchanged.
+    """
+    vials = np.asarray(vials, dtype=int)
+    influx = np.asarray(influx, dtype=np.float64)
+    efflux = np.asarray(efflux, dtype=np.float64)
+    message = [UNCHANGED] * PUMP_SLOTS
+    on = pumped(influx, efflux)
+    for x, time_in, time_out in zip(vials[on].tolist(), influx[on].tolist(),
+                                    efflux[on].tolist()):
+        message[x] = str(time_in)
+        message[x + EFFLUX_OFFSET] = str(time_out)
+    return message
+
+
+class TurbidostatStep:
+    """
+    Decisions of one turbidostat step, (vials,) arrays like the inputs:
+    average_od (NaN where unknown, see window_median),
+    end_curve/start_curve (vials whose growth curve ended or started, i.e.
+    whose ODset changed to the lower/upper threshold), odset (after the
+    changes), influx and efflux (seconds, 0 for no dilution).
+    """
+
+    def __init__(self, average_od, end_curve, start_curve, odset, influx,
+                 efflux):
+        self.average_od = average_od
+        self.end_curve = end_curve
+        self.start_curve = start_curve
+        self.odset = odset
+        self.influx = influx
+        self.efflux = efflux
+
+
+def turbidostat(inputs, lower, upper, volume, stop_after_n_curves=np.inf,
+                time_out=5, pump_wait=3, max_time_in=20, held=None,
+                min_valid=None):
+    """
+    Turbidostat over all vials at once: once the median OD of a vial
+    exceeds the upper threshold its ODset drops to the lower one and it is
+    diluted down to it, at most every pump_wait minutes; the ODset goes
+    back to the upper threshold when the OD is within a third of the
+    thresholds' range above the lower one. Vials flagged in held (e.g.
+    from Scheduler.held()) are not diluted, nor are vials with fewer than
+    min_valid valid ODs in their window (see window_median).
+    """
+    # median to avoid outliers
+    average_od, known = window_median(inputs.od_history, min_valid)
+    odset = inputs.odset.copy()
+    collecting_more_curves = inputs.curves <= (stop_after_n_curves + 2)
+
+    end_curve = (average_od > upper) & (odset != lower)
+    odset[end_curve] = lower[end_curve]
+    start_curve = ((average_od < (lower + (upper - lower) / 3)) &
+                   (odset != upper))
+    odset[start_curve] = upper[start_curve]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        time_in = -(np.log(lower / average_od) * volume) / inputs.flow_rate
+    time_in = np.round(np.minimum(time_in, max_time_in), 2)
+    waited = ((inputs.elapsed_time - inputs.last_pump) * 60) >= pump_wait
+    dilute = known & (average_od > odset) & collecting_more_curves & waited
+    if held is not None:
+        dilute &= ~held
+    influx = np.where(dilute, time_in, 0.0)
+    efflux = np.where(dilute, time_in + time_out, 0.0)
+    return TurbidostatStep(average_od, end_curve, start_curve, odset, influx,
+                           efflux)
+
+
+def _frozen(value):
+    # hashable, comparable form of a setting for the configuration cache
+    if isinstance(value, np.ndarray):
+        return value.tobytes()
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class ChemostatStep:
+    """
+    Decisions of one chemostat step, (vials,) arrays like the inputs:
+    active (start time and start OD passed), bolus_in_s and period of the
+    recurring pump program (0 for inactive vials, NaN for vials without
+    enough valid ODs to decide on, whose program is left as it is) and
+    changed (active vials whose period differs from the one in
+    chemo_config).
+    """
+
+    def __init__(self, active, bolus_in_s, period, changed):
+        self.active = active
+        self.bolus_in_s = bolus_in_s
+        self.period = period
+        self.changed = changed
+
+
+class Chemostat:
+    """
+    Chemostat over all vials at once. configure() compiles the per-vial
+    settings into arrays, which only happens again when they change, and
+    step() evaluates the start conditions and periods of all vials in one
+    go.
+    """
+
+    def __init__(self):
+        self._key = None
+        self.bolus = None
+        self.start_time = None
+        self.start_od = None
+        self.period = None
+
+    def configure(self, inputs, rate, start_time, start_od, bolus, volume):
+        """
+        rate (1/hr), start_time (hours) and start_od are scalars or lists
+        indexed by vial number, overridden by the rate, startTime and
+        startOD of the GUI's vial configuration; bolus is in ml.
+        """
+        key = (id(inputs.experiment_params), inputs.vials.tobytes(),
+               _frozen(rate), _frozen(start_time), _frozen(start_od), bolus,
+               volume)
+        if key == self._key:
+            return
+        rate = inputs.config('rate', rate)
+        self.start_time = inputs.config('startTime', start_time)
+        self.start_od = inputs.config('startOD', start_od)
+        self.bolus = bolus
+        # scale dilution rate by bolus size and volume; no dilutions for a
+        # rate of 0
+        with np.errstate(divide='ignore'):
+            self.period = np.where(rate > 0, (3600 * bolus) / (rate * volume),
+                                   0.0)
+        self._key = key
+
+    def step(self, inputs, min_valid=None):
+        """
+        Vials with fewer than min_valid valid ODs in their window (see
+        window_median) are neither started nor stopped.
+        """
+        known = np.ones(len(inputs.vials), dtype=bool)
+        if inputs.ready:
+            average_od, known = window_median(inputs.od_history, min_valid)
+            active = (known & (inputs.elapsed_time > self.start_time) &
+                      (average_od > self.start_od))
+        else:
+            active = np.zeros(len(inputs.vials), dtype=bool)
+        with np.errstate(divide='ignore'):
+            bolus_in_s = np.where(active, self.bolus / inputs.flow_rate, 0.0)
+        period = np.where(active, self.period, 0.0)
+        bolus_in_s[~known] = np.nan
+        period[~known] = np.nan
+        changed = active & (inputs.chemo_rate != period)
+        return ChemostatStep(active, bolus_in_s, period, changed)
+
+
+class ChemostatProgram:
+    """
+    The recurring pump program of a chemostat as sent to the eVOLVER,
+    'bolus|period' for the influx and efflux pump of each vial ('0|0'
+    stops them, vials with a NaN period are left unchanged). The encoded
+    message is cached and only rebuilt when the bolus times or periods
+    change.
+    """
+
+    def __init__(self):
+        self._key = None
+        self.value = None
+
+    def encode(self, vials, bolus_in_s, period):
+        """
+        vials, bolus_in_s and period are (vials,) arrays.
+        """
+        vials = np.asarray(vials, dtype=int)
+        bolus_in_s = np.asarray(bolus_in_s, dtype=np.float64)
+        period = np.asarray(period, dtype=np.float64)
+        key = (vials.tobytes(), bolus_in_s.tobytes(), period.tobytes())
+        if key == self._key:
+            return self.value
+        value = [UNCHANGED] * PUMP_SLOTS
+        for x, bolus, rate in zip(vials.tolist(), bolus_in_s.tolist(),
+                                  period.tolist()):
+            if rate != rate:
+                # NaN, no decision for this vial
+                continue
+            if rate == 0:
+                value[x] = '0|0'
+                value[x + EFFLUX_OFFSET] = '0|0'
+            else:
+                value[x] = '%.2f|%d' % (bolus, rate)
+                value[x + EFFLUX_OFFSET] = '%.2f|%d' % (bolus * 2, rate)
+        self._key = key
+        self.value = value
+        return value
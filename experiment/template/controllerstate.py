@@ -0,0 +1,204 @@
+import os
+import logging
+
+import numpy as np
+
+from datafiles import vial_file_path, tail_rows, format_row, read_complete_rows
+
+logger = logging.getLogger('eVOLVER')
+
+# per-vial arrays making up the controller state
+STATE = ['odset', 'odset_time', 'odset_lines', 'last_pump', 'chemo_time',
+         'chemo_phase', 'chemo_rate']
+# files the state is journaled to
+JOURNALS = ['ODset', 'pump_log', 'chemo_config']
+
+
+def count_lines(path, BUFFER_SIZE=65536):
+    count = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+            count += block.count(b'\n')
+    return count
+
+
+class ControllerState:
+    """
+    In-memory state of the turbidostat and chemostat controllers for every
+    vial. The ODset, pump_log and chemo_config files act as append-only
+    journals: every transition is appended to them through the data writer
+    and load() rebuilds the state from their tails, so control decisions
+    never have to read a file.
+
+    Rows appended to the journals by others (custom scripts writing to
+    ODset directly, as the old template did) are applied by refresh(),
+    which only stats the files unless they grew by more than what the state
+    wrote itself.
+    """
+
+    def __init__(self, exp_dir, vials, writer):
+        self.exp_dir = exp_dir
+        self.vials = vials
+        self.writer = writer
+        # ODset: current setpoint, when it was set and number of lines in
+        # the file (header included), which is what counts the curves
+        self.odset = np.zeros(vials)
+        self.odset_time = np.zeros(vials)
+        self.odset_lines = np.zeros(vials, dtype=int)
+        # pump_log: time of the last dilution
+        self.last_pump = np.zeros(vials)
+        # chemo_config: last time, phase and period written
+        self.chemo_time = np.zeros(vials)
+        self.chemo_phase = np.zeros(vials)
+        self.chemo_rate = np.zeros(vials)
+        # {(vial, journal): bytes of the file the state accounts for}, and
+        # the bytes and lines queued through the writer since
+        self._sizes = {}
+        self._written = {}
+
+    def _path(self, vial, parameter):
+        return vial_file_path(self.exp_dir, vial, parameter)
+
+    def _load(self, vial, parameter):
+        path = self._path(vial, parameter)
+        size = os.path.getsize(path)
+        row = tail_rows(path, 1)
+        if parameter == 'ODset':
+            if len(row):
+                self.odset_time[vial], self.odset[vial] = row[-1][:2]
+            self.odset_lines[vial] = count_lines(path)
+        elif parameter == 'pump_log':
+            if len(row):
+                self.last_pump[vial] = row[-1][0]
+        elif parameter == 'chemo_config':
+            if len(row):
+                (self.chemo_time[vial], self.chemo_phase[vial],
+                 self.chemo_rate[vial]) = row[-1][:3]
+        self._sizes[(vial, parameter)] = size
+        self._written.pop((vial, parameter), None)
+
+    def load(self):
+        for x in range(self.vials):
+            for parameter in JOURNALS:
+                self._load(x, parameter)
+        logger.debug('loaded controller state, ODset: %s', self.odset)
+
+    def refresh(self):
+        """
+        Applies the rows appended to the journals by others since they were
+        last read. Call it when the rows the state queued have been
+        committed, e.g. between broadcasts. Returns the vials with new
+        ODset rows.
+        """
+        new_odset = []
+        for x in range(self.vials):
+            for parameter in JOURNALS:
+                key = (x, parameter)
+                if key not in self._sizes:
+                    # not loaded yet
+                    continue
+                path = self._path(x, parameter)
+                written, written_lines = self._written.get(key, (0, 0))
+                try:
+                    size = os.path.getsize(path)
+                    if size == self._sizes[key] + written:
+                        # only our own rows
+                        self._sizes[key] = size
+                        self._written.pop(key, None)
+                        continue
+                    if size < self._sizes[key] + written:
+                        # our own rows are gone, i.e. rewritten
+                        logger.warning('%s was rewritten, reloading it', path)
+                        self._load(x, parameter)
+                        if parameter == 'ODset':
+                            new_odset.append(x)
+                        continue
+                    rows, lines, self._sizes[key] = read_complete_rows(
+                        path, self._sizes[key])
+                except OSError as e:
+                    logger.error('could not read %s: %s', path, e)
+                    continue
+                self._written.pop(key, None)
+                if lines > written_lines:
+                    logger.debug('%d rows appended to %s', lines -
+                                 written_lines, path)
+                    if parameter == 'ODset':
+                        new_odset.append(x)
+                # the last row is the current state, whoever wrote it
+                self.catch_up(x, parameter, rows, lines - written_lines)
+        return new_odset
+
+    def catch_up(self, vial, parameter, rows, lines):
+        """
+        Applies rows appended to a journal file, 'lines' of which are not
+        counted in the state yet.
+        """
+        if parameter == 'ODset':
+            self.odset_lines[vial] += lines
+            if len(rows):
+                self.odset_time[vial], self.odset[vial] = rows[-1][:2]
+        elif parameter == 'pump_log':
+            if len(rows):
+                self.last_pump[vial] = rows[-1][0]
+        elif parameter == 'chemo_config':
+            if len(rows):
+                (self.chemo_time[vial], self.chemo_phase[vial],
+                 self.chemo_rate[vial]) = rows[-1][:3]
+
+    def snapshot(self):
+        return dict((name, getattr(self, name).copy()) for name in STATE)
+
+    def restore(self, snapshot, file_sizes):
+        """
+        Restores a snapshot taken when the journals had the given sizes
+        ({journal: [bytes per vial]}); refresh() then applies the rows
+        appended after it.
+        """
+        for name in STATE:
+            setattr(self, name, snapshot[name].copy())
+        self._written = {}
+        self._sizes = dict(((x, parameter), file_sizes[parameter][x])
+                           for parameter in JOURNALS
+                           for x in range(self.vials))
+
+    def num_curves(self, vial):
+        return self.odset_lines[vial] / 2
+
+    def _append(self, vial, parameter, values):
+        line = format_row(values)
+        self.writer.append(self._path(vial, parameter), line)
+        written, lines = self._written.get((vial, parameter), (0, 0))
+        self._written[(vial, parameter)] = (written + len(line.encode()),
+                                            lines + 1)
+
+    def set_odset(self, vial, elapsed_time, value):
+        self._append(vial, 'ODset', [elapsed_time, value])
+        self.odset[vial] = value
+        self.odset_time[vial] = elapsed_time
+        self.odset_lines[vial] += 1
+
+    def log_pump(self, vial, elapsed_time, time_in):
+        self._append(vial, 'pump_log', [elapsed_time, time_in])
+        self.last_pump[vial] = elapsed_time
+
+    def set_odsets(self, vials, elapsed_time, values):
+        """
+        set_odset() for an array of vials at once.
+        """
+        for vial, value in zip(np.asarray(vials).tolist(),
+                               np.asarray(values).tolist()):
+            self.set_odset(vial, elapsed_time, value)
+
+    def log_pumps(self, vials, elapsed_time, times_in):
+        """
+        log_pump() for an array of vials at once.
+        """
+        for vial, time_in in zip(np.asarray(vials).tolist(),
+                                 np.asarray(times_in).tolist()):
+            self.log_pump(vial, elapsed_time, time_in)
+
+    def set_chemo(self, vial, elapsed_time, phase, rate):
+        self._append(vial, 'chemo_config', [elapsed_time, phase, rate])
+        self.chemo_time[vial] = elapsed_time
+        self.chemo_phase[vial] = phase
+        self.chemo_rate[vial] = rate
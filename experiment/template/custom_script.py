@@ -2,8 +2,8 @@
 
 import numpy as np
 import logging
-import os.path
-import time
+
+import controllers
 
 # logger setup
 logger = logging.getLogger(__name__)
@@ -48,10 +48,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
 
     lower_thresh = [0.2] * len(vials) #to set all vials to the same value, creates 16-value list
     upper_thresh = [0.4] * len(vials) #to set all vials to the same value, creates 16-value list
-
-    if eVOLVER.experiment_params is not None:
-        lower_thresh = list(map(lambda x: x['lower'], eVOLVER.experiment_params['vial_configuration']))
-        upper_thresh = list(map(lambda x: x['upper'], eVOLVER.experiment_params['vial_configuration']))
+    # thresholds set in the GUI take precedence, see inputs.config() below
 
     #Alternatively, use 16 value list to set different thresholds, use 9999 for vials not being used
     #lower_thresh = [0.2, 0.2, 0.3, 0.3, 9999, 9999, 9999, 9999, 9999, 9999, 9999, 9999, 9999, 9999, 9999, 9999]
@@ -69,92 +66,59 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
 
     ##### End of Turbidostat Settings #####
 
-    flow_rate = eVOLVER.get_flow_rate() #read from calibration file
-
     ##### Turbidostat Control Code Below #####
 
-    # fluidic message: initialized so that no change is sent
-    MESSAGE = ['--'] * 48
-    for x in turbidostat_vials: #main loop through each vial
-
-        # Update turbidostat configuration files for each vial
-        # initialize OD and find OD path
-
-        file_name =  "vial{0}_ODset.txt".format(x)
-        ODset_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'ODset', file_name)
-        data = np.genfromtxt(ODset_path, delimiter=',')
-        ODset = data[len(data)-1][1]
-        ODsettime = data[len(data)-1][0]
-        num_curves=len(data)/2;
-
-        file_name =  "vial{0}_OD.txt".format(x)
-        OD_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'OD', file_name)
-        data = eVOLVER.tail_to_np(OD_path, OD_values_to_average)
-        average_OD = 0
-
-        # Determine whether turbidostat dilutions are needed
-        #enough_ODdata = (len(data) > 7) #logical, checks to see if enough data points (couple minutes) for sliding window
-        collecting_more_curves = (num_curves <= (stop_after_n_curves + 2)) #logical, checks to see if enough growth curves have happened
-
-        if data.size != 0:
-            # Take median to avoid outlier
-            od_values_from_file = data[:,1]
-            average_OD = float(np.median(od_values_from_file))
-
-            #if recently exceeded upper threshold, note end of growth curve in ODset, allow dilutions to occur and growthrate to be measured
-            if (average_OD > upper_thresh[x]) and (ODset != lower_thresh[x]):
-                text_file = open(ODset_path, "a+")
-                text_file.write("{0},{1}\n".format(elapsed_time,
-                                                   lower_thresh[x]))
-                text_file.close()
-                ODset = lower_thresh[x]
-                # calculate growth rate
-                eVOLVER.calc_growth_rate(x, ODsettime, elapsed_time)
-
-            #if have approx. reached lower threshold, note start of growth curve in ODset
-            if (average_OD < (lower_thresh[x] + (upper_thresh[x] - lower_thresh[x]) / 3)) and (ODset != upper_thresh[x]):
-                text_file = open(ODset_path, "a+")
-                text_file.write("{0},{1}\n".format(elapsed_time, upper_thresh[x]))
-                text_file.close()
-                ODset = upper_thresh[x]
-
-            #if need to dilute to lower threshold, then calculate amount of time to pump
-            if average_OD > ODset and collecting_more_curves:
-
-                time_in = - (np.log(lower_thresh[x]/average_OD)*VOLUME)/flow_rate[x]
-
-                if time_in > 20:
-                    time_in = 20
-
-                time_in = round(time_in, 2)
-
-                file_name =  "vial{0}_pump_log.txt".format(x)
-                file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME,
-                                         'pump_log', file_name)
-                data = np.genfromtxt(file_path, delimiter=',')
-                last_pump = data[len(data)-1][0]
-                if ((elapsed_time - last_pump)*60) >= pump_wait: # if sufficient time since last pump, send command to Arduino
-                    logger.info('turbidostat dilution for vial %d' % x)
-                    # influx pump
-                    MESSAGE[x] = str(time_in)
-                    # efflux pump
-                    MESSAGE[x + 16] = str(time_in + time_out)
-
-                    file_name =  "vial{0}_pump_log.txt".format(x)
-                    file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'pump_log', file_name)
-
-                    text_file = open(file_path, "a+")
-                    text_file.write("{0},{1}\n".format(elapsed_time, time_in))
-                    text_file.close()
-        else:
-            logger.debug('not enough OD measurements for vial %d' % x)
-
-    # send fluidic command only if we are actually turning on any of the pumps
-    if MESSAGE != ['--'] * 48:
-        eVOLVER.fluid_command(MESSAGE)
-
-        # your_FB_function_here() #good spot to call feedback functions for dynamic temperature, stirring, etc for ind. vials
+    # (vials,) arrays of the last OD values, flow rates (read from the
+    # calibration file), ODset and pump times of the turbidostat vials,
+    # kept in memory by eVOLVER.py
+    inputs = eVOLVER.controller_inputs(turbidostat_vials, elapsed_time,
+                                       OD_values_to_average)
+    if not inputs.ready:
+        logger.debug('not enough OD measurements for turbidostat')
+        return
+    lower = inputs.config('lower', lower_thresh)
+    upper = inputs.config('upper', upper_thresh)
+
+    # all vials at once: ODset changes at the end and start of growth
+    # curves, and dilution times down to the lower threshold for the vials
+    # above their ODset
+    # vials whose pumping was put on hold with eVOLVER.scheduler.hold()
+    # are not diluted
+    held = eVOLVER.scheduler.held('pump', elapsed_time, inputs.vials)
+    step = controllers.turbidostat(inputs, lower, upper, VOLUME,
+                                   stop_after_n_curves, time_out, pump_wait,
+                                   held=held)
+
+    # ODset, pump_log etc. are journaled by eVOLVER.controller_state
+    state = eVOLVER.controller_state
+    ended = inputs.vials[step.end_curve]
+    if len(ended):
+        # recently exceeded upper threshold: note end of growth curve in
+        # ODset, allow dilutions to occur and measure the growth rate
+        state.set_odsets(ended, elapsed_time, lower[step.end_curve])
+        for x, ODsettime in zip(ended.tolist(),
+                                inputs.odset_time[step.end_curve].tolist()):
+            eVOLVER.calc_growth_rate(x, ODsettime, elapsed_time)
+    started = inputs.vials[step.start_curve]
+    if len(started):
+        # approx. reached lower threshold: note start of growth curve
+        state.set_odsets(started, elapsed_time, upper[step.start_curve])
+        for x in started.tolist():
+            # start tracking the growth rate of the new curve
+            eVOLVER.growth_rate.reset(x, elapsed_time)
+
+    # one fluidic command for all the dilutions, pumps are only turned on
+    # for vials with a dilution
+    eVOLVER.pump_vials(inputs.vials, elapsed_time, step.influx, step.efflux)
+
+    # your_FB_function_here() #good spot to call feedback functions for dynamic temperature, stirring, etc for ind. vials
     # your_function_here() #good spot to call non-feedback functions for dynamic temperature, stirring, etc.
+    # timed changes are better scheduled once than checked every broadcast,
+    # e.g. ramp vials 0-3 from 30 to 37 degrees C between hours 2 and 4
+    # (with from scheduler import ramp at the top of the script):
+    # eVOLVER.schedule_program('temp', [0, 1, 2, 3], ramp(2, 4, 30, 37, 0.25))
+    # or stop diluting vial 5 for the next hour:
+    # eVOLVER.scheduler.hold(5, 'pump', elapsed_time + 1)
 
     # end of turbidostat() fxn
 
@@ -167,6 +131,7 @@ def chemostat(eVOLVER, input_data, vials, elapsed_time):
     # Note that script uses AND logic, so both start time and start OD must be surpassed
 
     OD_values_to_average = 6  # Number of values to calculate the OD average
+    # eVOLVER.growth_rate.rolling holds the current growth rate of every vial (1/hr)
 
     chemostat_vials = vials #vials is all 16, can set to different range (ex. [0,1,2,3]) to only trigger tstat on those vials
 
@@ -178,12 +143,8 @@ def chemostat(eVOLVER, input_data, vials, elapsed_time):
     #rate_config = [0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9,1.0,1.1,1.2,1.3,1.4,1.5,1.6]
 
     ##### END OF USER DEFINED VARIABLES #####
-
-    if eVOLVER.experiment_params is not None:
-        rate_config = list(map(lambda x: x['rate'], eVOLVER.experiment_params['vial_configuration']))
-        stir = list(map(lambda x: x['stir'], eVOLVER.experiment_params['vial_configuration']))
-        start_time= list(map(lambda x: x['startTime'], eVOLVER.experiment_params['vial_configuration']))
-        start_OD= list(map(lambda x: x['startOD'], eVOLVER.experiment_params['vial_configuration']))
+    # rates, start times and ODs set in the GUI take precedence, see
+    # chemostat.configure() below
 
     ##### Chemostat Settings #####
 
@@ -192,68 +153,40 @@ def chemostat(eVOLVER, input_data, vials, elapsed_time):
 
     ##### End of Chemostat Settings #####
 
-    flow_rate = eVOLVER.get_flow_rate() #read from calibration file
-    period_config = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0] #initialize array
-    bolus_in_s = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0] #initialize array
-
-
     ##### Chemostat Control Code Below #####
 
-    for x in chemostat_vials: #main loop through each vial
-
-        # Update chemostat configuration files for each vial
-
-        #initialize OD and find OD path
-        file_name =  "vial{0}_OD.txt".format(x)
-        OD_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'OD', file_name)
-        data = eVOLVER.tail_to_np(OD_path, OD_values_to_average)
-        average_OD = 0
-        #enough_ODdata = (len(data) > 7) #logical, checks to see if enough data points (couple minutes) for sliding window
-
-        if data.size != 0: #waits for seven OD measurements (couple minutes) for sliding window
-
-            #calculate median OD
-            od_values_from_file = data[:,1]
-            average_OD = float(np.median(od_values_from_file))
-
-            # set chemostat config path and pull current state from file
-            file_name =  "vial{0}_chemo_config.txt".format(x)
-            chemoconfig_path = os.path.join(eVOLVER.exp_dir, EXP_NAME,
-                                            'chemo_config', file_name)
-            chemo_config = np.genfromtxt(chemoconfig_path, delimiter=',')
-            last_chemoset = chemo_config[len(chemo_config)-1][0] #should t=0 initially, changes each time a new command is written to file
-            last_chemophase = chemo_config[len(chemo_config)-1][1] #should be zero initially, changes each time a new command is written to file
-            last_chemorate = chemo_config[len(chemo_config)-1][2] #should be 0 initially, then period in seconds after new commands are sent
-
-            # once start time has passed and culture hits start OD, if no command has been written, write new chemostat command to file
-            if ((elapsed_time > start_time[x]) and (average_OD > start_OD[x])):
-
-                #calculate time needed to pump bolus for each pump
-                bolus_in_s[x] = bolus/flow_rate[x]
-
-                # calculate the period (i.e. frequency of dilution events) based on user specified growth rate and bolus size
-                if rate_config[x] > 0:
-                    period_config[x] = (3600*bolus)/((rate_config[x])*VOLUME) #scale dilution rate by bolus size and volume
-                else: # if no dilutions needed, then just loops with no dilutions
-                    period_config[x] = 0
-
-                if  (last_chemorate != period_config[x]):
-                    print('Chemostat updated in vial {0}'.format(x))
-                    logger.info('chemostat initiated for vial %d, period %.2f'
-                                % (x, period_config[x]))
-                    # writes command to chemo_config file, for storage
-                    text_file = open(chemoconfig_path, "a+")
-                    text_file.write("{0},{1},{2}\n".format(elapsed_time,
-                                                           (last_chemophase+1),
-                                                           period_config[x])) #note that this changes chemophase
-                    text_file.close()
-        else:
-            logger.debug('not enough OD measurements for vial %d' % x)
-
-        # your_FB_function_here() #good spot to call feedback functions for dynamic temperature, stirring, etc for ind. vials
+    # (vials,) arrays of the last OD values, flow rates (read from the
+    # calibration file) and chemostat phase and period of the chemostat
+    # vials, kept in memory by eVOLVER.py
+    inputs = eVOLVER.controller_inputs(chemostat_vials, elapsed_time,
+                                       OD_values_to_average)
+    if not inputs.ready:
+        logger.debug('not enough OD measurements for chemostat')
+
+    # settings are compiled into arrays once, and again only if they change
+    chemostat = eVOLVER.chemostat
+    chemostat.configure(inputs, rate_config, start_time, start_OD, bolus,
+                        VOLUME)
+    # all vials at once: once start time has passed and culture hits start
+    # OD, time needed to pump the bolus and period (i.e. frequency of
+    # dilution events) based on user specified growth rate and bolus size
+    step = chemostat.step(inputs)
+
+    state = eVOLVER.controller_state
+    for x, phase, period in zip(inputs.vials[step.changed].tolist(),
+                                inputs.chemo_phase[step.changed].tolist(),
+                                step.period[step.changed].tolist()):
+        print('Chemostat updated in vial {0}'.format(x))
+        logger.info('chemostat initiated for vial %d, period %.2f', x, period)
+        # writes command to chemo_config file, for storage
+        state.set_chemo(x, elapsed_time, phase + 1, period) #note that this changes chemophase
+
+    # your_FB_function_here() #good spot to call feedback functions for dynamic temperature, stirring, etc for ind. vials
     # your_function_here() #good spot to call non-feedback functions for dynamic temperature, stirring, etc.
 
-    eVOLVER.update_chemo(input_data, chemostat_vials, bolus_in_s, period_config) #compares computed chemostat config to the remote one
+    # compares the chemostat program to the remote one, only re-encoded
+    # when it changed
+    eVOLVER.set_chemostat(inputs.vials, step.bolus_in_s, step.period)
     # end of chemostat() fxn
 
 # def your_function_here(): # good spot to define modular functions for dynamics or feedback
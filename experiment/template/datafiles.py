@@ -0,0 +1,278 @@
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def vial_file_path(exp_dir, vial, parameter, directory=None):
+    """
+    Path of the per-vial text file for a parameter,
+    e.g. <exp_dir>/OD/vial0_OD.txt
+    """
+    if directory is None:
+        directory = parameter
+    file_name = "vial{0}_{1}.txt".format(vial, parameter)
+    return os.path.join(exp_dir, directory, file_name)
+
+
+def tail_to_np(path, window=10, BUFFER_SIZE=512):
+    """
+    Reads file from the end and returns a numpy array with the data of the last 'window' lines.
+    Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
+    """
+    if window == 0:
+        return []
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        remaining_bytes = f.tell()
+        size = window + 1  # Read one more line to avoid broken lines
+        block = -1
+        data = []
+
+        while size > 0 and remaining_bytes > 0:
+            if remaining_bytes - BUFFER_SIZE > 0:
+                # Seek back one whole BUFFER_SIZE
+                f.seek(block * BUFFER_SIZE, os.SEEK_END)
+                # read BUFFER
+                bunch = f.read(BUFFER_SIZE)
+            else:
+                # file too small, start from beginning
+                f.seek(0, 0)
+                # only read what was not read
+                bunch = f.read(remaining_bytes)
+
+            bunch = bunch.decode('utf-8')
+            data.append(bunch)
+            size -= bunch.count('\n')
+            remaining_bytes -= BUFFER_SIZE
+            block -= 1
+
+    data = ''.join(reversed(data)).splitlines()[-window:]
+
+    if len(data) < window:
+        # Not enough data
+        return np.asarray([])
+
+    for c, v in enumerate(data):
+        data[c] = v.split(',')
+
+    try:
+        data = np.asarray(data, dtype=np.float64)
+        return data
+    except ValueError:
+        # It is reading the header
+        return np.asarray([])
+
+
+def last_row(path):
+    """
+    Last data row of a file as a float array, or None if the file only
+    holds a header (or nothing at all).
+    """
+    data = tail_to_np(path, 1)
+    if len(data) == 0:
+        return None
+    return data[0]
+
+
+# durability policies of DataWriter: when appended rows are fsync'ed to disk
+SYNC_BROADCAST = 'broadcast'
+SYNC_INTERVAL = 'interval'
+SYNC_SHUTDOWN = 'shutdown'
+SYNC_POLICIES = [SYNC_BROADCAST, SYNC_INTERVAL, SYNC_SHUTDOWN]
+
+
+def open_file_budget(writers=1, share=0.5, most=256):
+    """
+    Open handles each of 'writers' DataWriters can keep: their part of
+    'share' of the process' soft limit on open files (the rest is left for
+    sockets, logs etc.), at most 'most'.
+    """
+    try:
+        import resource
+    except ImportError:
+        # Windows, whose C runtime allows 512
+        limit = 512
+    else:
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if limit == resource.RLIM_INFINITY:
+            return most
+    return max(16, min(most, int(limit * share) // max(writers, 1)))
+
+
+def format_row(values):
+    """
+    Newline terminated, comma separated line of a per-vial file.
+    """
+    return ','.join('{0}'.format(v) for v in values) + '\n'
+
+
+class DataWriter:
+    """
+    Appends rows to the per-vial text files through a bounded pool of open
+    file handles instead of opening and closing every file for each row.
+
+    Rows are queued with append() and written out together by commit(),
+    which is called once per broadcast (group commit). After a commit the
+    rows are visible to any reader of the files; the durability policy only
+    decides when they are fsync'ed:
+
+    - 'broadcast': on every commit
+    - 'interval': at most every sync_interval seconds
+    - 'shutdown': when the file is closed (as plain open/close did before)
+
+    max_open_files defaults to what the open file limit allows, see
+    open_file_budget(); pass the budget explicitly when several writers
+    share the process (e.g. one per eVOLVER unit).
+    """
+
+    def __init__(self, policy=SYNC_SHUTDOWN, sync_interval=60,
+                 max_open_files=None):
+        if policy not in SYNC_POLICIES:
+            raise ValueError('unknown durability policy %s' % policy)
+        self.policy = policy
+        self.sync_interval = sync_interval
+        if max_open_files is None:
+            max_open_files = open_file_budget()
+        self.max_open_files = max_open_files
+        self._pending = OrderedDict()
+        self._files = OrderedDict()
+        self._unsynced = set()
+        self._last_sync = time.monotonic()
+
+    def append(self, path, line):
+        self._pending.setdefault(path, []).append(line)
+
+    def append_row(self, path, values):
+        self.append(path, format_row(values))
+
+    def _open(self, path):
+        f = self._files.get(path)
+        if f is not None:
+            self._files.move_to_end(path)
+            return f
+        while len(self._files) >= self.max_open_files:
+            old_path, old_file = self._files.popitem(last=False)
+            self._close(old_path, old_file)
+        f = open(path, 'a')
+        self._files[path] = f
+        return f
+
+    def _close(self, path, f):
+        if path in self._unsynced:
+            f.flush()
+            os.fsync(f.fileno())
+            self._unsynced.discard(path)
+        f.close()
+
+    def commit(self):
+        """
+        Writes all queued rows, one write per file.
+        """
+        if self._pending:
+            pending, self._pending = self._pending, OrderedDict()
+            for path, lines in pending.items():
+                f = self._open(path)
+                f.write(''.join(lines))
+                f.flush()
+                self._unsynced.add(path)
+
+        if self.policy == SYNC_BROADCAST:
+            self.sync()
+        elif (self.policy == SYNC_INTERVAL and
+              time.monotonic() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        for path in list(self._unsynced):
+            f = self._files.get(path)
+            if f is not None:
+                os.fsync(f.fileno())
+        self._unsynced.clear()
+        self._last_sync = time.monotonic()
+
+    def release(self, path):
+        """
+        Closes the handle of a file, e.g. before it is recreated.
+        """
+        self._pending.pop(path, None)
+        f = self._files.pop(path, None)
+        if f is not None:
+            self._close(path, f)
+
+    def close(self):
+        self.commit()
+        while self._files:
+            path, f = self._files.popitem(last=False)
+            self._close(path, f)
+
+
+def tail_rows(path, rows, BUFFER_SIZE=4096):
+    """
+    Up to the last 'rows' numeric rows of a file as a (n x columns) array.
+    Unlike tail_to_np, header lines are skipped and shorter files return
+    whatever rows they have.
+    """
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        chunks = []
+        newlines = 0
+        while position > 0 and newlines <= rows:
+            step = min(BUFFER_SIZE, position)
+            position -= step
+            f.seek(position)
+            chunk = f.read(step)
+            chunks.append(chunk)
+            newlines += chunk.count(b'\n')
+
+    lines = b''.join(reversed(chunks)).decode('utf-8').splitlines()
+    if position > 0:
+        # the first line is probably cut
+        lines = lines[1:]
+    return _parse_rows(lines[-rows:])
+
+
+def read_appended(path, offset):
+    """
+    Rows appended to a file after byte 'offset', e.g. since a checkpoint.
+    Returns the (n x columns) array of numeric rows and the number of
+    lines appended. Raises ValueError if the file is now shorter.
+    """
+    data = _read_from(path, offset)
+    return _parse_rows(data.decode('utf-8').splitlines()), data.count(b'\n')
+
+
+def read_complete_rows(path, offset):
+    """
+    Like read_appended, for files other processes may be writing to right
+    now: a last line without its newline yet is left for the next call.
+    Returns the rows, the number of complete lines read and the offset to
+    continue from.
+    """
+    data = _read_from(path, offset)
+    end = data.rfind(b'\n') + 1
+    return (_parse_rows(data[:end].decode('utf-8').splitlines()),
+            data.count(b'\n'), offset + end)
+
+
+def _read_from(path, offset):
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size < offset:
+            raise ValueError('%s shrank below %d bytes' % (path, offset))
+        f.seek(offset)
+        return f.read()
+
+
+def _parse_rows(lines):
+    data = []
+    for line in lines:
+        try:
+            data.append([float(x) for x in line.split(',')])
+        except ValueError:
+            continue
+    if not data:
+        return np.empty((0, 2))
+    return np.asarray(data, dtype=np.float64)
@@ -7,16 +7,37 @@ import pickle
 import shutil
 import logging
 import argparse
+import functools
 import numpy as np
 import json
-import traceback
-from scipy import stats
-from socketIO_client import SocketIO, BaseNamespace
-from nbstreamreader import NonBlockingStreamReader as NBSR
+from socketIO_client import BaseNamespace
+from runtime import EvolverSocketIO, ExperimentRuntime, RUNNING
+from worker import BroadcastWorker
+from calibrations import CalibrationEngine, CalibrationStore, to_float_array
+from calibrations import transform_batch
+from calibrations import THREE_DIMENSION
+from datafiles import tail_to_np, tail_rows, read_appended, vial_file_path
+from datafiles import DataWriter, SYNC_POLICIES, SYNC_SHUTDOWN
+from datafiles import open_file_budget
+from setpoints import SetpointState
+from columnstore import ColumnStore
+from ringbuffer import VialRingBuffer
+from growthrate import GrowthRateEstimator
+from controllerstate import ControllerState
+from controllerstate import JOURNALS as CONTROLLER_JOURNALS
+from controllers import ControllerInputs, pump_message, pumped
+from controllers import Chemostat, ChemostatProgram
+from checkpoint import Checkpointer, atomic_pickle
+from commands import CommandCoalescer, UNCHANGED
+from scheduler import Scheduler
+from sensorqc import SensorQC
+from scriptreload import ScriptReloader
+from metrics import Metrics, MetricsServer
+from logpipeline import LogPipeline, make_file_handler
 
 import custom_script
 from custom_script import EXP_NAME
-from custom_script import EVOLVER_PORT, OPERATION_MODE
+from custom_script import EVOLVER_PORT
 from custom_script import STIR_INITIAL, TEMP_INITIAL
 
 # Should not be changed
@@ -26,17 +47,24 @@ VIALS = [x for x in range(16)]
 
 SAVE_PATH = os.path.dirname(os.path.realpath(__file__))
 EXP_DIR = os.path.join(SAVE_PATH, EXP_NAME)
-OD_CAL_PATH = os.path.join(SAVE_PATH, 'od_cal.json')
-TEMP_CAL_PATH = os.path.join(SAVE_PATH, 'temp_cal.json')
-PUMP_CAL_PATH = os.path.join(SAVE_PATH, 'pump_cal.json')
+OD_CAL_FILE = 'od_cal.json'
+TEMP_CAL_FILE = 'temp_cal.json'
+PUMP_CAL_FILE = 'pump_cal.json'
+OD_CAL_PATH = os.path.join(SAVE_PATH, OD_CAL_FILE)
+TEMP_CAL_PATH = os.path.join(SAVE_PATH, TEMP_CAL_FILE)
+PUMP_CAL_PATH = os.path.join(SAVE_PATH, PUMP_CAL_FILE)
 JSON_PARAMS_FILE = os.path.join(SAVE_PATH, 'eVOLVER_parameters.json')
-
-SIGMOID = 'sigmoid'
-LINEAR = 'linear'
-THREE_DIMENSION = '3d'
+CUSTOM_SCRIPT_PATH = os.path.join(SAVE_PATH, 'custom_script.py')
+# operation modes and the custom script functions they run
+CUSTOM_FUNCTIONS = {'turbidostat': 'turbidostat',
+                    'chemostat': 'chemostat',
+                    'growthcurve': 'growth_curve'}
 
 logger = logging.getLogger('eVOLVER')
 
+# file handler pipeline set up by setup_logging()
+LOG_PIPELINE = None
+
 paused = False
 
 EVOLVER_NS = None
@@ -45,9 +73,77 @@ class EvolverNamespace(BaseNamespace):
     start_time = None
     use_blank = False
     OD_initial = None
+    # number of broadcasts processed and elapsed time of the last one
+    broadcast_seq = 0
+    last_elapsed_time = None
     experiment_params = None
     ip_address = None
     exp_dir = SAVE_PATH
+    # parameters kept in memory for recent(), and how many points per vial
+    buffered_params = ['OD', 'temp']
+    buffer_length = 128
+    # number of broadcasts in the rolling growth rate window
+    growth_rate_window = 60
+    # {stage: seconds} spent on the last broadcast
+    stage_times = {}
+    # keyword arguments for setup_logging(), filled in from the command line
+    log_settings = {}
+    # running version of the custom script, see use_script()
+    script = custom_script
+
+    def __init__(self, io, path, unit=None):
+        # in multi-unit mode each unit keeps its calibrations and experiment
+        # data in a directory of its own
+        self.unit = unit
+        if unit is None:
+            self.save_path = SAVE_PATH
+        else:
+            self.save_path = os.path.join(SAVE_PATH, unit)
+            os.makedirs(self.save_path, exist_ok=True)
+        # custom scripts build their paths from eVOLVER.exp_dir
+        self.exp_dir = self.save_path
+        self.data_dir = os.path.join(self.save_path, EXP_NAME)
+        super().__init__(io, path)
+
+    def initialize(self):
+        self.calibrations = CalibrationStore({
+            'od': os.path.join(self.save_path, OD_CAL_FILE),
+            'temp': os.path.join(self.save_path, TEMP_CAL_FILE),
+            'pump': os.path.join(self.save_path, PUMP_CAL_FILE)})
+        self.temp_setpoints = SetpointState(self.data_dir, 'temp_config',
+                                            VIALS)
+        self.writer = DataWriter()
+        # optional binary copy of the data, see columnstore.py
+        self.column_store = None
+        (self.controller_state, self.growth_rate,
+         self.ring_buffers) = self.new_runtime_state()
+        # checks of the raw readings before calibration
+        self.qc = SensorQC(len(VIALS))
+        self.commands = CommandCoalescer(self.emit_command)
+        # compiled chemostat settings and encoded pump program, see
+        # controllers.py
+        self.chemostat = Chemostat()
+        self.chemo_program = ChemostatProgram()
+        # timed per-vial actions of the custom script
+        self.scheduler = Scheduler(len(VIALS), self.elapsed)
+        self._scheduler_queued = False
+        self._programs = set()
+        self.metrics = Metrics(None if self.unit is None else
+                               {'unit': self.unit})
+        self.checkpointer = Checkpointer(os.path.join(self.data_dir,
+                                                      EXP_NAME + '.checkpoint'))
+
+    def new_runtime_state(self):
+        """
+        Empty controller state, growth rate estimator and ring buffers.
+        """
+        controller_state = ControllerState(self.data_dir, len(VIALS),
+                                           self.writer)
+        growth_rate = GrowthRateEstimator(len(VIALS), self.growth_rate_window)
+        ring_buffers = dict((param, VialRingBuffer(len(VIALS),
+                                                   self.buffer_length))
+                            for param in self.buffered_params)
+        return controller_state, growth_rate, ring_buffers
 
     def on_connect(self, *args):
         print("Connected to eVOLVER as client")
@@ -61,38 +157,73 @@ class EvolverNamespace(BaseNamespace):
         print("Reconnected to eVOLVER as client")
         logger.info("reconnected to eVOLVER as client")
 
-    def on_broadcast(self, data):
-        logger.info('Broadcast received')
-        elapsed_time = round((time.time() - self.start_time) / 3600, 4)
-        logger.info('Elapsed time: %.4f hours' % elapsed_time)
-        print("{0}: {1} Hours".format(EXP_NAME, elapsed_time))
+    @property
+    def label(self):
+        if self.unit is None:
+            return EXP_NAME
+        return '{0} ({1})'.format(EXP_NAME, self.unit)
+
+    def on_broadcast(self, data, calibrated=None):
+        start = time.monotonic()
+        self.stage_times = {}
+        self.metrics.inc('broadcasts')
+        # commands sent while processing the broadcast go out together at
+        # the end, see CommandCoalescer
+        self.commands.begin(data.get('config'))
+        try:
+            self.process_broadcast(data, calibrated)
+        finally:
+            flush_start = time.monotonic()
+            self.commands.flush()
+            self._end_stage('commands', flush_start)
+            self.metrics.observe('broadcast', time.monotonic() - start)
+
+    def process_broadcast(self, data, calibrated=None):
+        if self.unit is None:
+            logger.info('Broadcast received')
+        else:
+            logger.info('Broadcast received from %s', self.unit)
+        elapsed_time = self.elapsed()
+        logger.info('Elapsed time: %.4f hours', elapsed_time)
+        print("{0}: {1} Hours".format(self.label, elapsed_time))
         # are the calibrations in yet?
         if not self.check_for_calibrations():
             logger.warning('Calibration files still missing, skipping custom '
                            'functions')
             return
 
-        with open(OD_CAL_PATH) as f:
-            od_cal = json.load(f)
-        with open(TEMP_CAL_PATH) as f:
-            temp_cal = json.load(f)
+        od_cal = self.calibrations.fit('od')
+        temp_cal = self.calibrations.fit('temp')
+        stage_start = time.monotonic()
 
         # apply calibrations
         # update temperatures if needed
-        data = self.transform_data(data, VIALS, od_cal, temp_cal)
+        data = self.transform_data(data, VIALS, calibrated=calibrated)
         if data is None:
             logger.error('could not tranform raw data, skipping user-'
                          'defined functions')
+            self.metrics.inc('rejected_broadcasts')
             return
 
         # should we "blank" the OD?
         if self.use_blank and self.OD_initial is None:
+            if not np.isfinite(data['transformed']['od']).all():
+                logger.error('no valid OD from vials %s to blank with, '
+                             'skipping broadcast', np.flatnonzero(
+                                 ~np.isfinite(data['transformed']['od'])))
+                self.metrics.inc('rejected_broadcasts')
+                return
             logger.info('setting initial OD reading')
             self.OD_initial = data['transformed']['od']
         elif self.OD_initial is None:
             self.OD_initial = np.zeros(len(VIALS))
         data['transformed']['od'] = (data['transformed']['od'] -
                                         self.OD_initial)
+        self.ring_buffers['OD'].append(elapsed_time, data['transformed']['od'])
+        self.ring_buffers['temp'].append(elapsed_time,
+                                         data['transformed']['temp'])
+        self.growth_rate.update(elapsed_time, data['transformed']['od'])
+        stage_start = self._end_stage('transform', stage_start)
         # save data
         try:
             self.save_data(data['transformed']['od'], elapsed_time,
@@ -106,39 +237,58 @@ class EvolverNamespace(BaseNamespace):
             for param in temp_cal['params']:
                 self.save_data(data['data'].get(param, []), elapsed_time,
                             VIALS, param + '_raw')
+            # group commit of all the rows of this broadcast
+            self.writer.commit()
+            if self.column_store is not None:
+                self.column_store.commit()
         except OSError:
             logger.info("Broadcast received before experiment initialization - skipping custom function...")
             return
+        stage_start = self._end_stage('save', stage_start)
 
+        # custom scripts may also append to ODset, pump_log etc. directly
+        self.controller_state.refresh()
         # run custom functions
         self.custom_functions(data, VIALS, elapsed_time)
-        # save variables
-        self.save_variables(self.start_time, self.OD_initial)
+        self.writer.commit()
+        self._end_stage('custom_functions', stage_start)
+        self.broadcast_seq += 1
+        self.last_elapsed_time = elapsed_time
+        # save variables needed for restarting experiment later
+        if self.checkpointer.due():
+            self.save_checkpoint()
+
+    def elapsed(self):
+        """
+        Hours since the start of the experiment.
+        """
+        return round((time.time() - self.start_time) / 3600, 4)
 
-        # Restart logging for db/gdrive syncing
-        logging.shutdown()
-        logging.getLogger('eVOLVER')
+    def _end_stage(self, stage, start):
+        now = time.monotonic()
+        self.stage_times[stage] = now - start
+        self.metrics.observe(stage, now - start)
+        return now
 
     def on_activecalibrations(self, data):
         print('Calibrations recieved')
         logger.info('Calibrations recieved')
         for calibration in data:
             if calibration['calibrationType'] == 'od':
-                file_path = OD_CAL_PATH
+                kind = 'od'
             elif calibration['calibrationType'] == 'temperature':
-                file_path = TEMP_CAL_PATH
+                kind = 'temp'
             elif calibration['calibrationType'] == 'pump':
-                file_path = PUMP_CAL_PATH
+                kind = 'pump'
             else:
                 continue
             for fit in calibration['fits']:
                 if fit['active']:
-                    with open(file_path, 'w') as f:
-                        json.dump(fit, f)
+                    self.calibrations.update(kind, fit)
                     # Create raw data directories and files for params needed
                     for param in fit['params']:
-                        if not os.path.isdir(os.path.join(EXP_DIR, param + '_raw')) and param != 'pump':
-                            os.makedirs(os.path.join(EXP_DIR, param + '_raw'))
+                        if not os.path.isdir(os.path.join(self.data_dir, param + '_raw')) and param != 'pump':
+                            os.makedirs(os.path.join(self.data_dir, param + '_raw'))
                             for x in range(len(fit['coefficients'])):
                                 exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
                                         x,
@@ -151,98 +301,95 @@ class EvolverNamespace(BaseNamespace):
         self.emit('getactivecal',
                   {}, namespace = '/dpu-evolver')
 
-    def transform_data(self, data, vials, od_cal, temp_cal):
+    def calibration_inputs(self, data, engine, report=True):
+        """
+        The raw (od, temp, set_temp, od_2) arrays of a broadcast for
+        engine.transform(), or None if the broadcast is incomplete (which
+        is logged if report is True). Readings rejected by the sensor QC
+        are set to NaN, which only invalidates their vial.
+        """
         od_data_2 = None
-        if od_cal['type'] == THREE_DIMENSION:
-            od_data_2 = data['data'].get(od_cal['params'][1], None)
+        if engine.od_type == THREE_DIMENSION:
+            od_data_2 = data['data'].get(engine.od_params[1], None)
 
-        od_data = data['data'].get(od_cal['params'][0], None)
-        temp_data = data['data'].get(temp_cal['params'][0], None)
+        od_data = data['data'].get(engine.od_params[0], None)
+        temp_data = data['data'].get(engine.temp_params[0], None)
         set_temp_data = data['config'].get('temp', {}).get('value', None)
 
         if od_data is None or temp_data is None or set_temp_data is None:
-            print('Incomplete data recieved, Error with measurement')
-            logger.error('Incomplete data received, error with measurements')
+            if report:
+                print('Incomplete data recieved, Error with measurement')
+                logger.error('Incomplete data received, error with '
+                             'measurements')
             return None
-        if 'NaN' in od_data or 'NaN' in temp_data or 'NaN' in set_temp_data:
-            print('NaN recieved, Error with measurement')
-            logger.error('NaN received, error with measurements')
+        if 'NaN' in set_temp_data:
+            if report:
+                print('NaN recieved, Error with measurement')
+                logger.error('NaN received, error with measurements')
             return None
 
-        od_data = np.array([float(x) for x in od_data])
-        if od_data_2:
-            od_data_2 = np.array([float(x) for x in od_data_2])
-        temp_data = np.array([float(x) for x in temp_data])
-        set_temp_data = np.array([float(x) for x in set_temp_data])
-
-        temps = []
-        for x in vials:
-            file_name =  "vial{0}_temp_config.txt".format(x)
-            file_path = os.path.join(EXP_DIR, 'temp_config', file_name)
-            temp_set_data = np.genfromtxt(file_path, delimiter=',')
-            temp_set = temp_set_data[len(temp_set_data)-1][1]
-            temps.append(temp_set)
-            od_coefficients = od_cal['coefficients'][x]
-            temp_coefficients = temp_cal['coefficients'][x]
-            try:
-                if od_cal['type'] == SIGMOID:
-                    #convert raw photodiode data into ODdata using calibration curve
-                    od_data[x] = np.real(od_coefficients[2] -
-                                        ((np.log10((od_coefficients[1] -
-                                                    od_coefficients[0]) /
-                                                    (float(od_data[x]) -
-                                                    od_coefficients[0])-1)) /
-                                                    od_coefficients[3]))
-                    if not np.isfinite(od_data[x]):
-                        od_data[x] = 'NaN'
-                        logger.debug('OD from vial %d: %s' % (x, od_data[x]))
-                    else:
-                        logger.debug('OD from vial %d: %.3f' % (x, od_data[x]))
-                elif od_cal['type'] == THREE_DIMENSION:
-                    od_data[x] = np.real(od_coefficients[0] +
-                                        (od_coefficients[1]*od_data[x]) +
-                                        (od_coefficients[2]*od_data_2[x]) +
-                                        (od_coefficients[3]*(od_data[x]**2)) +
-                                        (od_coefficients[4]*od_data[x]*od_data_2[x]) +
-                                        (od_coefficients[5]*(od_data_2[x]**2)))
-                else:
-                    logger.error('OD calibration not of supported type!')
-                    od_data[x] = 'NaN'
-            except ValueError:
-                print("OD Read Error")
-                logger.error('OD read error for vial %d, setting to NaN' % x)
-                od_data[x] = 'NaN'
-            try:
-                temp_data[x] = (float(temp_data[x]) *
-                                temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('temperature from vial %d: %.3f' % (x, temp_data[x]))
-            except ValueError:
-                print("Temp Read Error")
-                logger.error('temperature read error for vial %d, setting to NaN'
-                            % x)
-                temp_data[x]  = 'NaN'
-            try:
-                set_temp_data[x] = (float(set_temp_data[x]) *
-                                    temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('set_temperature from vial %d: %.3f' % (x,
-                                                                set_temp_data[x]))
-            except ValueError:
-                print("Set Temp Read Error")
-                logger.error('set temperature read error for vial %d, setting to NaN'
-                            % x)
-                set_temp_data[x]  = 'NaN'
-
-        temps = np.array(temps)
+        od_data = to_float_array(od_data)
+        temp_data = to_float_array(temp_data)
+        if od_data_2 is not None:
+            od_data_2 = to_float_array(od_data_2)
+        qc = self.qc.check(od_data, temp_data, od_data_2)
+        if not qc.valid.all():
+            logger.warning('sensor QC rejected readings of vials %s (%s)',
+                           np.flatnonzero(~qc.valid), ', '.join(
+                               '{0}: {1}'.format(check, np.flatnonzero(vials))
+                               for check, vials in qc.rejected.items()
+                               if vials.any()))
+            self.metrics.inc('qc_rejections', int(
+                np.count_nonzero(~qc.od_valid) +
+                np.count_nonzero(~qc.temp_valid)))
+            od_data[~qc.od_valid] = np.nan
+            if od_data_2 is not None:
+                od_data_2[~qc.od_valid] = np.nan
+            temp_data[~qc.temp_valid] = np.nan
+        return (od_data, temp_data, to_float_array(set_temp_data), od_data_2)
+
+    def transform_data(self, data, vials, od_cal=None, temp_cal=None,
+                       calibrated=None):
+        # fits passed explicitly take precedence over the calibration store
+        if od_cal is not None and temp_cal is not None:
+            engine = CalibrationEngine(od_cal, temp_cal)
+        else:
+            engine = self.calibrations.engine()
+
+        # calibrated is given when the broadcast was calibrated together
+        # with those of other units, see UnitGroup
+        if calibrated is None:
+            inputs = self.calibration_inputs(data, engine)
+            if inputs is None:
+                return None
+            calibrated = engine.transform(*inputs)
+        if not calibrated.od_valid.all():
+            logger.debug('OD from vials %s is not finite, setting to NaN',
+                         np.flatnonzero(~calibrated.od_valid))
+            self.metrics.inc('nan_readings',
+                             int(np.count_nonzero(~calibrated.od_valid)))
+        if not calibrated.temp_valid.all():
+            logger.error('temperature read error for vials %s, setting to NaN',
+                         np.flatnonzero(~calibrated.temp_valid))
+            self.metrics.inc('nan_readings',
+                             int(np.count_nonzero(~calibrated.temp_valid)))
+        logger.debug('OD: %s', calibrated.od)
+        logger.debug('temperature: %s', calibrated.temp)
+        logger.debug('set temperature: %s', calibrated.set_temp)
+
+        # custom scripts and the GUI may have appended to temp_config
+        self.temp_setpoints.refresh()
+        temps = self.temp_setpoints.values[vials]
+
+        temp_data = calibrated.temp[vials]
+        set_temp_data = calibrated.set_temp[vials]
         # update temperatures only if difference with expected
         # value is above 0.2 degrees celsius
         delta_t = np.abs(set_temp_data - temps).max()
         if delta_t > 0.2:
-            logger.info('updating temperatures (max. deltaT is %.2f)' %
+            logger.info('updating temperatures (max. deltaT is %.2f)',
                         delta_t)
-            coefficients = temp_cal['coefficients']
-            raw_temperatures = [str(int((temps[x] - temp_cal['coefficients'][x][1]) /
-                                        temp_cal['coefficients'][x][0]))
-                                for x in vials]
+            raw_temperatures = engine.raw_temperature(temps)
             self.update_temperature(raw_temperatures)
         else:
             # config from server agrees with local config
@@ -250,61 +397,108 @@ class EvolverNamespace(BaseNamespace):
             delta_t = np.abs(temps - temp_data).max()
             if delta_t > 0.2:
                 logger.debug('actual temperature doesn\'t match configuration '
-                            '(yet? max deltaT is %.2f)' % delta_t)
-                logger.debug('temperature config: %s' % temps)
-                logger.debug('actual temperatures: %s' % temp_data)
+                            '(yet? max deltaT is %.2f)', delta_t)
+                logger.debug('temperature config: %s', temps)
+                logger.debug('actual temperatures: %s', temp_data)
 
         # add a new field in the data dictionary
         data['transformed'] = {}
-        data['transformed']['od'] = od_data
-        data['transformed']['temp'] = temp_data
+        data['transformed']['od'] = calibrated.od
+        data['transformed']['temp'] = calibrated.temp
+        data['transformed']['valid'] = calibrated.valid
         return data
 
+    def emit_command(self, command):
+        logger.debug('%s command: %s', command['param'], command)
+        self.emit('command', command, namespace = '/dpu-evolver')
+        self.metrics.inc('commands')
+        if command['param'] == 'pump' and not command['recurring']:
+            self.metrics.inc('pump_events',
+                             sum(1 for v in command['value']
+                                 if v != UNCHANGED and float(v) > 0))
+
     def update_stir_rate(self, stir_rates, immediate = False):
-        data = {'param': 'stir', 'value': stir_rates,
-                'immediate': immediate, 'recurring': True}
-        logger.debug('stir rate command: %s' % data)
-        self.emit('command', data, namespace = '/dpu-evolver')
+        self.commands.send('stir', stir_rates, immediate)
+
+    def set_stir(self, stir_rates, vials=None):
+        """
+        Changes the stir rate of vials (all by default), leaving the others
+        as they are.
+        """
+        if vials is None:
+            vials = VIALS
+        vials = np.atleast_1d(vials)
+        stir_rates = np.broadcast_to(stir_rates, vials.shape)
+        values = [UNCHANGED] * len(VIALS)
+        for vial, rate in zip(vials.tolist(), stir_rates.tolist()):
+            values[vial] = rate
+        self.update_stir_rate(values)
+
+    def set_temperature(self, temperatures, vials=None, elapsed_time=None):
+        """
+        Changes the temperature setpoints (degrees C) of vials (all by
+        default) and sends them to the eVOLVER right away, instead of with
+        the next broadcast as custom scripts editing temp_config do.
+        """
+        if elapsed_time is None:
+            elapsed_time = self.elapsed()
+        if vials is not None:
+            vials = np.atleast_1d(vials).tolist()
+        self.temp_setpoints.set(temperatures, elapsed_time, vials)
+        if self.calibrations.ready():
+            engine = self.calibrations.engine()
+            self.update_temperature(
+                engine.raw_temperature(self.temp_setpoints.values))
 
     def update_temperature(self, temperatures, immediate = False):
-        data = {'param': 'temp', 'value': temperatures,
-                'immediate': immediate, 'recurring': True}
-        logger.debug('temperature command: %s' % data)
-        self.emit('command', data, namespace = '/dpu-evolver')
+        self.commands.send('temp', temperatures, immediate)
 
     def fluid_command(self, MESSAGE):
-        logger.debug('fluid command: %s' % MESSAGE)
-        command = {'param': 'pump', 'value': MESSAGE,
-                   'recurring': False ,'immediate': True}
-        self.emit('command', command, namespace='/dpu-evolver')
-
-    def update_chemo(self, data, vials, bolus_in_s, period_config, immediate = False):
-        current_pump = data['config']['pump']['value']
+        self.commands.send('pump', MESSAGE, immediate=True, recurring=False)
 
-        MESSAGE = {'fields_expected_incoming': 49,
-                   'fields_expected_outgoing': 49,
-                   'recurring': True,
-                   'immediate': immediate,
-                   'value': ['--'] * 48,
-                   'param': 'pump'}
+    def controller_inputs(self, vials, elapsed_time, history=1):
+        """
+        (vials,) arrays of the OD history, flow rates and controller state
+        of vials for array based controllers, see controllers.py.
+        """
+        return ControllerInputs(self, vials, elapsed_time, history)
 
-        for x in vials:
-            # stop pumps if period is zero
-            if period_config[x] == 0:
-                # influx
-                MESSAGE['value'][x] = '0|0'
-                # efflux
-                MESSAGE['value'][x + 16] = '0|0'
-            else:
-                # influx
-                MESSAGE['value'][x] = '%.2f|%d' % (bolus_in_s[x], period_config[x])
-                # efflux
-                MESSAGE['value'][x + 16] = '%.2f|%d' % (bolus_in_s[x] * 2,
-                                                        period_config[x])
+    def pump_vials(self, vials, elapsed_time, influx, efflux):
+        """
+        Runs the influx and efflux pumps of vials for the given (vials,)
+        arrays of seconds with one fluidic command and logs the influx to
+        their pump_log; vials with neither influx nor efflux are left alone.
+        """
+        influx = np.asarray(influx, dtype=np.float64)
+        on = pumped(influx, efflux)
+        if not on.any():
+            return
+        vials = np.asarray(vials, dtype=int)
+        logger.info('dilutions for vials %s', vials[on])
+        self.fluid_command(pump_message(vials, influx, efflux))
+        self.controller_state.log_pumps(vials[on], elapsed_time, influx[on])
 
-        if MESSAGE['value'] != current_pump:
-            logger.info('updating chemostat: %s' % MESSAGE)
-            self.emit('command', MESSAGE, namespace = '/dpu-evolver')
+    def update_chemo(self, data, vials, bolus_in_s, period_config, immediate = False):
+        # bolus_in_s and period_config are indexed by vial number
+        vials = np.asarray(vials, dtype=int)
+        self.set_chemostat(vials,
+                           np.asarray(bolus_in_s, dtype=np.float64)[vials],
+                           np.asarray(period_config, dtype=np.float64)[vials],
+                           immediate)
+
+    def set_chemostat(self, vials, bolus_in_s, period, immediate = False):
+        """
+        Sends the recurring pump program for (vials,) arrays of bolus times
+        and periods, unless the eVOLVER already runs it. The program is
+        only re-encoded when an input changed.
+        """
+        value = self.chemo_program.encode(vials, bolus_in_s, period)
+        # compared against the pump config of the current broadcast
+        if not self.commands.is_noop('pump', value):
+            logger.info('updating chemostat: %s', value)
+            self.commands.send('pump', value, immediate,
+                               fields_expected_incoming=49,
+                               fields_expected_outgoing=49)
 
     def stop_all_pumps(self, ):
         data = {'param': 'pump',
@@ -312,7 +506,9 @@ class EvolverNamespace(BaseNamespace):
                 'recurring': False,
                 'immediate': True}
         logger.info('stopping all pumps')
+        # not through the command coalescer, this has to go out right away
         self.emit('command', data, namespace = '/dpu-evolver')
+        self.metrics.inc('commands')
 
     def _create_file(self, vial, param, directory=None, defaults=None):
         if defaults is None:
@@ -320,7 +516,8 @@ class EvolverNamespace(BaseNamespace):
         if directory is None:
             directory = param
         file_name =  "vial{0}_{1}.txt".format(vial, param)
-        file_path = os.path.join(EXP_DIR, directory, file_name)
+        file_path = os.path.join(self.data_dir, directory, file_name)
+        self.writer.release(file_path)
         text_file = open(file_path, "w")
         for default in defaults:
             text_file.write(default + '\n')
@@ -331,8 +528,8 @@ class EvolverNamespace(BaseNamespace):
         self.experiment_params = experiment_params
         logger.info('initializing experiment')
 
-        if os.path.exists(EXP_DIR):
-            setup_logging(log_name, quiet, verbose)
+        if os.path.exists(self.data_dir):
+            setup_logging(log_name, quiet, verbose, **self.log_settings)
             logger.info('found an existing experiment')
             exp_continue = None
             if always_yes:
@@ -343,8 +540,9 @@ class EvolverNamespace(BaseNamespace):
         else:
             exp_continue = 'n'
 
+        checkpoint = None
         if exp_continue == 'n':
-            if os.path.exists(EXP_DIR):
+            if os.path.exists(self.data_dir):
                 exp_overwrite = None
                 if always_yes:
                     exp_overwrite = 'y'
@@ -355,7 +553,7 @@ class EvolverNamespace(BaseNamespace):
                 logger.info('data directory already exists')
                 if exp_overwrite == 'y':
                     logger.info('deleting existing data directory')
-                    shutil.rmtree(EXP_DIR)
+                    shutil.rmtree(self.data_dir)
                 else:
                     print('Change experiment name in custom_script.py '
                         'and then restart...')
@@ -367,14 +565,14 @@ class EvolverNamespace(BaseNamespace):
             self.request_calibrations()
 
             logger.debug('creating data directories')
-            os.makedirs(os.path.join(EXP_DIR, 'OD'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp_config'))
-            os.makedirs(os.path.join(EXP_DIR, 'pump_log'))
-            os.makedirs(os.path.join(EXP_DIR, 'ODset'))
-            os.makedirs(os.path.join(EXP_DIR, 'growthrate'))
-            os.makedirs(os.path.join(EXP_DIR, 'chemo_config'))
-            setup_logging(log_name, quiet, verbose)
+            os.makedirs(os.path.join(self.data_dir, 'OD'))
+            os.makedirs(os.path.join(self.data_dir, 'temp'))
+            os.makedirs(os.path.join(self.data_dir, 'temp_config'))
+            os.makedirs(os.path.join(self.data_dir, 'pump_log'))
+            os.makedirs(os.path.join(self.data_dir, 'ODset'))
+            os.makedirs(os.path.join(self.data_dir, 'growthrate'))
+            os.makedirs(os.path.join(self.data_dir, 'chemo_config'))
+            setup_logging(log_name, quiet, verbose, **self.log_settings)
             for x in vials:
                 exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
                                                                  x,
@@ -427,30 +625,74 @@ class EvolverNamespace(BaseNamespace):
                 self.OD_initial = np.zeros(len(vials))
         else:
             # load existing experiment
-            pickle_name =  "{0}.pickle".format(EXP_NAME)
-            pickle_path = os.path.join(EXP_DIR, pickle_name)
-            logger.info('loading previous experiment data: %s' % pickle_path)
-            with open(pickle_path, 'rb') as f:
-                loaded_var  = pickle.load(f)
-            x = loaded_var
-            start_time = x[0]
-            self.OD_initial = x[1]
+            checkpoint = self.checkpointer.load()
+            if checkpoint is not None:
+                logger.info('loading previous experiment data: %s' %
+                            self.checkpointer.path)
+                start_time = checkpoint['start_time']
+                self.OD_initial = checkpoint['OD_initial']
+                self.broadcast_seq = checkpoint['sequence']
+                self.last_elapsed_time = checkpoint['elapsed_time']
+            else:
+                pickle_name =  "{0}.pickle".format(EXP_NAME)
+                pickle_path = os.path.join(self.data_dir, pickle_name)
+                logger.info('loading previous experiment data: %s' % pickle_path)
+                with open(pickle_path, 'rb') as f:
+                    loaded_var  = pickle.load(f)
+                x = loaded_var
+                start_time = x[0]
+                self.OD_initial = x[1]
+
+        # current temperature setpoints, served from memory from now on
+        self.temp_setpoints.load()
+        if not self.restore_checkpoint(checkpoint):
+            self.controller_state.load()
+            self.load_ring_buffers()
 
         # copy current custom script to txt file
+        self.backup_script()
+
+        return start_time
+
+    def backup_script(self, source=None):
+        """
+        Saves a copy of the custom script (or of the given source) in the
+        experiment directory.
+        """
         backup_filename = '{0}_{1}.txt'.format(EXP_NAME,
                                             time.strftime('%y%m%d_%H%M'))
-        shutil.copy(os.path.join(SAVE_PATH, 'custom_script.py'), os.path.join(EXP_DIR,
-                                                    backup_filename))
+        backup_path = os.path.join(self.data_dir, backup_filename)
+        if source is None:
+            shutil.copy(CUSTOM_SCRIPT_PATH, backup_path)
+        else:
+            if os.path.exists(backup_path):
+                # several versions within a minute
+                backup_filename = '{0}_{1}.txt'.format(
+                    EXP_NAME, time.strftime('%y%m%d_%H%M%S'))
+                backup_path = os.path.join(self.data_dir, backup_filename)
+            with open(backup_path, 'wb') as f:
+                f.write(source)
         logger.info('saved a copy of current custom_script.py as %s' %
                     backup_filename)
 
-        return start_time
+    def use_script(self, module, source):
+        """
+        Switches custom_functions() over to a new version of the custom
+        script (see ScriptReloader); runs on the processing worker, so
+        between two broadcasts.
+        """
+        self.script = module
+        self.backup_script(source)
+        logger.info('%s: custom functions now run from the new version of '
+                    'custom_script.py', self.label)
 
     def check_for_calibrations(self):
         result = True
-        if not os.path.exists(OD_CAL_PATH) or not os.path.exists(TEMP_CAL_PATH) or not os.path.exists(PUMP_CAL_PATH):
+        self.calibrations.refresh()
+        if not self.calibrations.ready():
             # log and request again
-            logger.warning('Calibrations not received yet, requesting again')
+            logger.warning('Calibrations not received yet (%s), requesting '
+                           'again' % ', '.join(self.calibrations.missing()))
             self.request_calibrations()
             result = False
         return result
@@ -460,30 +702,142 @@ class EvolverNamespace(BaseNamespace):
             return
         for x in vials:
             file_name =  "vial{0}_{1}.txt".format(x, parameter)
-            file_path = os.path.join(EXP_DIR, parameter, file_name)
-            text_file = open(file_path, "a+")
-            text_file.write("{0},{1}\n".format(elapsed_time, data[x]))
-            text_file.close()
+            file_path = os.path.join(self.data_dir, parameter, file_name)
+            self.writer.append_row(file_path, [elapsed_time, data[x]])
+        if self.column_store is not None:
+            self.column_store.append(parameter, elapsed_time,
+                                     [data[x] for x in vials])
+
+    def append_row(self, vial, parameter, values, directory=None):
+        """
+        Queues a comma separated row for a per-vial file (e.g. ODset or
+        pump_log); it is written out with the rest of the broadcast.
+        """
+        file_path = vial_file_path(self.data_dir, vial, parameter, directory)
+        self.writer.append_row(file_path, values)
 
     def save_variables(self, start_time, OD_initial):
         # save variables needed for restarting experiment later
-        save_path = os.path.dirname(os.path.realpath(__file__))
         pickle_name = "{0}.pickle".format(EXP_NAME)
-        pickle_path = os.path.join(EXP_DIR, pickle_name)
-        logger.debug('saving all variables: %s' % pickle_path)
-        with open(pickle_path, 'wb') as f:
-            pickle.dump([start_time, OD_initial], f)
+        pickle_path = os.path.join(self.data_dir, pickle_name)
+        logger.debug('saving all variables: %s', pickle_path)
+        atomic_pickle([start_time, OD_initial], pickle_path)
+
+    def save_checkpoint(self):
+        # the file sizes recorded must match the state, commit first
+        self.writer.commit()
+        file_sizes = {}
+        for param in ['OD'] + CONTROLLER_JOURNALS:
+            file_sizes[param] = [
+                os.path.getsize(vial_file_path(self.data_dir, x, param))
+                for x in VIALS]
+        self.checkpointer.save({
+            'sequence': self.broadcast_seq,
+            'elapsed_time': self.last_elapsed_time,
+            'start_time': self.start_time,
+            'OD_initial': self.OD_initial,
+            'file_sizes': file_sizes,
+            'controller': self.controller_state.snapshot(),
+            'growth_rate': self.growth_rate.snapshot(),
+            'ring_buffers': dict((param, ring_buffer.snapshot()) for
+                                 param, ring_buffer in
+                                 self.ring_buffers.items())})
+        # kept for older scripts resuming this experiment
+        self.save_variables(self.start_time, self.OD_initial)
+
+    def restore_checkpoint(self, checkpoint):
+        """
+        Restores the controller state, ring buffers and growth rate sums of
+        a checkpoint, then applies whatever was appended to the data files
+        after it was taken. Returns False if the state has to be rebuilt
+        from the data files instead, leaving the current state untouched.
+        """
+        if checkpoint is None:
+            return False
+        # restored into new objects, swapped in once everything was read
+        controller_state, growth_rate, ring_buffers = self.new_runtime_state()
+        try:
+            controller_state.restore(checkpoint['controller'],
+                                     checkpoint['file_sizes'])
+            growth_rate.restore(checkpoint['growth_rate'])
+            for param, ring_buffer in ring_buffers.items():
+                ring_buffer.restore(checkpoint['ring_buffers'][param])
+
+            sizes = checkpoint['file_sizes']
+            behind = False
+            # rows appended to the controller journals after the checkpoint
+            for x in controller_state.refresh():
+                # a growth curve may have started since
+                growth_rate.reset(x, controller_state.odset_time[x])
+            for x in VIALS:
+                rows, lines = read_appended(
+                    vial_file_path(self.data_dir, x, 'OD'), sizes['OD'][x])
+                if len(rows):
+                    growth_rate.add(x, rows[:, 0], rows[:, 1])
+                    behind = True
+        except (KeyError, ValueError, OSError) as e:
+            logger.warning('could not restore checkpoint (%s), reloading '
+                           'state from the data files' % e)
+            return False
+        self.controller_state = controller_state
+        self.growth_rate = growth_rate
+        self.ring_buffers = ring_buffers
+
+        if behind:
+            logger.info('data files are ahead of checkpoint %d, reloading '
+                        'recent values' % checkpoint['sequence'])
+            self.load_ring_buffers()
+        logger.info('restored checkpoint %d' % checkpoint['sequence'])
+        return True
+
+    def load_ring_buffers(self):
+        # fill the in-memory history from the tails of the data files
+        for param, ring_buffer in self.ring_buffers.items():
+            for x in range(ring_buffer.vials):
+                file_path = vial_file_path(self.data_dir, x, param)
+                rows = tail_rows(file_path, ring_buffer.capacity)
+                ring_buffer.fill(x, rows)
+                if param == 'OD':
+                    self.growth_rate.fill_history(x, rows)
+
+    def recent(self, parameter, n, times=False):
+        """
+        Last n values of a parameter (e.g. 'OD') for every vial as a
+        (vials x n) array, oldest first, without reading any file. Fewer
+        than n columns are returned until enough broadcasts came in.
+        Pass times=True to get the matching elapsed times instead.
+        """
+        ring_buffer = self.ring_buffers[parameter]
+        if times:
+            return ring_buffer.recent_times(n)
+        return ring_buffer.recent(n)
+
+    def write_metrics(self):
+        self.metrics.write(os.path.join(self.data_dir, 'metrics.json'))
 
     def get_flow_rate(self):
-        pump_cal = None
-        with open(PUMP_CAL_PATH) as f:
-            pump_cal = json.load(f)
-        return pump_cal['coefficients']
+        return self.calibrations.flow_rate()
 
     def calc_growth_rate(self, vial, gr_start, elapsed_time):
+        if self.growth_rate.tracking(vial, gr_start):
+            slope = self.growth_rate.slope(vial)
+        else:
+            # curve started before the estimator was running (e.g. resumed
+            # experiment), fall back to the data file
+            logger.info('growth rate for vial %d not tracked since %s, '
+                        'reading OD file', vial, gr_start)
+            slope = self._growth_rate_from_file(vial, gr_start)
+        logger.debug('growth rate for vial %s: %.2f', vial, slope)
+
+        # Save slope to file
+        self.append_row(vial, 'gr', [elapsed_time, slope],
+                        directory='growthrate')
+
+    def _growth_rate_from_file(self, vial, gr_start):
+        self.writer.commit()
         ODfile_name =  "vial{0}_OD.txt".format(vial)
         # Grab Data and make setpoint
-        OD_path = os.path.join(EXP_DIR, 'OD', ODfile_name)
+        OD_path = os.path.join(self.data_dir, 'OD', ODfile_name)
         OD_data = np.genfromtxt(OD_path, delimiter=',')
         raw_time = OD_data[:, 0]
         raw_OD = OD_data[:, 1]
@@ -494,84 +848,93 @@ class EvolverNamespace(BaseNamespace):
         trim_time = raw_time[np.nonzero(np.where(raw_time > gr_start, 1, 0))]
         trim_OD = raw_OD[np.nonzero(np.where(raw_time > gr_start, 1, 0))]
 
+        # scipy.stats takes most of a second to import, only this fallback
+        # needs it
+        from scipy import stats
+
         # Take natural log, calculate slope
         log_OD = np.log(trim_OD)
         slope, intercept, r_value, p_value, std_err = stats.linregress(
             trim_time[np.isfinite(log_OD)],
             log_OD[np.isfinite(log_OD)])
-        logger.debug('growth rate for vial %s: %.2f' % (vial, slope))
-
-        # Save slope to file
-        file_name =  "vial{0}_gr.txt".format(vial)
-        gr_path = os.path.join(EXP_DIR, 'growthrate', file_name)
-        text_file = open(gr_path, "a+")
-        text_file.write("{0},{1}\n".format(elapsed_time, slope))
-        text_file.close()
+        return slope
 
     def tail_to_np(self, path, window=10, BUFFER_SIZE=512):
         """
         Reads file from the end and returns a numpy array with the data of the last 'window' lines.
         Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
         """
-        f = open(path, 'rb')
-        if window == 0:
-            return []
-
-        f.seek(0, os.SEEK_END)
-        remaining_bytes = f.tell()
-        size = window + 1  # Read one more line to avoid broken lines
-        block = -1
-        data = []
-
-        while size > 0 and remaining_bytes > 0:
-            if remaining_bytes - BUFFER_SIZE > 0:
-                # Seek back one whole BUFFER_SIZE
-                f.seek(block * BUFFER_SIZE, os.SEEK_END)
-                # read BUFFER
-                bunch = f.read(BUFFER_SIZE)
-            else:
-                # file too small, start from beginning
-                f.seek(0, 0)
-                # only read what was not read
-                bunch = f.read(remaining_bytes)
-
-            bunch = bunch.decode('utf-8')
-            data.append(bunch)
-            size -= bunch.count('\n')
-            remaining_bytes -= BUFFER_SIZE
-            block -= 1
-
-        data = ''.join(reversed(data)).splitlines()[-window:]
+        # make sure rows queued during this broadcast are on file
+        self.writer.commit()
+        return tail_to_np(path, window, BUFFER_SIZE)
 
-        if len(data) < window:
-            # Not enough data
-            return np.asarray([])
-
-        for c, v in enumerate(data):
-            data[c] = v.split(',')
+    def schedule_program(self, param, vials, program, name=None):
+        """
+        Schedules a temperature ('temp') or stir ('stir') program for
+        vials: a list of (elapsed_time, value) steps, e.g. from
+        scheduler.ramp(). A program is registered once per name (param by
+        default), later calls are ignored so scripts can call this on every
+        broadcast; steps in the past are skipped except the last one, which
+        is applied right away.
+        """
+        name = name or param
+        if name in self._programs:
+            return False
+        if param == 'temp':
+            setter = self.set_temperature
+        elif param == 'stir':
+            setter = self.set_stir
+        else:
+            raise ValueError('no program for parameter %s' % param)
+        self._programs.add(name)
+
+        def apply_step(value):
+            return lambda eVOLVER, vials, elapsed_time: setter(value, vials)
+
+        now = self.elapsed()
+        program = sorted(program)
+        past = [step for step in program if step[0] <= now]
+        steps = past[-1:] + [step for step in program if step[0] > now]
+        for when, value in steps:
+            self.scheduler.at(when, apply_step(value), vials, name)
+        logger.info('scheduled %s program %s with %d steps for vials %s',
+                    param, name, len(steps), vials)
+        return True
+
+    def run_scheduled(self, elapsed_time=None):
+        """
+        Runs the scheduled actions that are due.
+        """
+        self._scheduler_queued = False
+        if elapsed_time is None:
+            elapsed_time = self.elapsed()
+        self.scheduler.run_due(self, elapsed_time)
 
-        try:
-            data = np.asarray(data, dtype=np.float64)
-            return data
-        except ValueError:
-            # It is reading the header
-            return np.asarray([])
+    def poll_scheduler(self, worker):
+        """
+        Queues run_scheduled() on the processing worker if an action is due;
+        called by a timer between broadcasts.
+        """
+        if (self.start_time is None or self._scheduler_queued or
+                not self.scheduler.due(self.elapsed())):
+            return
+        self._scheduler_queued = True
+        worker.submit('scheduled', self.run_scheduled, ())
 
     def custom_functions(self, data, vials, elapsed_time):
+        # timed actions first, the controllers see their effect
+        self.run_scheduled(elapsed_time)
         # load user script from custom_script.py
-        mode = self.experiment_params['function'] if self.experiment_params else OPERATION_MODE
-        if mode == 'turbidostat':
-            custom_script.turbidostat(self, data, vials, elapsed_time)
-        elif mode == 'chemostat':
-            custom_script.chemostat(self, data, vials, elapsed_time)
-        elif mode == 'growthcurve':
-            custom_script.growth_curve(self, data, vials, elapsed_time)
+        mode = self.experiment_params['function'] if self.experiment_params else self.script.OPERATION_MODE
+        if mode in CUSTOM_FUNCTIONS:
+            getattr(self.script, CUSTOM_FUNCTIONS[mode])(self, data, vials,
+                                                         elapsed_time)
         else:
             # try to load the user function
             # if failing report to user
-            logger.info('user-defined operation mode %s' % mode)
+            logger.info('user-defined operation mode %s', mode)
             try:
-                func = getattr(custom_script, mode)
+                func = getattr(self.script, mode)
                 func(self, data, vials, elapsed_time)
             except AttributeError:
                 logger.error('could not find function %s in custom_script.py' %
@@ -582,20 +945,102 @@ class EvolverNamespace(BaseNamespace):
 
     def stop_exp(self):
         self.stop_all_pumps()
-
-def setup_logging(filename, quiet, verbose):
+        if self.broadcast_seq > 0:
+            self.save_checkpoint()
+        self.writer.close()
+        if self.column_store is not None:
+            self.column_store.close()
+
+def setup_logging(filename, quiet, verbose, queued=False, max_bytes=0,
+                  rotate_when=None, backup_count=5):
+    global LOG_PIPELINE
+    root = logging.getLogger()
     if quiet:
-        logging.basicConfig(level=logging.CRITICAL + 10)
-    else:
-        if verbose == 0:
-            level = logging.INFO
-        elif verbose >= 1:
-            level = logging.DEBUG
-        logging.basicConfig(format='%(asctime)s - %(name)s - [%(levelname)s] '
-                            '- %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            filename=filename,
-                            level=level)
+        root.setLevel(logging.CRITICAL + 10)
+        return
+    if LOG_PIPELINE is not None:
+        if os.path.exists(filename):
+            return
+        # the log file went away with an overwritten experiment directory
+        root.removeHandler(LOG_PIPELINE.handler)
+        LOG_PIPELINE.close()
+    if verbose == 0:
+        level = logging.INFO
+    elif verbose >= 1:
+        level = logging.DEBUG
+    handler = make_file_handler(filename, max_bytes, rotate_when, backup_count)
+    LOG_PIPELINE = LogPipeline(handler, queued)
+    LOG_PIPELINE.start()
+    root.addHandler(LOG_PIPELINE.handler)
+    root.setLevel(level)
+
+def flush_logging():
+    """
+    Pushes buffered log records to the log file (with --log-queue from the
+    background thread, every --log-flush-interval seconds).
+    """
+    if LOG_PIPELINE is not None:
+        LOG_PIPELINE.flush()
+
+def stop_logging():
+    if LOG_PIPELINE is not None:
+        LOG_PIPELINE.stop()
+
+class UnitGroup:
+    """
+    Processes the broadcasts of several eVOLVER units run from one process
+    (--unit). All units share the processing worker; the broadcasts that
+    are waiting together are calibrated in a single numpy pass across all
+    their vials before each unit runs the rest of its pipeline.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        # stage durations of the last broadcast processed
+        self.stage_times = {}
+
+    def on_broadcast(self, namespace, data):
+        start = time.monotonic()
+        taken = self.worker.take_broadcasts(self.on_broadcast)
+        batch = [(namespace, data)] + [args for args, _ in taken]
+        # the worker accounts for the broadcast it called us with, the
+        # others are accounted for here
+        received = [None] + [received for _, received in taken]
+        calibrated = [None] * len(batch)
+        pending = []
+        for i, (unit, unit_data) in enumerate(batch):
+            unit.calibrations.refresh()
+            if not unit.calibrations.ready():
+                continue
+            engine = unit.calibrations.engine()
+            inputs = unit.calibration_inputs(unit_data, engine, report=False)
+            if inputs is not None:
+                pending.append((i, engine, inputs))
+        if pending:
+            results = transform_batch([engine for _, engine, _ in pending],
+                                      [inputs for _, _, inputs in pending])
+            for (i, _, _), result in zip(pending, results):
+                calibrated[i] = result
+        # units whose broadcast could not be calibrated here go through the
+        # usual checks and error reporting of on_broadcast
+        for (unit, unit_data), unit_calibrated, unit_received in zip(
+                batch, calibrated, received):
+            unit.on_broadcast(unit_data, calibrated=unit_calibrated)
+            self.stage_times = unit.stage_times
+            if unit_received is not None:
+                self.worker.record(unit_received, start)
+
+
+def parse_units(units, parser):
+    result = []
+    for unit in units:
+        name, _, ip = unit.partition('=')
+        if not name or not ip:
+            parser.error('--unit expects NAME=IP, got {0}'.format(unit))
+        if name in [n for n, _ in result]:
+            parser.error('unit {0} given twice'.format(name))
+        result.append((name, ip))
+    return result
 
 def get_options():
     description = 'Run an eVOLVER experiment from the command line'
@@ -608,10 +1053,84 @@ def get_options():
                              'overwrites existing data and blanks OD '
                              'measurements)')
     parser.add_argument('-l', '--log-name',
-                        default=os.path.join(EXP_DIR, 'evolver.log'),
-                        help='Log file name directory (default: %(default)s)')
+                        help='Log file name directory (default: {0}, or {1} '
+                             'with --unit)'.format(
+                                 os.path.join(EXP_DIR, 'evolver.log'),
+                                 os.path.join(SAVE_PATH, 'evolver.log')))
     parser.add_argument('-i', '--ip-address', action='store', dest='ip_address',
                         help='IP address of eVOLVER to run experiment on.')
+    parser.add_argument('-u', '--unit', action='append', dest='units',
+                        metavar='NAME=IP',
+                        help='Run the experiment on several eVOLVERs from '
+                             'this process, one --unit per eVOLVER. Data of '
+                             'each unit goes to <NAME>/{0}'.format(EXP_NAME))
+    parser.add_argument('--durability', choices=SYNC_POLICIES,
+                        default=SYNC_SHUTDOWN,
+                        help='When data files are fsync\'ed to disk: on every '
+                             'broadcast, every --sync-interval seconds or '
+                             'only on shutdown (default: %(default)s)')
+    parser.add_argument('--sync-interval', type=float, default=60,
+                        help='Seconds between fsyncs with --durability '
+                             'interval (default: %(default)s)')
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        help='Seconds between checkpoints of the experiment '
+                             'state used to resume it (default: %(default)s)')
+    parser.add_argument('--binary-store', action='store_true', default=False,
+                        help='Also store data in memory-mappable binary '
+                             'files under <experiment>/binary')
+
+    parser.add_argument('--max-pending-broadcasts', type=int, default=1,
+                        help='Broadcasts kept waiting while the previous one '
+                             'is processed, older ones are dropped '
+                             '(default: %(default)s)')
+    parser.add_argument('--late-after', type=float, default=5,
+                        help='Seconds a broadcast can wait before it is '
+                             'reported as late (default: %(default)s)')
+    parser.add_argument('--stats-interval', type=float, default=600,
+                        help='Seconds between logging broadcast counters and '
+                             'processing lag (default: %(default)s)')
+    parser.add_argument('--qc-jump', type=float, default=0.5,
+                        help='Relative change from its recent readings above '
+                             'which a vial\'s raw reading is rejected as a '
+                             'glitch; 0 disables the check (default: '
+                             '%(default)s)')
+    parser.add_argument('--command-interval', type=float, default=0,
+                        help='Minimum seconds between two temp, stir or '
+                             'chemostat commands, changes in between are '
+                             'merged into the next one (default: '
+                             '%(default)s)')
+    parser.add_argument('--scheduler-interval', type=float, default=1,
+                        help='Seconds between checks for scheduled custom '
+                             'script actions that are due between '
+                             'broadcasts (default: %(default)s)')
+    parser.add_argument('--reload-interval', type=float, default=2,
+                        help='Seconds between checks of custom_script.py for '
+                             'changes, which are loaded without restarting '
+                             'the experiment; 0 disables reloading (default: '
+                             '%(default)s)')
+    parser.add_argument('--metrics-interval', type=float, default=60,
+                        help='Seconds between rewrites of the metrics.json '
+                             'file in the experiment directory, 0 to '
+                             'disable (default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve the metrics in the Prometheus text '
+                             'format on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--log-queue', action='store_true', default=False,
+                        help='Write the log file from a background thread, '
+                             'buffering records for up to '
+                             '--log-flush-interval seconds')
+    parser.add_argument('--log-flush-interval', type=float, default=30,
+                        help='Seconds between log file flushes with '
+                             '--log-queue (default: %(default)s)')
+    parser.add_argument('--log-max-bytes', type=int, default=0,
+                        help='Rotate the log file when it reaches this size '
+                             '(default: no size based rotation)')
+    parser.add_argument('--log-rotate-when', default=None,
+                        help='Rotate the log file on a schedule, e.g. '
+                             'midnight or H (see TimedRotatingFileHandler)')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help='Rotated log files to keep (default: '
+                             '%(default)s)')
 
     log_nolog = parser.add_mutually_exclusive_group()
     log_nolog.add_argument('-v', '--verbose', action='count',
@@ -634,102 +1153,119 @@ if __name__ == '__main__':
     if os.path.exists(JSON_PARAMS_FILE):
         with open(JSON_PARAMS_FILE) as f:
             experiment_params = json.load(f)
-    evolver_ip = experiment_params['ip'] if experiment_params is not None else options.ip_address
-    if evolver_ip is None:
-        logger.error('No IP address found. Please provide on the command line or through the GUI.')
-        parser.print_help()
-        sys.exit(2)
-
-    socketIO = SocketIO(evolver_ip, EVOLVER_PORT)
-    EVOLVER_NS = socketIO.define(EvolverNamespace, '/dpu-evolver')
-
-    # start by stopping any existing chemostat
-    EVOLVER_NS.stop_all_pumps()
-    #
-    EVOLVER_NS.start_time = EVOLVER_NS.initialize_exp(VIALS,
-                                                      experiment_params,
-                                                      options.log_name,
-                                                      options.quiet,
-                                                      options.verbose,
-                                                      evolver_ip,
-                                                      options.always_yes
-                                                      )
-
-    # Using a non-blocking stream reader to be able to listen
-    # for commands from the electron app. 
-    nbsr = NBSR(sys.stdin)
-    paused = False
-
-    # logging setup
-
-    reset_connection_timer = time.time()
-    while True:        
-        try:
-            # infinite loop
-
-            # check if a message has come in from the DPU
-            message = nbsr.readline()
-            if 'stop-script' in message:
-                logger.info('Stop message received - halting all pumps');
-                EVOLVER_NS.stop_exp()
-                socketIO.disconnect()
-            if 'pause-script' in message:
-                print('Pausing experiment', flush = True)
-                logger.info('Pausing experiment in dpu')
-                paused = True
-                EVOLVER_NS.stop_exp()
-                socketIO.disconnect()
-                
-            if 'continue-script' in message:
-                print('Restarting experiment', flush = True)
-                logger.info('Restarting experiment')
-                paused = False
-                socketIO.connect()
-
-            if not paused:
-                    socketIO.wait(seconds=0.1)
-                    if time.time() - reset_connection_timer > 3600 and not paused:
-                        # reset connection to avoid buildup of broadcast
-                        # messages (unlikely but could happen for very long
-                        # experiments with slow dpu code/computer)
-                        logger.info('resetting connection to eVOLVER to avoid '
-                                    'potential buildup of broadcast messages')
-                        socketIO.disconnect()
-                        socketIO.connect()
-                        reset_connection_timer = time.time()
-        except KeyboardInterrupt:
-            try:
-                print('Ctrl-C detected, pausing experiment')
-                logger.warning('interrupt received, pausing experiment')
-                EVOLVER_NS.stop_exp()
-                # stop receiving broadcasts
-                socketIO.disconnect()
-                while True:
-                    key = input('Experiment paused. Press enter key to restart '
-                                ' or hit Ctrl-C again to terminate experiment')
-                    logger.warning('resuming experiment')
-                    # no need to have something like "restart_chemo" here
-                    # with the new server logic
-                    socketIO.connect()
-                    break
-            except KeyboardInterrupt:
-                print('Second Ctrl-C detected, shutting down')
-                logger.warning('second interrupt received, terminating '
-                                'experiment')
-                EVOLVER_NS.stop_exp()
-                print('Experiment stopped, goodbye!')
-                logger.warning('experiment stopped, goodbye!')
-                break
-        except Exception as e:
-            logger.critical('exception %s stopped the experiment' % str(e))
-            print('error "%s" stopped the experiment' % str(e))
-            traceback.print_exc(file=sys.stdout)
-            EVOLVER_NS.stop_exp()
-            print('Experiment stopped, goodbye!')
-            logger.warning('experiment stopped, goodbye!')
-            break
+    if options.units:
+        # multi-unit mode, one connection per eVOLVER
+        units = parse_units(options.units, parser)
+    else:
+        evolver_ip = experiment_params['ip'] if experiment_params is not None else options.ip_address
+        if evolver_ip is None:
+            logger.error('No IP address found. Please provide on the command line or through the GUI.')
+            parser.print_help()
+            sys.exit(2)
+        units = [(None, evolver_ip)]
+
+    connections = []
+    for unit, evolver_ip in units:
+        socketIO = EvolverSocketIO(evolver_ip, EVOLVER_PORT)
+        namespace = socketIO.define(
+            functools.partial(EvolverNamespace, unit=unit), '/dpu-evolver')
+        namespace.writer.policy = options.durability
+        namespace.writer.sync_interval = options.sync_interval
+        # the units' writers share the process' open file limit
+        namespace.writer.max_open_files = open_file_budget(len(units))
+        namespace.checkpointer.interval = options.checkpoint_interval
+        namespace.commands.min_interval = options.command_interval
+        namespace.qc.jump = options.qc_jump
+        namespace.log_settings = {'queued': options.log_queue,
+                                  'max_bytes': options.log_max_bytes,
+                                  'rotate_when': options.log_rotate_when,
+                                  'backup_count': options.log_backups}
+        if options.binary_store:
+            namespace.column_store = ColumnStore(namespace.data_dir,
+                                                 len(VIALS))
+        connections.append((socketIO, namespace))
+    EVOLVER_NS = connections[0][1]
+
+    log_name = options.log_name
+    if log_name is None:
+        if options.units:
+            log_name = os.path.join(SAVE_PATH, 'evolver.log')
+        else:
+            log_name = os.path.join(EXP_DIR, 'evolver.log')
+
+    for (unit, evolver_ip), (socketIO, namespace) in zip(units, connections):
+        if unit is not None:
+            print('Setting up unit {0} ({1})'.format(unit, evolver_ip))
+        # start by stopping any existing chemostat
+        namespace.stop_all_pumps()
+        #
+        namespace.start_time = namespace.initialize_exp(VIALS,
+                                                        experiment_params,
+                                                        log_name,
+                                                        options.quiet,
+                                                        options.verbose,
+                                                        evolver_ip,
+                                                        options.always_yes
+                                                        )
+
+    # the sockets, stdin commands from the electron app and timers are all
+    # served by one event loop, broadcasts are processed on a worker thread
+    # so a slow custom script never holds up the sockets
+    worker = BroadcastWorker(options.max_pending_broadcasts,
+                             options.late_after)
+    if options.units:
+        group = UnitGroup(worker)
+        worker.stage_times = lambda: group.stage_times
+        runtime = ExperimentRuntime(connections, worker,
+                                    broadcast_handler=group.on_broadcast)
+    else:
+        worker.stage_times = lambda: EVOLVER_NS.stage_times
+        runtime = ExperimentRuntime(connections, worker)
+    runtime.add_timer(options.stats_interval, worker.report)
+    for namespace in runtime.namespaces:
+        runtime.add_timer(options.stats_interval, namespace.commands.report)
+        runtime.add_timer(options.stats_interval, namespace.qc.report)
+    if options.log_queue:
+        # get the log file on disk regularly for db/gdrive syncing
+        runtime.add_timer(options.log_flush_interval, flush_logging)
+    def poll_schedulers():
+        if runtime.state == RUNNING:
+            for namespace in runtime.namespaces:
+                namespace.poll_scheduler(worker)
+    runtime.add_timer(options.scheduler_interval, poll_schedulers)
+    if options.reload_interval > 0:
+        reloader = ScriptReloader(CUSTOM_SCRIPT_PATH, custom_script,
+                                  required=CUSTOM_FUNCTIONS.values(),
+                                  fixed=['EXP_NAME'],
+                                  startup=['EVOLVER_PORT', 'STIR_INITIAL',
+                                           'TEMP_INITIAL'])
+        def reload_script():
+            module = reloader.load()
+            if module is not None:
+                for namespace in runtime.namespaces:
+                    namespace.use_script(module, reloader.source)
+        def poll_script():
+            # the new version is loaded and swapped in on the worker, in
+            # between broadcasts
+            if runtime.state == RUNNING and reloader.changed():
+                worker.submit('reload', reload_script, ())
+        runtime.add_timer(options.reload_interval, poll_script)
+    if options.metrics_interval > 0:
+        for namespace in runtime.namespaces:
+            runtime.add_timer(options.metrics_interval,
+                              namespace.write_metrics)
+    if options.metrics_port is not None:
+        metrics_server = MetricsServer(
+            [namespace.metrics for namespace in runtime.namespaces],
+            options.metrics_port)
+        runtime.add_task(metrics_server.serve)
+    runtime.run()
 
     # stop experiment one last time
     # covers corner case where user presses Ctrl-C twice quickly
-    socketIO.connect()
-    EVOLVER_NS.stop_exp()
+    for socketIO, namespace in connections:
+        socketIO.connect()
+        namespace.stop_exp()
+        if options.metrics_interval > 0:
+            namespace.write_metrics()
+    stop_logging()
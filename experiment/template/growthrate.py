@@ -0,0 +1,131 @@
+import numpy as np
+
+from ringbuffer import VialRingBuffer
+
+
+def _slope(n, st, sy, stt, sty):
+    # least squares slope of y = log(OD) against t from running sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sty - st * sy) / (n * stt - st * st)
+    return np.where(n >= 2, slope, np.nan)
+
+
+class GrowthRateEstimator:
+    """
+    Online growth rate (slope of log OD over time, 1/hr) for every vial.
+
+    For the current growth curve of each vial, started with reset(), it
+    keeps the sums n, sum(t), sum(log OD), sum(t^2) and sum(t * log OD) of
+    the points after the start time, so slope() gives the same result as a
+    linear regression over the whole curve in O(1). Times are taken
+    relative to the start of the curve to keep the sums well conditioned.
+
+    It also keeps a rolling growth rate over the last 'window' broadcasts,
+    updated every broadcast in the 'rolling' array.
+    """
+
+    def __init__(self, vials, window=60):
+        self.vials = vials
+        self.start = np.full(vials, np.nan)
+        self.n = np.zeros(vials)
+        self.st = np.zeros(vials)
+        self.sy = np.zeros(vials)
+        self.stt = np.zeros(vials)
+        self.sty = np.zeros(vials)
+        self.rolling = np.full(vials, np.nan)
+        self._history = VialRingBuffer(vials, window)
+
+    def reset(self, vial, gr_start):
+        """
+        Starts a new growth curve for a vial; only points after gr_start
+        are taken into account.
+        """
+        self.start[vial] = gr_start
+        self.n[vial] = 0
+        self.st[vial] = 0
+        self.sy[vial] = 0
+        self.stt[vial] = 0
+        self.sty[vial] = 0
+
+    def tracking(self, vial, gr_start):
+        """
+        True if the sums of a vial cover the curve starting at gr_start.
+        """
+        return self.start[vial] == gr_start
+
+    def update(self, elapsed_time, od):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_od = np.log(np.asarray(od, dtype=np.float64))
+        finite = np.isfinite(log_od)
+        # comparisons with a NaN start (no curve yet) are False
+        valid = finite & (elapsed_time > self.start)
+        t = np.where(valid, elapsed_time - self.start, 0)
+        y = np.where(valid, log_od, 0)
+        self.n += valid
+        self.st += t
+        self.sy += y
+        self.stt += t * t
+        self.sty += t * y
+
+        self._history.append(elapsed_time, np.where(finite, log_od, np.nan))
+        self.rolling = self._rolling_slope()
+
+    def add(self, vial, times, od):
+        """
+        Adds a batch of points of one vial to its current curve, e.g. rows
+        written to the OD file after the last checkpoint.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_od = np.log(np.asarray(od, dtype=np.float64))
+        valid = np.isfinite(log_od) & (times > self.start[vial])
+        t = times[valid] - self.start[vial]
+        y = log_od[valid]
+        self.n[vial] += len(t)
+        self.st[vial] += t.sum()
+        self.sy[vial] += y.sum()
+        self.stt[vial] += (t * t).sum()
+        self.sty[vial] += (t * y).sum()
+
+    def fill_history(self, vial, data):
+        """
+        Replaces the rolling window of a vial with the (n x 2) [time, OD]
+        rows of data, oldest first.
+        """
+        data = np.array(data, dtype=np.float64).reshape(-1, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data[:, 1] = np.log(data[:, 1])
+        data[~np.isfinite(data[:, 1]), 1] = np.nan
+        self._history.fill(vial, data)
+        self.rolling = self._rolling_slope()
+
+    def snapshot(self):
+        return {'start': self.start.copy(), 'n': self.n.copy(),
+                'st': self.st.copy(), 'sy': self.sy.copy(),
+                'stt': self.stt.copy(), 'sty': self.sty.copy(),
+                'history': self._history.snapshot()}
+
+    def restore(self, snapshot):
+        self._history.restore(snapshot['history'])
+        for name in ['start', 'n', 'st', 'sy', 'stt', 'sty']:
+            setattr(self, name, snapshot[name].copy())
+        self.rolling = self._rolling_slope()
+
+    def _rolling_slope(self):
+        history = self._history
+        times = history.recent_times(history.capacity)
+        values = history.recent(history.capacity)
+        valid = np.isfinite(values)
+        t = np.where(valid, times - times[:, -1:], 0)
+        y = np.where(valid, values, 0)
+        return _slope(valid.sum(axis=1), t.sum(axis=1), y.sum(axis=1),
+                      (t * t).sum(axis=1), (t * y).sum(axis=1))
+
+    def slope(self, vial=None):
+        """
+        Growth rate of the current curve of one vial, or of all vials.
+        """
+        rates = _slope(self.n, self.st, self.sy, self.stt, self.sty)
+        if vial is None:
+            return rates
+        return rates[vial]
@@ -0,0 +1,115 @@
+import queue
+import atexit
+import logging
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s - %(name)s - [%(levelname)s] - %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def make_file_handler(filename, max_bytes=0, rotate_when=None,
+                      backup_count=5):
+    """
+    File handler for the experiment log, rotating by size (max_bytes) or
+    time (rotate_when, e.g. 'midnight' or 'H', see TimedRotatingFileHandler)
+    if requested.
+    """
+    if max_bytes:
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count)
+    elif rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=rotate_when, backupCount=backup_count)
+    else:
+        handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    return handler
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves message formatting to the listener thread.
+    The stock prepare() merges the arguments into the message in the
+    calling thread; here that only happens for records with a traceback,
+    which has to be rendered while it still exists. Objects passed as
+    logging arguments should therefore not be modified after the call.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            return super().prepare(record)
+        return record
+
+
+class BufferingHandler(logging.handlers.MemoryHandler):
+    """
+    MemoryHandler for the listener thread of a queued LogPipeline. Besides
+    when it fills up or an error comes in, it writes its buffer out when it
+    gets the flush request record of LogPipeline.flush(), so the file is
+    only ever written from the listener thread.
+    """
+
+    def handle(self, record):
+        if getattr(record, 'flush_request', False):
+            self.flush()
+            return True
+        return super().handle(record)
+
+
+class LogPipeline:
+    """
+    Writes log records to a file handler, either directly (queued=False,
+    same as logging.basicConfig) or through a queue drained by a background
+    thread, so the broadcast loop never waits on the disk. In queued mode
+    records are buffered in memory by the background thread and written
+    when flush() is called (e.g. from a timer), when the buffer fills up or
+    when an error is logged.
+    """
+
+    def __init__(self, handler, queued=False, buffer_capacity=1000):
+        self.target = handler
+        self.queued = queued
+        self.listener = None
+        self._running = False
+        if queued:
+            self._buffer = BufferingHandler(
+                buffer_capacity, flushLevel=logging.ERROR, target=handler)
+            self._queue = queue.Queue(-1)
+            self.handler = DeferredQueueHandler(self._queue)
+            self.listener = logging.handlers.QueueListener(self._queue,
+                                                           self._buffer)
+        else:
+            self._buffer = handler
+            self.handler = handler
+
+    def start(self):
+        if self.listener is not None:
+            self.listener.start()
+        self._running = True
+        atexit.register(self.stop)
+
+    def flush(self):
+        """
+        Gets the records logged so far into the log file. In queued mode
+        this only asks the background thread to do so once it got to them,
+        so it never blocks.
+        """
+        if self.listener is None:
+            self.target.flush()
+        elif self._running:
+            self._queue.put_nowait(logging.makeLogRecord(
+                {'msg': 'flush', 'flush_request': True}))
+
+    def stop(self):
+        if self.listener is not None and self._running:
+            # processes the records still queued
+            self.listener.stop()
+        self._running = False
+        self._buffer.flush()
+        self.target.flush()
+        atexit.unregister(self.stop)
+
+    def close(self):
+        self.stop()
+        self._buffer.close()
+        self.target.close()
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import bisect
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger('eVOLVER')
+
+# name: help text, exported as evolver_<name>_total
+COUNTERS = {
+    'broadcasts': 'Broadcasts processed',
+    'rejected_broadcasts': 'Broadcasts skipped for incomplete or NaN '
+                           'readings',
+    'qc_rejections': 'Vial OD and temperature readings rejected by the sensor '
+                     'quality checks',
+    'nan_readings': 'Vial OD and temperature readings that were not finite '
+                    'after calibration',
+    'commands': 'Commands emitted to the eVOLVER',
+    'pump_events': 'Pumps switched on by one-shot pump commands',
+}
+# stages of on_broadcast timed in the evolver_stage_seconds histogram
+STAGES = ['transform', 'save', 'custom_functions', 'commands', 'broadcast']
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, like a Prometheus histogram:
+    counts per bucket plus the number and sum of the observations.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.last = None
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.last = seconds
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    Counters and per-stage latency histograms of one namespace, updated
+    from the processing worker and read from the event loop. Updates are
+    a few integer operations under a lock, cheap enough to stay on.
+
+    labels (e.g. {'unit': 'a'}) tell apart the namespaces of a multi-unit
+    run when they are exported together.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.histograms = dict((stage, Histogram()) for stage in STAGES)
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.histograms[stage].observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'labels': dict(self.labels),
+                'started': self.started,
+                'time': time.time(),
+                'counters': dict(self.counters),
+                'stages': dict(
+                    (stage, {'count': h.count, 'sum': h.sum, 'last': h.last,
+                             'buckets': [[bound, count] for bound, count in
+                                         h.cumulative()]})
+                    for stage, h in self.histograms.items())}
+
+    def write(self, path):
+        """
+        Replaces the json metrics file at path with the current values.
+        """
+        snapshot = self.snapshot()
+        for stage in snapshot['stages'].values():
+            # json has no infinity
+            stage['buckets'][-1][0] = '+Inf'
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(temp_path, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, v)
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def _bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render_prometheus(registries):
+    """
+    The Prometheus text exposition of a list of Metrics.
+    """
+    snapshots = [metrics.snapshot() for metrics in registries]
+    lines = []
+    for name, help_text in COUNTERS.items():
+        metric = 'evolver_{0}_total'.format(name)
+        lines.append('# HELP {0} {1}'.format(metric, help_text))
+        lines.append('# TYPE {0} counter'.format(metric))
+        for snapshot in snapshots:
+            lines.append('{0}{1} {2}'.format(
+                metric, _labels(snapshot['labels']),
+                snapshot['counters'][name]))
+    metric = 'evolver_stage_seconds'
+    lines.append('# HELP {0} Time spent in each stage of broadcast '
+                 'processing'.format(metric))
+    lines.append('# TYPE {0} histogram'.format(metric))
+    for snapshot in snapshots:
+        for stage, values in snapshot['stages'].items():
+            labels = dict(snapshot['labels'], stage=stage)
+            for bound, count in values['buckets']:
+                lines.append('{0}_bucket{1} {2}'.format(
+                    metric, _labels(dict(labels, le=_bound(bound))), count))
+            lines.append('{0}_sum{1} {2!r}'.format(metric, _labels(labels),
+                                                   values['sum']))
+            lines.append('{0}_count{1} {2}'.format(metric, _labels(labels),
+                                                   values['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Minimal HTTP endpoint serving render_prometheus() at /metrics, run as a
+    task of the experiment's event loop (see ExperimentRuntime.add_task).
+    """
+
+    def __init__(self, registries, port, host='127.0.0.1'):
+        self.registries = registries
+        self.port = port
+        self.host = host
+
+    async def serve(self):
+        try:
+            server = await asyncio.start_server(self._handle, self.host,
+                                                self.port)
+        except OSError as e:
+            logger.error('could not serve metrics on %s:%d: %s', self.host,
+                         self.port, e)
+            return
+        logger.info('serving metrics on http://%s:%d/metrics', self.host,
+                    self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # skip the headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            if (len(parts) >= 2 and parts[0] == b'GET' and
+                    parts[1].split(b'?')[0] in (b'/', b'/metrics')):
+                status = '200 OK'
+                body = render_prometheus(self.registries).encode()
+            else:
+                status = '404 Not Found'
+                body = b'not found\n'
+            writer.write('HTTP/1.0 {0}\r\nContent-Type: {1}\r\n'
+                         'Content-Length: {2}\r\nConnection: close\r\n\r\n'
+                         .format(status, CONTENT_TYPE, len(body)).encode() +
+                         body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
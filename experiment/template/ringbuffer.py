@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class VialRingBuffer:
+    """
+    Fixed-size history of the most recent (time, value) pairs of a
+    parameter for every vial, stored in preallocated numpy arrays.
+    """
+
+    def __init__(self, vials, capacity):
+        self.vials = vials
+        self.capacity = capacity
+        self.times = np.full((vials, capacity), np.nan)
+        self.values = np.full((vials, capacity), np.nan)
+        self.count = np.zeros(vials, dtype=int)
+        # position the next sample is written to
+        self._head = np.zeros(vials, dtype=int)
+        self._rows = np.arange(vials)
+
+    def append(self, elapsed_time, values):
+        """
+        Adds one sample for every vial, e.g. one broadcast.
+        """
+        self.times[self._rows, self._head] = elapsed_time
+        self.values[self._rows, self._head] = values
+        self._head = (self._head + 1) % self.capacity
+        self.count = np.minimum(self.count + 1, self.capacity)
+
+    def fill(self, vial, data):
+        """
+        Replaces the history of one vial with the rows of a
+        (n x 2) [time, value] array, oldest first.
+        """
+        data = np.asarray(data, dtype=np.float64)[-self.capacity:]
+        n = len(data)
+        self.times[vial] = np.nan
+        self.values[vial] = np.nan
+        if n:
+            self.times[vial, :n] = data[:, 0]
+            self.values[vial, :n] = data[:, 1]
+        self.count[vial] = n
+        self._head[vial] = n % self.capacity
+
+    def _indices(self, n):
+        n = min(n, self.capacity, int(self.count.min()))
+        # oldest to newest, per vial
+        offsets = np.arange(-n, 0)
+        return (self._head[:, None] + offsets[None, :]) % self.capacity, n
+
+    def recent(self, n):
+        """
+        (vials x k) array of the last k values, oldest first, where k is n
+        or fewer if not enough samples were recorded yet.
+        """
+        indices, _ = self._indices(n)
+        return self.values[self._rows[:, None], indices]
+
+    def recent_times(self, n):
+        indices, _ = self._indices(n)
+        return self.times[self._rows[:, None], indices]
+
+    def snapshot(self):
+        return {'times': self.times.copy(), 'values': self.values.copy(),
+                'count': self.count.copy(), 'head': self._head.copy()}
+
+    def restore(self, snapshot):
+        if snapshot['values'].shape != self.values.shape:
+            raise ValueError('ring buffer snapshot has shape %s, expected %s'
+                             % (snapshot['values'].shape, self.values.shape))
+        self.times = snapshot['times'].copy()
+        self.values = snapshot['values'].copy()
+        self.count = snapshot['count'].copy()
+        self._head = snapshot['head'].copy()
@@ -0,0 +1,346 @@
+import os
+import sys
+import signal
+import asyncio
+import functools
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from socketIO_client import SocketIO
+
+logger = logging.getLogger('eVOLVER')
+
+# namespace callbacks that are run on the event loop instead of the socket
+# thread
+EVENTS = ['connect', 'disconnect', 'reconnect', 'broadcast',
+          'activecalibrations']
+# the ones that touch experiment data, run in order on the processing worker
+WORKER_EVENTS = ['broadcast', 'activecalibrations']
+
+RUNNING = 'running'
+PAUSED = 'paused'
+INTERRUPTED = 'interrupted'
+
+
+class EvolverSocketIO(SocketIO):
+    """
+    SocketIO client whose wait() can be ended from another thread, so the
+    socket can be served by a single long-running wait() instead of short
+    polling calls.
+    """
+
+    def __init__(self, *args, **kw):
+        self._stop_event = threading.Event()
+        super().__init__(*args, **kw)
+
+    def stop_waiting(self):
+        self._stop_event.set()
+
+    def start_waiting(self):
+        self._stop_event.clear()
+
+    def _should_stop_waiting(self, **kw):
+        return (self._stop_event.is_set() or
+                super()._should_stop_waiting(**kw))
+
+    def serve(self):
+        """
+        Blocks, dispatching socket events to the namespaces, until
+        stop_waiting() is called. start_waiting() has to be called first.
+        """
+        self.wait()
+
+
+class ExperimentRuntime:
+    """
+    Runs an experiment on an asyncio event loop. Each socket (one per
+    eVOLVER unit, see connections) is served from a thread of its own that
+    hands namespace events over to the loop, or to the processing worker (a
+    BroadcastWorker) for broadcasts and calibrations. stdin commands from
+    the electron app (stop-script, pause-script, continue-script) are read
+    by the loop itself and timers are plain loop callbacks, so the process
+    sleeps until one of them has work to do. Other long-running coroutines
+    (e.g. the metrics endpoint) can be added with add_task().
+
+    connections is a list of (EvolverSocketIO, namespace) pairs.
+    broadcast_handler(namespace, data), if given, processes the broadcasts
+    instead of namespace.on_broadcast(data).
+    """
+
+    def __init__(self, connections, worker, broadcast_handler=None,
+                 events=EVENTS, worker_events=WORKER_EVENTS):
+        self.connections = connections
+        self.worker = worker
+        self.broadcast_handler = broadcast_handler
+        self.events = events
+        self.worker_events = worker_events
+        self.state = RUNNING
+        self.loop = None
+        self._timers = []
+        self._tasks = []
+        self._receivers = {}
+        self._executor = None
+        self._pausing = None
+        self._terminating = False
+        self._done = None
+        self._stdin_fd = None
+
+    def add_timer(self, interval, callback):
+        """
+        Calls callback every interval seconds while the runtime is running.
+        """
+        self._timers.append((interval, callback))
+
+    def add_task(self, coroutine_function):
+        """
+        Runs coroutine_function() on the loop for as long as the runtime
+        runs; it is cancelled on shutdown.
+        """
+        self._tasks.append(coroutine_function)
+
+    @property
+    def namespaces(self):
+        return [namespace for _, namespace in self.connections]
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self._done = asyncio.Event()
+        self._executor = ThreadPoolExecutor(len(self.connections),
+                                            thread_name_prefix='socket')
+        for socketIO, namespace in self.connections:
+            for event in self.events:
+                if event == 'broadcast' and self.broadcast_handler:
+                    forward = self._forward(event, self.broadcast_handler,
+                                            socketIO, namespace)
+                else:
+                    forward = self._forward(event,
+                                            getattr(namespace, 'on_' + event),
+                                            socketIO)
+                namespace.on(event, forward)
+        self.worker.on_error = lambda e: self.loop.call_soon_threadsafe(
+            self.fail, e)
+        self.worker.start()
+        previous_handler = signal.signal(signal.SIGINT, self._on_sigint)
+        tasks = [asyncio.ensure_future(self._read_stdin())]
+        tasks += [asyncio.ensure_future(self._every(interval, callback))
+                  for interval, callback in self._timers]
+        tasks += [asyncio.ensure_future(self._run_task(coroutine_function))
+                  for coroutine_function in self._tasks]
+        self._start_receivers()
+        try:
+            await self._done.wait()
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+            for task in tasks:
+                task.cancel()
+            await self._stop_receivers()
+            self._executor.shutdown()
+            await self.loop.run_in_executor(None, self.worker.stop)
+            if self._stdin_fd is not None:
+                os.set_blocking(self._stdin_fd, True)
+
+    def _forward(self, event, callback, key, *bound):
+        # bound: leading arguments for callback
+        if event in self.worker_events:
+            def forward(*args):
+                if event == 'broadcast' and self.state != RUNNING:
+                    return
+                self.worker.submit(event, callback, bound + args, key)
+        else:
+            def forward(*args):
+                self.loop.call_soon_threadsafe(self._dispatch, callback,
+                                               bound + args)
+        return forward
+
+    def _dispatch(self, callback, args):
+        if self._done.is_set():
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            self.fail(e)
+
+    # socket
+
+    def _start_receivers(self):
+        for socketIO, _ in self.connections:
+            if socketIO in self._receivers:
+                continue
+            socketIO.start_waiting()
+            receiver = self.loop.run_in_executor(self._executor,
+                                                 socketIO.serve)
+            receiver.add_done_callback(functools.partial(
+                self._receiver_done, socketIO))
+            self._receivers[socketIO] = receiver
+
+    def _receiver_done(self, socketIO, receiver):
+        if (self._receivers.get(socketIO) is not receiver or
+                receiver.cancelled()):
+            return
+        # wait() returned without being asked to
+        del self._receivers[socketIO]
+        e = receiver.exception()
+        if e is None:
+            e = ConnectionError('connection to eVOLVER closed')
+        self.fail(e)
+
+    async def _stop_receivers(self):
+        receivers, self._receivers = self._receivers, {}
+        for socketIO in receivers:
+            socketIO.stop_waiting()
+        for receiver in receivers.values():
+            try:
+                await receiver
+            except Exception as e:
+                logger.warning('socket receiver stopped with %s', e)
+
+    async def _disconnect(self):
+        await self._stop_receivers()
+        for socketIO, _ in self.connections:
+            socketIO.disconnect()
+
+    async def _connect(self):
+        if self._pausing is not None:
+            await self._pausing
+            self._pausing = None
+        for socketIO, _ in self.connections:
+            socketIO.connect()
+        self._start_receivers()
+
+    def _stop_all(self):
+        for namespace in self.namespaces:
+            namespace.stop_exp()
+
+    async def _stop_experiment(self):
+        # let the broadcast being processed finish so that nothing is sent
+        # to the eVOLVER after the pumps were stopped
+        self.worker.discard_broadcasts()
+        await self.loop.run_in_executor(None, self.worker.wait_idle)
+        self._stop_all()
+
+    # stdin
+
+    async def _read_stdin(self):
+        queue = asyncio.Queue()
+        try:
+            reader = asyncio.StreamReader()
+            await self.loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+            self._stdin_fd = sys.stdin.fileno()
+            readline = reader.readline
+        except (NotImplementedError, ValueError, OSError):
+            # e.g. Windows consoles or stdin redirected from a file: read
+            # from a thread and hand the lines over to the loop
+            def read_lines():
+                for line in sys.stdin:
+                    self.loop.call_soon_threadsafe(queue.put_nowait, line)
+                self.loop.call_soon_threadsafe(queue.put_nowait, '')
+            threading.Thread(target=read_lines, daemon=True).start()
+            readline = queue.get
+        while True:
+            line = await readline()
+            if not line:
+                logger.debug('stdin closed')
+                return
+            if isinstance(line, bytes):
+                line = line.decode(errors='replace')
+            try:
+                await self.handle_command(line)
+            except Exception as e:
+                self.fail(e)
+
+    async def handle_command(self, message):
+        if self.state == INTERRUPTED:
+            logger.warning('resuming experiment')
+            self.state = RUNNING
+            await self._connect()
+            return
+        if 'stop-script' in message:
+            logger.info('Stop message received - halting all pumps')
+            self.state = PAUSED
+            await self._stop_experiment()
+            await self._disconnect()
+        if 'pause-script' in message:
+            print('Pausing experiment', flush=True)
+            logger.info('Pausing experiment in dpu')
+            self.state = PAUSED
+            await self._stop_experiment()
+            await self._disconnect()
+        if 'continue-script' in message:
+            print('Restarting experiment', flush=True)
+            logger.info('Restarting experiment')
+            self.state = RUNNING
+            await self._connect()
+
+    # timers
+
+    async def _every(self, interval, callback):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                self.fail(e)
+
+    async def _run_task(self, coroutine_function):
+        try:
+            await coroutine_function()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.fail(e)
+
+    # shutdown
+
+    def _on_sigint(self, signum, frame):
+        self.loop.call_soon_threadsafe(self.interrupt)
+
+    def interrupt(self):
+        if self._done.is_set():
+            return
+        if self.state != INTERRUPTED:
+            print('Ctrl-C detected, pausing experiment')
+            logger.warning('interrupt received, pausing experiment')
+            self.state = INTERRUPTED
+            self._pausing = asyncio.ensure_future(self._pause_interrupted())
+        else:
+            print('Second Ctrl-C detected, shutting down')
+            logger.warning('second interrupt received, terminating '
+                           'experiment')
+            asyncio.ensure_future(self._terminate())
+
+    async def _pause_interrupted(self):
+        await self._stop_experiment()
+        # stop receiving broadcasts
+        await self._disconnect()
+        print('Experiment paused. Press enter key to restart or hit '
+              'Ctrl-C again to terminate experiment', flush=True)
+
+    async def _terminate(self):
+        if self._terminating:
+            return
+        self._terminating = True
+        await self.loop.run_in_executor(None, self.worker.stop)
+        self._stop_all()
+        self.finish()
+
+    def fail(self, e):
+        if self._done.is_set():
+            return
+        logger.critical('exception %s stopped the experiment', e)
+        print('error "%s" stopped the experiment' % str(e))
+        traceback.print_exception(type(e), e, e.__traceback__,
+                                  file=sys.stdout)
+        asyncio.ensure_future(self._terminate())
+
+    def finish(self):
+        print('Experiment stopped, goodbye!')
+        logger.warning('experiment stopped, goodbye!')
+        self._done.set()
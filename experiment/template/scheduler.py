@@ -0,0 +1,153 @@
+import heapq
+import logging
+import itertools
+import threading
+
+import numpy as np
+
+logger = logging.getLogger('eVOLVER')
+
+
+class ScheduledAction:
+    """
+    An action of the Scheduler; cancel() drops it (and its repetitions).
+    """
+
+    def __init__(self, due, callback, vials, name, every):
+        self.due = due
+        self.callback = callback
+        self.vials = vials
+        self.name = name
+        self.every = every
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    One-shot and periodic actions for vials (e.g. temperature or stir
+    ramps), kept in a heap ordered by when they are due, in elapsed
+    experiment hours like the rest of the custom script. Only the top of
+    the heap is looked at until an action is due, so a long program costs
+    nothing between its steps.
+
+    Actions are called as callback(eVOLVER, vials, elapsed_time) from
+    run_due(), which the namespace calls at every broadcast and, between
+    broadcasts, whenever the runtime's timer finds an action due.
+
+    hold()/held() block an activity (e.g. 'pump') of vials until a given
+    time, as (vials,) arrays so controllers can mask vials in one step.
+    """
+
+    def __init__(self, vials, clock):
+        self.vials = vials
+        # clock() returns the current elapsed time
+        self.clock = clock
+        self.fired = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._holds = {}
+        self._lock = threading.Lock()
+
+    def at(self, when, callback, vials=None, name=None, every=None):
+        """
+        Runs callback at elapsed time when, then every 'every' hours if
+        given. vials (a vial, a list of vials or None) and name are passed
+        through to the callback and used by cancel().
+        """
+        action = ScheduledAction(when, callback, vials, name, every)
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._seq), action))
+        return action
+
+    def after(self, delay, callback, vials=None, name=None, every=None):
+        """
+        at() delay hours from now.
+        """
+        return self.at(self.clock() + delay, callback, vials, name, every)
+
+    def cancel(self, name=None, vials=None):
+        """
+        Cancels the pending actions with the given name and/or vials.
+        """
+        with self._lock:
+            for _, _, action in self._heap:
+                if ((name is None or action.name == name) and
+                        (vials is None or action.vials == vials)):
+                    action.cancelled = True
+
+    def pending(self, name=None):
+        with self._lock:
+            return [action for _, _, action in self._heap
+                    if not action.cancelled and
+                    (name is None or action.name == name)]
+
+    def next_due(self):
+        """
+        Elapsed time of the next action, None if there is none.
+        """
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def due(self, now):
+        next_due = self.next_due()
+        return next_due is not None and next_due <= now
+
+    def run_due(self, eVOLVER, now):
+        """
+        Runs the actions due at elapsed time now, in order; periodic ones
+        are rescheduled for their next period after now.
+        """
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return
+                due, _, action = heapq.heappop(self._heap)
+                if action.cancelled:
+                    continue
+                if action.every:
+                    # skip the periods missed while paused
+                    periods = int((now - due) // action.every) + 1
+                    action.due = due + periods * action.every
+                    heapq.heappush(self._heap,
+                                   (action.due, next(self._seq), action))
+            logger.debug('running scheduled %s for vials %s due at %.4f',
+                         action.name or 'action', action.vials, due)
+            self.fired += 1
+            action.callback(eVOLVER, action.vials, now)
+
+    def hold(self, vials, name, until):
+        """
+        Blocks activity name of vials until elapsed time until.
+        """
+        with self._lock:
+            holds = self._holds.setdefault(name,
+                                           np.full(self.vials, -np.inf))
+            holds[vials] = until
+
+    def held(self, name, now, vials=None):
+        """
+        Boolean array, True for the vials (all by default) whose activity
+        name is on hold at elapsed time now.
+        """
+        with self._lock:
+            holds = self._holds.get(name)
+            if holds is None:
+                held = np.zeros(self.vials, dtype=bool)
+            else:
+                held = now < holds
+        return held if vials is None else held[vials]
+
+
+def ramp(start, end, from_value, to_value, step):
+    """
+    Program (list of (elapsed_time, value)) going linearly from from_value
+    at elapsed time start to to_value at end, in steps of 'step' hours.
+    """
+    times = np.arange(start, end, step).tolist() + [end]
+    values = np.interp(times, [start, end], [from_value, to_value])
+    return list(zip(times, values.tolist()))
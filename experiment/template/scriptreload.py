@@ -0,0 +1,124 @@
+import os
+import sys
+import types
+import inspect
+import logging
+
+logger = logging.getLogger('eVOLVER')
+
+
+class ScriptReloader:
+    """
+    Watches the custom script and loads new versions of it while the
+    experiment runs. A new version is executed as a fresh module and only
+    replaces the running one if it passes validate(): it has to import
+    cleanly, keep the settings in fixed (e.g. EXP_NAME, which the data
+    directory depends on) and define every function in required with the
+    (eVOLVER, input_data, vials, elapsed_time) signature of the custom
+    functions. Otherwise the running version stays in place.
+
+    Only the script itself is reloaded, not the modules it imports, and
+    module level state of the old version is not carried over. Settings in
+    startup are only read when the experiment starts, a change to them is
+    reported but has no effect until the next start.
+    """
+
+    def __init__(self, path, module, required=(), fixed=(), startup=()):
+        self.path = path
+        self.module = module
+        self.required = list(required)
+        self.fixed = list(fixed)
+        self.startup = list(startup)
+        # number of versions loaded since the start
+        self.version = 0
+        self.source = None
+        self._stat = self._read_stat()
+
+    def _read_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def changed(self):
+        """
+        True once per change of the file on disk.
+        """
+        stat = self._read_stat()
+        if stat is None or stat == self._stat:
+            return False
+        self._stat = stat
+        return True
+
+    def functions(self, module):
+        """
+        Names of the custom functions required of a version of module.
+        """
+        names = list(self.required)
+        mode = getattr(module, 'OPERATION_MODE', None)
+        if isinstance(mode, str) and mode not in names:
+            names.append(mode)
+        return names
+
+    def validate(self, module):
+        """
+        List of the problems that keep module from replacing the running
+        version, empty if there are none.
+        """
+        problems = []
+        for name in self.fixed:
+            if getattr(module, name, None) != getattr(self.module, name,
+                                                      None):
+                problems.append('{0} cannot change while the experiment '
+                                'runs'.format(name))
+        for name in self.functions(module):
+            func = getattr(module, name, None)
+            if not callable(func):
+                problems.append('function {0} is missing'.format(name))
+                continue
+            try:
+                inspect.signature(func).bind(None, None, None, None)
+            except TypeError:
+                problems.append('function {0} does not take (eVOLVER, '
+                                'input_data, vials, elapsed_time)'.format(
+                                    name))
+            except ValueError:
+                pass
+        return problems
+
+    def load(self):
+        """
+        Executes the script on disk and returns the new module if it is
+        valid, else None. The source of the loaded version is kept in
+        source.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                source = f.read()
+            code = compile(source, self.path, 'exec')
+            module = types.ModuleType(self.module.__name__)
+            module.__file__ = self.path
+            exec(code, module.__dict__)
+        except Exception as e:
+            logger.error('could not load new version of %s, keeping the '
+                         'running one: %s: %s', self.path,
+                         type(e).__name__, e)
+            return None
+        problems = self.validate(module)
+        if problems:
+            logger.error('new version of %s is not valid, keeping the '
+                         'running one: %s', self.path, '; '.join(problems))
+            return None
+        for name in self.startup:
+            if getattr(module, name, None) != getattr(self.module, name,
+                                                      None):
+                logger.warning('%s changed in %s, it only takes effect '
+                               'when the experiment is restarted', name,
+                               self.path)
+        self.module = module
+        self.source = source
+        self.version += 1
+        sys.modules[module.__name__] = module
+        logger.info('loaded version %d of %s', self.version, self.path)
+        return module
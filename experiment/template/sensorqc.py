@@ -0,0 +1,164 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('eVOLVER')
+
+# raw ADC range of each kind of sensor, readings at either end are
+# saturated photodiodes/thermistors or disconnected sensors
+ADC_RANGES = {'od': (0, 65535), 'temp': (0, 4095)}
+# sensors that never read the same across all vials, unlike temperatures
+# of vials kept at the same setpoint
+STUCK_SENSORS = ['od']
+# checks in the order they are applied, a reading is counted against the
+# first one it fails
+CHECKS = ['missing', 'saturated', 'stuck', 'jump']
+
+
+class QCResult:
+    """
+    Outcome of SensorQC.check() for one broadcast: od_valid and temp_valid
+    are (vials,) masks of the readings that passed, rejected maps each
+    check to the vials it rejected a reading of (OD or temperature).
+    """
+
+    def __init__(self, od_valid, temp_valid, rejected):
+        self.od_valid = od_valid
+        self.temp_valid = temp_valid
+        self.rejected = rejected
+
+    @property
+    def valid(self):
+        return self.od_valid & self.temp_valid
+
+
+class SensorQC:
+    """
+    Quality checks of the raw sensor readings of a broadcast, run before
+    calibration on all vials at once:
+
+    missing    not a number (e.g. 'NaN' from the eVOLVER)
+    saturated  at or beyond the ends of the ADC range
+    stuck      every vial reporting the very same OD value, i.e. not
+               actual readings (cross-vial)
+    jump       more than 'jump' (relative) away from the median of the
+               vial's last 'history' accepted readings, e.g. a bubble or a
+               spike. A shift seen by at least 'common' of the vials at
+               once is taken as real (cross-vial), as is a new level that
+               persists for 'persist' broadcasts.
+
+    Rejected readings only invalidate their vial, the other vials carry on
+    with the broadcast, and the controllers decide on the valid readings
+    of their OD window (see controllers.window_median). Per-vial counts of
+    the rejections are kept in rejects, one (vials,) array per check.
+    """
+
+    def __init__(self, vials, history=5, jump=0.5, persist=3, common=0.75,
+                 ranges=ADC_RANGES):
+        self.vials = vials
+        self.history = history
+        self.jump = jump
+        self.persist = persist
+        self.common = common
+        self.ranges = ranges
+        self.rejects = dict((check, np.zeros(vials, dtype=int))
+                            for check in CHECKS)
+        # per sensor: last accepted readings, (vials, history) oldest first,
+        # and consecutive jumps of each vial
+        self._history = {}
+        self._jumps = {}
+
+    def check(self, od, temp, od_2=None):
+        """
+        Checks the raw od, temp (and od_2 for 3d fits) arrays of a broadcast.
+        """
+        rejected = dict((check, np.zeros(self.vials, dtype=bool))
+                        for check in CHECKS)
+        od_valid = self._check_sensor('od', 'od', od, rejected)
+        if od_2 is not None:
+            od_valid &= self._check_sensor('od', 'od_2', od_2, rejected)
+        temp_valid = self._check_sensor('temp', 'temp', temp, rejected)
+        for check, vials in rejected.items():
+            self.rejects[check] += vials
+        return QCResult(od_valid, temp_valid, rejected)
+
+    def _check_sensor(self, kind, name, raw, rejected):
+        raw = np.asarray(raw, dtype=np.float64)
+        low, high = self.ranges[kind]
+        missing = ~np.isfinite(raw)
+        with np.errstate(invalid='ignore'):
+            saturated = ~missing & ((raw <= low) | (raw >= high))
+        stuck = np.zeros(self.vials, dtype=bool)
+        if (kind in STUCK_SENSORS and self.vials > 1 and not missing.any()
+                and (raw == raw[0]).all()):
+            stuck[:] = True
+        jump = self._check_jumps(name, raw, ~(missing | saturated | stuck))
+        ok = np.ones(self.vials, dtype=bool)
+        for check, failed in (('missing', missing), ('saturated', saturated),
+                              ('stuck', stuck), ('jump', jump)):
+            # counted against the first check failed
+            failed = failed & ok
+            rejected[check] |= failed
+            ok &= ~failed
+        self._remember(name, raw, ok)
+        return ok
+
+    def _check_jumps(self, name, raw, ok):
+        history = self._history.get(name)
+        if history is None or not self.jump:
+            return np.zeros(self.vials, dtype=bool)
+        has_history = np.isfinite(history).any(axis=1)
+        reference = np.full(self.vials, np.nan)
+        if has_history.any():
+            reference[has_history] = np.nanmedian(history[has_history],
+                                                  axis=1)
+        checked = ok & has_history
+        jump = np.zeros(self.vials, dtype=bool)
+        jump[checked] = (np.abs(raw[checked] - reference[checked]) >
+                         self.jump * np.abs(reference[checked]))
+        if checked.sum() > 1 and jump.sum() >= self.common * checked.sum():
+            logger.info('%s readings of %d vials shifted at once, taking it '
+                        'as a real change', name, jump.sum())
+            jump[:] = False
+        consecutive = np.where(jump, self._jumps[name] + 1, 0)
+        persisting = consecutive >= self.persist
+        if persisting.any():
+            logger.info('%s readings of vials %s stayed at a new level, '
+                        'accepting it', name, np.flatnonzero(persisting))
+            history[persisting] = np.nan
+            jump &= ~persisting
+            consecutive[persisting] = 0
+        self._jumps[name] = consecutive
+        return jump
+
+    def _remember(self, name, raw, ok):
+        history = self._history.get(name)
+        if history is None:
+            history = np.full((self.vials, self.history), np.nan)
+            self._history[name] = history
+            self._jumps[name] = np.zeros(self.vials, dtype=int)
+        history[ok, :-1] = history[ok, 1:]
+        history[ok, -1] = raw[ok]
+
+    def reset(self, vials=None):
+        """
+        Forgets the reading history (of vials, all by default), e.g. after
+        a vial was refilled.
+        """
+        for name, history in self._history.items():
+            if vials is None:
+                history[:] = np.nan
+                self._jumps[name][:] = 0
+            else:
+                history[vials] = np.nan
+                self._jumps[name][vials] = 0
+
+    def report(self):
+        total = sum(self.rejects.values())
+        if not total.any():
+            logger.info('sensor QC: no readings rejected')
+            return
+        logger.info('sensor QC: readings rejected per vial: %s (%s)',
+                    total.tolist(), ', '.join(
+                        '{0} {1}'.format(check, int(counts.sum()))
+                        for check, counts in self.rejects.items()))
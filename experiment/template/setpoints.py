@@ -0,0 +1,106 @@
+import os
+import logging
+
+import numpy as np
+
+from datafiles import vial_file_path, last_row, read_complete_rows
+
+logger = logging.getLogger('eVOLVER')
+
+
+class SetpointState:
+    """
+    Current per-vial setpoints of a parameter (e.g. the temperatures in
+    temp_config/vialN_temp_config.txt), kept in memory.
+
+    The config files are read once by load(); set() writes a
+    "<elapsed_time>,<value>" row for every vial whose setpoint changed, so
+    the files keep their usual layout. Rows appended by others (custom
+    scripts, the GUI) are picked up by refresh(), which only stats the
+    files and parses what was appended to them.
+    """
+
+    def __init__(self, exp_dir, parameter, vials):
+        self.exp_dir = exp_dir
+        self.parameter = parameter
+        self.vials = list(vials)
+        self._values = np.full(len(self.vials), np.nan)
+        # bytes of each file accounted for in _values
+        self._sizes = [0] * len(self.vials)
+
+    def _path(self, vial):
+        return vial_file_path(self.exp_dir, vial, self.parameter)
+
+    def _reload(self, i):
+        path = self._path(self.vials[i])
+        row = last_row(path)
+        self._values[i] = np.nan if row is None else row[1]
+        self._sizes[i] = os.path.getsize(path)
+
+    def load(self):
+        for i in range(len(self.vials)):
+            self._reload(i)
+        logger.debug('loaded %s setpoints: %s', self.parameter, self._values)
+        return self.values
+
+    def refresh(self):
+        """
+        Applies the rows appended to the config files since they were last
+        read, e.g. by a custom script. Returns the vials whose setpoint
+        changed.
+        """
+        changed = []
+        for i, vial in enumerate(self.vials):
+            path = self._path(vial)
+            previous = self._values[i]
+            try:
+                if os.path.getsize(path) == self._sizes[i]:
+                    continue
+                rows, _, self._sizes[i] = read_complete_rows(
+                    path, self._sizes[i])
+                if len(rows):
+                    self._values[i] = rows[-1][1]
+            except ValueError:
+                # shorter than before, i.e. rewritten instead of appended to
+                logger.warning('%s was rewritten, reloading it', path)
+                self._reload(i)
+            except OSError as e:
+                logger.error('could not read %s: %s', path, e)
+                continue
+            value = self._values[i]
+            if value != previous and not (value != value and
+                                          previous != previous):
+                logger.info('%s setpoint for vial %d changed to %s in its '
+                            'config file', self.parameter, vial, value)
+                changed.append(vial)
+        return changed
+
+    @property
+    def values(self):
+        """
+        Read-only array of the current setpoints, one per vial.
+        """
+        values = self._values.view()
+        values.flags.writeable = False
+        return values
+
+    def set(self, values, elapsed_time, vials=None):
+        """
+        Updates the setpoints of the given vials (all vials by default) and
+        appends the changes to the config files.
+        """
+        self.refresh()
+        if vials is None:
+            vials = self.vials
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64),
+                                 (len(vials),))
+        for vial, value in zip(vials, values):
+            i = self.vials.index(vial)
+            if self._values[i] == value:
+                continue
+            with open(self._path(vial), 'a+') as f:
+                f.write("{0},{1}\n".format(elapsed_time, value))
+                self._sizes[i] = f.tell()
+            self._values[i] = value
+            logger.info('%s setpoint for vial %d changed to %s',
+                        self.parameter, vial, value)
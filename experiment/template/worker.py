@@ -0,0 +1,196 @@
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('eVOLVER')
+
+BROADCAST = 'broadcast'
+
+
+class BroadcastWorker:
+    """
+    Runs namespace callbacks on a single background thread, in the order
+    they were received, so the socket never waits on data processing.
+
+    At most max_pending broadcasts are queued per key (e.g. per eVOLVER
+    unit); when processing falls behind, the oldest queued broadcast is
+    dropped in favour of the newest, since the controllers only ever need
+    the latest readings. Other events
+    (e.g. calibrations) are never dropped. A broadcast that waited more than
+    late_after seconds before being processed is counted as late.
+
+    stage_times is an optional callable returning the {stage: seconds}
+    durations of the broadcast that was just processed, used to report the
+    lag of each stage relative to when the broadcast was received.
+    """
+
+    def __init__(self, max_pending=1, late_after=5, stage_times=None,
+                 on_error=None):
+        self.max_pending = max_pending
+        self.late_after = late_after
+        self.stage_times = stage_times
+        self.on_error = on_error
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.late = 0
+        self.lag = {}
+        self.max_lag = 0.0
+        self._queue = deque()
+        self._pending = {}
+        self._busy = False
+        self._halted = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._halted = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def submit(self, event, callback, args, key=None):
+        """
+        Queues callback(*args); safe to call from any thread.
+        """
+        with self._condition:
+            if self._halted:
+                return
+            if event == BROADCAST:
+                self.received += 1
+                if self._pending.get(key, 0) >= self.max_pending:
+                    self._drop_oldest_broadcast(key)
+                self._pending[key] = self._pending.get(key, 0) + 1
+            self._queue.append((event, callback, args, key, time.monotonic()))
+            self._condition.notify()
+
+    def _drop_oldest_broadcast(self, key):
+        for i, item in enumerate(self._queue):
+            if item[0] == BROADCAST and item[3] == key:
+                del self._queue[i]
+                self._pending[key] -= 1
+                self.dropped += 1
+                logger.warning('processing is falling behind, dropped a '
+                               'stale broadcast (%d so far)', self.dropped)
+                return
+
+    def take_broadcasts(self, callback):
+        """
+        Removes the queued broadcasts for callback and returns their
+        (arguments, received) pairs, for callbacks that process several
+        broadcasts at once; they pass received to record() once each
+        broadcast is processed. Broadcasts queued after another event of
+        their key (e.g. new calibrations of that unit), or after an event of
+        no key in particular, are left to be processed after it.
+        """
+        taken = []
+        with self._condition:
+            kept = deque()
+            blocked = set()
+            for item in self._queue:
+                event, item_callback, args, key, received = item
+                if (event == BROADCAST and item_callback == callback and
+                        key not in blocked and None not in blocked):
+                    taken.append((args, received))
+                    self._pending[key] -= 1
+                    continue
+                if event != BROADCAST:
+                    blocked.add(key)
+                kept.append(item)
+            self._queue = kept
+        return taken
+
+    def discard_broadcasts(self):
+        """
+        Forgets the broadcasts still waiting, e.g. when pausing.
+        """
+        with self._condition:
+            self._queue = deque(item for item in self._queue
+                                if item[0] != BROADCAST)
+            self._pending = {}
+
+    def wait_idle(self, timeout=None):
+        """
+        Blocks until the queue is empty and nothing is being processed.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._busy and (self._halted or not self._queue),
+                timeout)
+
+    def stop(self, timeout=None):
+        """
+        Finishes the callback in progress, drops whatever is still queued
+        and stops the thread.
+        """
+        with self._condition:
+            self._halted = True
+            self._queue.clear()
+            self._pending = {}
+            self._condition.notify_all()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._halted or self._queue)
+                if self._halted:
+                    return
+                event, callback, args, key, received = self._queue.popleft()
+                if event == BROADCAST:
+                    self._pending[key] -= 1
+                self._busy = True
+            try:
+                start = time.monotonic()
+                callback(*args)
+                if event == BROADCAST:
+                    self.record(received, start)
+            except Exception as e:
+                with self._condition:
+                    self._halted = True
+                    self._queue.clear()
+                if self.on_error is not None:
+                    self.on_error(e)
+                else:
+                    logger.exception('error processing %s', event)
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def record(self, received, start):
+        """
+        Accounts for a broadcast received (time.monotonic()) at 'received'
+        whose processing started at 'start': lag, late broadcasts and the
+        processed count.
+        """
+        waited = start - received
+        self.processed += 1
+        if waited > self.late_after:
+            self.late += 1
+            logger.warning('broadcast processed %.1f s after it was '
+                           'received', waited)
+        lag = {'queue': waited}
+        elapsed = waited
+        if self.stage_times is not None:
+            for stage, seconds in self.stage_times().items():
+                elapsed += seconds
+                lag[stage] = elapsed
+        total = time.monotonic() - received
+        lag['total'] = total
+        self.lag = lag
+        self.max_lag = max(self.max_lag, total)
+
+    def report(self):
+        """
+        Logs the broadcast counters and the lag of the last broadcast.
+        """
+        lag = ', '.join('%s %.3f s' % item for item in self.lag.items())
+        logger.info('broadcasts: %d received, %d processed, %d dropped, '
+                    '%d late; lag of last broadcast: %s; max lag %.3f s',
+                    self.received, self.processed, self.dropped, self.late,
+                    lag or 'n/a', self.max_lag)
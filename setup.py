@@ -16,13 +16,18 @@ setup(
     author='Fynch Biosciencese',
     author_email='brandon@fynchbio.com',
     install_requires=reqs,
+    # asyncio.run() and get_running_loop() of experiment/template/runtime.py
+    python_requires='>=3.7',
     classifiers=(
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Software Development :: Libraries',
         'Topic :: Utilities',
     ),
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from calibrations import (CalibrationEngine, CalibrationStore, apply_fit,
+                          compile_fit, LINEAR, SIGMOID)
+
+VIALS = 16
+TEMP_CAL = {'type': LINEAR, 'params': ['temp'],
+            'coefficients': [[-0.02, 62.0]] * VIALS}
+SIGMOID_CAL = {'type': SIGMOID, 'params': ['od_135'],
+               'coefficients': [[62721, 1000, 0.5, -2]] * VIALS}
+PUMP_CAL = {'params': ['pump'], 'coefficients': [1.0] * 48}
+
+
+def linear_od_cal():
+    return {'type': LINEAR, 'params': ['od_135'],
+            'coefficients': [[0.0001, -1]] * VIALS}
+
+
+def test_apply_fit_linear_over_timepoints():
+    fit = linear_od_cal()
+    raw = np.array([[10000, 20000]] * VIALS, dtype=float)
+    od = apply_fit(fit['type'], compile_fit(fit), raw)
+    assert od.shape == (VIALS, 2)
+    assert np.allclose(od[0], [0, 1])
+
+
+def test_live_engine_keeps_rejecting_linear_od_fits():
+    engine = CalibrationEngine(linear_od_cal(), TEMP_CAL)
+    assert np.isnan(engine.od(np.full(VIALS, 10000.0))).all()
+
+
+def test_live_engine_sigmoid_matches_apply_fit():
+    fit = SIGMOID_CAL
+    engine = CalibrationEngine(fit, TEMP_CAL)
+    raw = np.linspace(5000, 50000, VIALS)
+    assert np.array_equal(engine.od(raw),
+                          apply_fit(SIGMOID, compile_fit(fit), raw))
+
+
+def write_json(path, data, mtime_ns):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    # the mtime is what tells the store a file changed
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def make_store(tmp_path, od_cal=None):
+    paths = {kind: str(tmp_path / '{0}_cal.json'.format(kind))
+             for kind in ('od', 'temp', 'pump')}
+    write_json(paths['od'], od_cal or SIGMOID_CAL, 10**18)
+    write_json(paths['temp'], TEMP_CAL, 10**18)
+    write_json(paths['pump'], PUMP_CAL, 10**18)
+    store = CalibrationStore(paths, check_interval=3600)
+    store.refresh()
+    return store
+
+
+def test_store_loads_all_calibrations(tmp_path):
+    store = make_store(tmp_path)
+    assert store.ready() and store.missing() == []
+    assert store.fit('od') == SIGMOID_CAL
+    assert store.flow_rate().tolist() == PUMP_CAL['coefficients']
+
+
+def test_store_reloads_files_whose_mtime_changed(tmp_path):
+    store = make_store(tmp_path)
+    engine = store.engine()
+    fit = dict(SIGMOID_CAL, coefficients=[[62721, 2000, 0.5, -2]] * VIALS)
+    write_json(store.paths['od'], fit, 2 * 10**18)
+
+    # within check_interval nothing is looked at
+    store.refresh()
+    assert store.fit('od') == SIGMOID_CAL
+    store.refresh(force=True)
+    assert store.fit('od') == fit
+    assert store.engine() is not engine
+
+
+def test_store_discards_invalid_files(tmp_path):
+    store = make_store(tmp_path)
+    write_json(store.paths['od'], dict(SIGMOID_CAL, params=[]), 2 * 10**18)
+    store.refresh(force=True)
+    assert not store.ready()
+    assert store.missing() == ['od']
+
+    # a missing calibration is looked for on every call
+    write_json(store.paths['od'], SIGMOID_CAL, 3 * 10**18)
+    store.refresh()
+    assert store.ready()
+
+
+def test_store_update_installs_and_persists(tmp_path):
+    store = make_store(tmp_path)
+    fit = dict(PUMP_CAL, coefficients=[2.0] * 48)
+    assert store.update('pump', fit)
+    assert store.flow_rate().tolist() == [2.0] * 48
+    with open(store.paths['pump']) as f:
+        assert json.load(f) == fit
+    # the file the store just wrote is not read again
+    store.refresh(force=True)
+    assert store.fit('pump') is fit
+
+    assert not store.update('od', dict(SIGMOID_CAL, params=[]))
+    assert store.missing() == ['od']
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+eVOLVER = pytest.importorskip('eVOLVER')
+from controllerstate import JOURNALS
+from datafiles import vial_file_path
+
+VIALS = eVOLVER.VIALS
+
+
+class FakeIO:
+    _url = 'fake'
+
+
+def make_namespace(data_dir):
+    namespace = eVOLVER.EvolverNamespace(FakeIO(), '/dpu-evolver')
+    namespace.data_dir = data_dir
+    namespace.initialize()
+    return namespace
+
+
+def write(path, text, mode='a'):
+    with open(path, mode) as f:
+        f.write(text)
+
+
+def make_experiment(tmp_path):
+    data_dir = str(tmp_path)
+    for parameter in ['OD', 'temp'] + JOURNALS:
+        os.makedirs(os.path.join(data_dir, parameter))
+        for x in VIALS:
+            row = '0,0\n' if parameter != 'chemo_config' else '0,0,0\n'
+            write(vial_file_path(data_dir, x, parameter),
+                  'Experiment: test vial {0}\n'.format(x) + row, 'w')
+    namespace = make_namespace(data_dir)
+    namespace.start_time = 0
+    namespace.OD_initial = np.zeros(len(VIALS))
+    namespace.controller_state.load()
+    namespace.load_ring_buffers()
+    for x in VIALS:
+        namespace.growth_rate.reset(x, 0)
+    for i in range(1, 4):
+        od = np.full(len(VIALS), 0.1 * i)
+        namespace.ring_buffers['OD'].append(i / 60, od)
+        namespace.growth_rate.update(i / 60, od)
+        namespace.save_data(od, i / 60, VIALS, 'OD')
+    namespace.save_checkpoint()
+    return namespace
+
+
+def test_restore_applies_rows_written_after_the_checkpoint(tmp_path):
+    namespace = make_experiment(tmp_path)
+    write(vial_file_path(str(tmp_path), 2, 'OD'), '0.0667,0.4\n')
+    write(vial_file_path(str(tmp_path), 2, 'ODset'), '0.06,0.3\n')
+
+    resumed = make_namespace(str(tmp_path))
+    assert resumed.restore_checkpoint(resumed.checkpointer.load())
+    assert resumed.controller_state.odset[2] == 0.3
+    assert resumed.growth_rate.n[2] == 1
+    assert resumed.growth_rate.n[3] == namespace.growth_rate.n[3] == 3
+    assert resumed.recent('OD', 1)[2, 0] == 0.4
+
+
+def test_failed_restore_leaves_the_state_untouched(tmp_path):
+    make_experiment(tmp_path)
+    # vial 0 got rows after the checkpoint, vial 5's OD file shrank
+    write(vial_file_path(str(tmp_path), 0, 'OD'), '0.0667,0.4\n')
+    write(vial_file_path(str(tmp_path), 0, 'ODset'), '0.06,0.3\n')
+    write(vial_file_path(str(tmp_path), 5, 'OD'),
+          'Experiment: test vial 5\n', 'w')
+
+    resumed = make_namespace(str(tmp_path))
+    state = resumed.controller_state
+    assert not resumed.restore_checkpoint(resumed.checkpointer.load())
+    assert resumed.controller_state is state
+    assert not resumed.controller_state.odset.any()
+    assert not resumed.growth_rate.n.any()
+    assert np.isnan(resumed.growth_rate.start).all()
+    assert not resumed.ring_buffers['OD'].count.any()
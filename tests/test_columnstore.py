@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from columnstore import ColumnStore, HEADER
+
+VIALS = 4
+
+
+def fill(store, parameter, rows):
+    for i in range(rows):
+        store.append(parameter, i / 60, np.arange(VIALS) + i)
+    store.commit()
+
+
+def test_rows_round_trip(tmp_path):
+    store = ColumnStore(str(tmp_path), VIALS)
+    fill(store, 'OD', 3)
+    store.close()
+
+    times, values = ColumnStore(str(tmp_path), VIALS).series('OD')
+    assert np.allclose(times, [0, 1 / 60, 2 / 60])
+    assert values.tolist() == [[0, 1, 2, 3], [1, 2, 3, 4], [2, 3, 4, 5]]
+    assert store.parameters() == ['OD']
+
+
+def test_partial_row_is_truncated_on_open(tmp_path):
+    store = ColumnStore(str(tmp_path), VIALS)
+    fill(store, 'OD', 2)
+    store.close()
+    # a crash in the middle of a write
+    with open(store.path('OD'), 'ab') as f:
+        f.write(b'\0' * 5)
+
+    store = ColumnStore(str(tmp_path), VIALS)
+    fill(store, 'OD', 1)
+    store.close()
+    assert os.path.getsize(store.path('OD')) == HEADER.size + 3 * 8 * (VIALS + 1)
+    _, values = store.series('OD')
+    assert values[:, 0].tolist() == [0, 1, 0]
+
+
+def test_other_vial_count_is_rejected(tmp_path):
+    store = ColumnStore(str(tmp_path), VIALS)
+    fill(store, 'OD', 1)
+    store.close()
+    with pytest.raises(ValueError):
+        ColumnStore(str(tmp_path), 16).read('OD')
+
+
+def test_export_text_writes_the_legacy_files(tmp_path):
+    store = ColumnStore(str(tmp_path), VIALS)
+    fill(store, 'OD', 2)
+    store.append('od_135_raw', 0.5, [1000, 2000, 3000, 4000.5])
+    store.close()
+
+    out_dir = str(tmp_path / 'export')
+    store.export_text('OD', out_dir, header='Experiment: test vial {0}')
+    with open(os.path.join(out_dir, 'vial1_OD.txt')) as f:
+        assert f.read() == ('Experiment: test vial 1\n'
+                            '0.0,1.0\n0.016666666666666666,2.0\n')
+    store.export_text('od_135_raw', out_dir)
+    with open(os.path.join(out_dir, 'vial0_od_135_raw.txt')) as f:
+        assert f.read() == '0.5,1000\n'
+    with open(os.path.join(out_dir, 'vial3_od_135_raw.txt')) as f:
+        assert f.read() == '0.5,4000.5\n'
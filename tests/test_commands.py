@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from commands import CommandCoalescer, UNCHANGED
+
+
+def make_coalescer(min_interval=0):
+    sent = []
+    return CommandCoalescer(sent.append, min_interval), sent
+
+
+def config(**values):
+    return dict((param, {'value': value}) for param, value in values.items())
+
+
+def test_commands_of_a_cycle_are_merged_vial_by_vial():
+    coalescer, sent = make_coalescer()
+    coalescer.begin(config(temp=['3000'] * 4))
+    coalescer.send('temp', ['2900', UNCHANGED, UNCHANGED, UNCHANGED])
+    coalescer.send('temp', [UNCHANGED, '2800', UNCHANGED, UNCHANGED])
+    coalescer.send('temp', ['2950', UNCHANGED, UNCHANGED, UNCHANGED],
+                   immediate=True)
+    assert sent == []
+    coalescer.flush()
+    assert len(sent) == 1
+    assert sent[0]['value'] == ['2950', '2800', UNCHANGED, UNCHANGED]
+    assert sent[0]['immediate']
+    assert coalescer.merged == 2
+
+
+def test_commands_matching_the_config_are_suppressed():
+    coalescer, sent = make_coalescer()
+    coalescer.begin(config(stir=[8, 8]))
+    coalescer.send('stir', ['8', UNCHANGED])
+    coalescer.send('pump', [UNCHANGED] * 4, recurring=False)
+    coalescer.flush()
+    assert sent == []
+    assert coalescer.suppressed == 2
+
+    coalescer.begin(config(stir=[8, 8]))
+    coalescer.send('stir', ['8', '10'])
+    coalescer.flush()
+    assert [command['value'] for command in sent] == [['8', '10']]
+
+
+def test_recurring_commands_are_deferred_within_min_interval():
+    coalescer, sent = make_coalescer(min_interval=3600)
+    coalescer.begin(config(temp=['3000', '3000']))
+    coalescer.send('temp', ['2900', UNCHANGED])
+    coalescer.flush()
+    coalescer.begin(config(temp=['2900', '3000']))
+    coalescer.send('temp', [UNCHANGED, '2900'])
+    # one-shot pump commands are never held back
+    coalescer.send('pump', ['5', UNCHANGED], recurring=False)
+    coalescer.flush()
+    assert [command['param'] for command in sent] == ['temp', 'pump']
+    assert coalescer.deferred == 1
+
+    # still pending, merged into the next cycle once the interval is over
+    coalescer._last_emit[('temp', True)] -= 3600
+    coalescer.begin(config(temp=['2900', '3000']))
+    coalescer.send('temp', ['2800', UNCHANGED])
+    coalescer.flush()
+    assert sent[-1]['value'] == ['2800', '2900']
+
+
+def test_commands_outside_a_cycle_go_out_right_away():
+    coalescer, sent = make_coalescer()
+    coalescer.send('pump', ['5|60'], fields_expected_incoming=49)
+    assert len(sent) == 1
+    assert sent[0]['fields_expected_incoming'] == 49
@@ -0,0 +1,130 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+import controllers
+from controllerstate import ControllerState
+from ringbuffer import VialRingBuffer
+
+VIALS = 16
+HISTORY = 6
+
+
+class FakeEvolver:
+    """
+    What ControllerInputs reads from the eVOLVER namespace.
+    """
+
+    def __init__(self, ods):
+        self.experiment_params = None
+        self.ring_buffer = VialRingBuffer(VIALS, HISTORY)
+        for i, od in enumerate(ods):
+            self.ring_buffer.append(i / 60, od)
+        self.controller_state = ControllerState(None, VIALS, None)
+
+    def recent(self, parameter, n):
+        return self.ring_buffer.recent(n)
+
+    def get_flow_rate(self):
+        return [1.0] * 48
+
+
+def od_history(rejected=()):
+    # 6 broadcasts at OD 0.5, with the readings of (broadcast, vial) in
+    # rejected set to NaN like the sensor QC does
+    ods = np.full((HISTORY, VIALS), 0.5)
+    for broadcast, vial in rejected:
+        ods[broadcast, vial] = np.nan
+    return ods
+
+
+def chemostat_step(ods, chemo_rate=None):
+    evolver = FakeEvolver(ods)
+    if chemo_rate is not None:
+        evolver.controller_state.chemo_rate[:] = chemo_rate
+    inputs = controllers.ControllerInputs(evolver, range(VIALS), 1.0,
+                                          HISTORY)
+    chemostat = controllers.Chemostat()
+    chemostat.configure(inputs, 0.5, 0, 0.1, 0.5, 25)
+    step = chemostat.step(inputs)
+    return step, controllers.ChemostatProgram().encode(
+        inputs.vials, step.bolus_in_s, step.period)
+
+
+def test_window_median_ignores_rejected_readings():
+    history = np.array([[1, 2, np.nan, 3, 4, 5],
+                        [1, np.nan, np.nan, np.nan, 4, 5],
+                        [1, 2, 3, 4, 5, 6]], dtype=float)
+    median, known = controllers.window_median(history)
+    assert known.tolist() == [True, False, True]
+    assert median[0] == 3
+    assert np.isnan(median[1])
+    assert median[2] == np.median(history[2])
+
+
+def test_chemostat_keeps_running_through_a_rejected_reading():
+    step, value = chemostat_step(od_history(), chemo_rate=144)
+    assert step.active.all()
+    running = value[3]
+
+    step, value = chemostat_step(od_history(rejected=[(5, 3)]),
+                                 chemo_rate=144)
+    assert step.active[3]
+    assert value[3] == running
+    assert value[3 + controllers.EFFLUX_OFFSET] != '0|0'
+
+
+def test_chemostat_leaves_undecided_vials_alone():
+    # most of vial 3's window rejected: no decision, neither a new program
+    # nor a stop
+    rejected = [(i, 3) for i in range(4)]
+    step, value = chemostat_step(od_history(rejected), chemo_rate=144)
+    assert not step.active[3] and not step.changed[3]
+    assert value[3] == controllers.UNCHANGED
+    assert value[3 + controllers.EFFLUX_OFFSET] == controllers.UNCHANGED
+    assert value[4] != controllers.UNCHANGED
+
+
+def test_chemostat_stops_vials_below_start_od():
+    ods = od_history()
+    ods[:, 3] = 0.05
+    step, value = chemostat_step(ods, chemo_rate=144)
+    assert value[3] == '0|0'
+
+
+def test_turbidostat_dilutes_through_a_rejected_reading():
+    ods = od_history(rejected=[(5, 3)])
+    inputs = controllers.ControllerInputs(FakeEvolver(ods), range(VIALS),
+                                          1.0, HISTORY)
+    lower = np.full(VIALS, 0.2)
+    upper = np.full(VIALS, 0.4)
+    step = controllers.turbidostat(inputs, lower, upper, 25)
+    assert step.average_od[3] == 0.5
+    assert step.influx[3] > 0
+    assert step.influx[3] == step.influx[4]
+
+
+def test_dilution_rounded_to_no_influx_is_still_sent():
+    # lower and upper thresholds equal: just above them, the influx time
+    # rounds to 0 but the vial is still diluted, as it always was
+    ods = od_history()
+    ods[:, 3] = 0.20001
+    inputs = controllers.ControllerInputs(FakeEvolver(ods), range(VIALS),
+                                          1.0, HISTORY)
+    thresholds = np.full(VIALS, 0.2)
+    step = controllers.turbidostat(inputs, thresholds, thresholds, 25)
+    message = controllers.pump_message(inputs.vials, step.influx,
+                                       step.efflux)
+    assert step.influx[3] == 0
+    assert message[3] == '0.0'
+    assert message[3 + controllers.EFFLUX_OFFSET] == '5.0'
+
+
+def test_pump_message_leaves_vials_without_pump_times_alone():
+    message = controllers.pump_message([0, 1], [0.0, 0.0], [0.0, 5.0])
+    assert message[0] == message[controllers.EFFLUX_OFFSET] == '--'
+    assert message[1] == '0.0'
@@ -0,0 +1,97 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from controllerstate import ControllerState, JOURNALS
+from datafiles import DataWriter, vial_file_path
+
+VIALS = 2
+
+
+def make_state(tmp_path):
+    exp_dir = str(tmp_path)
+    for parameter in JOURNALS:
+        os.makedirs(os.path.join(exp_dir, parameter))
+        for x in range(VIALS):
+            with open(vial_file_path(exp_dir, x, parameter), 'w') as f:
+                f.write('Experiment: test vial {0}\n'.format(x))
+                if parameter == 'ODset':
+                    f.write('0,0\n')
+                else:
+                    f.write('0,0,0\n')
+    state = ControllerState(exp_dir, VIALS, DataWriter())
+    state.load()
+    return state
+
+
+def append(state, vial, parameter, text):
+    with open(vial_file_path(state.exp_dir, vial, parameter), 'a') as f:
+        f.write(text)
+
+
+def test_own_rows_are_not_applied_twice(tmp_path):
+    state = make_state(tmp_path)
+    state.set_odset(0, 1.0, 0.4)
+    state.log_pump(1, 1.0, 5)
+    state.writer.commit()
+    assert state.refresh() == []
+    assert state.odset_lines.tolist() == [3, 2]
+    assert state.odset[0] == 0.4 and state.last_pump[1] == 1.0
+
+
+def test_rows_appended_by_others_are_picked_up(tmp_path):
+    state = make_state(tmp_path)
+    state.set_odset(0, 1.0, 0.4)
+    state.writer.commit()
+    # a custom script writing to the files itself, like the old template
+    append(state, 0, 'ODset', '2.0,0.2\n')
+    append(state, 1, 'pump_log', '2.0,3\n')
+    append(state, 1, 'chemo_config', '2.0,1,0.5\n')
+    assert state.refresh() == [0]
+    assert state.odset[0] == 0.2 and state.odset_time[0] == 2.0
+    assert state.odset_lines.tolist() == [4, 2]
+    assert state.last_pump[1] == 2.0
+    assert state.chemo_rate[1] == 0.5
+    assert state.refresh() == []
+
+
+def test_partial_rows_wait_for_the_next_refresh(tmp_path):
+    state = make_state(tmp_path)
+    append(state, 1, 'ODset', '2.0,0.')
+    assert state.refresh() == []
+    assert state.odset[1] == 0
+    append(state, 1, 'ODset', '3\n')
+    assert state.refresh() == [1]
+    assert state.odset[1] == 0.3
+    assert state.odset_lines[1] == 3
+
+
+def test_rewritten_journal_is_reloaded(tmp_path):
+    state = make_state(tmp_path)
+    state.set_odset(0, 1.0, 0.4)
+    state.writer.commit()
+    with open(vial_file_path(state.exp_dir, 0, 'ODset'), 'w') as f:
+        f.write('Experiment: test vial 0\n0,0.1\n')
+    assert state.refresh() == [0]
+    assert state.odset[0] == 0.1
+    assert state.odset_lines[0] == 2
+
+
+def test_restore_applies_rows_after_the_snapshot(tmp_path):
+    state = make_state(tmp_path)
+    snapshot = state.snapshot()
+    sizes = dict((parameter, [os.path.getsize(vial_file_path(
+        state.exp_dir, x, parameter)) for x in range(VIALS)])
+        for parameter in JOURNALS)
+    state.set_odset(1, 1.0, 0.4)
+    state.writer.commit()
+
+    restored = ControllerState(state.exp_dir, VIALS, DataWriter())
+    restored.restore(snapshot, sizes)
+    assert restored.refresh() == [1]
+    assert np.array_equal(restored.odset, state.odset)
+    assert np.array_equal(restored.odset_lines, state.odset_lines)
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+import datafiles
+from datafiles import DataWriter, SYNC_BROADCAST, SYNC_INTERVAL, SYNC_SHUTDOWN
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    synced = []
+    real = os.fsync
+
+    def fsync(fd):
+        synced.append(fd)
+        real(fd)
+    monkeypatch.setattr(datafiles.os, 'fsync', fsync)
+    return synced
+
+
+def test_rows_are_written_on_commit(tmp_path):
+    path = str(tmp_path / 'vial0_OD.txt')
+    writer = DataWriter()
+    writer.append_row(path, [0.5, 0.1])
+    writer.append(path, '1.0,0.2\n')
+    assert not os.path.exists(path)
+    writer.commit()
+    assert read(path) == '0.5,0.1\n1.0,0.2\n'
+    writer.close()
+
+
+def test_least_recently_used_handles_are_closed(tmp_path):
+    paths = [str(tmp_path / 'vial{0}_OD.txt'.format(x)) for x in range(3)]
+    writer = DataWriter(max_open_files=2)
+    for path in paths:
+        writer.append_row(path, [0])
+        writer.commit()
+    assert list(writer._files) == paths[1:]
+
+    # using a file makes it the most recent one
+    writer.append_row(paths[1], [1])
+    writer.commit()
+    writer.append_row(paths[0], [1])
+    writer.commit()
+    assert list(writer._files) == [paths[1], paths[0]]
+    writer.close()
+    assert [read(path) for path in paths] == ['0\n1\n', '0\n1\n', '0\n']
+
+
+def test_release_drops_pending_rows_and_the_handle(tmp_path):
+    path = str(tmp_path / 'vial0_OD.txt')
+    writer = DataWriter()
+    writer.append_row(path, [0])
+    writer.commit()
+    writer.append_row(path, [1])
+    writer.release(path)
+    assert path not in writer._files
+    # e.g. recreated with a new header
+    with open(path, 'w') as f:
+        f.write('header\n')
+    writer.close()
+    assert read(path) == 'header\n'
+
+
+def test_broadcast_policy_syncs_every_commit(tmp_path, fsyncs):
+    writer = DataWriter(SYNC_BROADCAST)
+    writer.append_row(str(tmp_path / 'a.txt'), [0])
+    writer.commit()
+    assert len(fsyncs) == 1
+    writer.close()
+
+
+def test_interval_policy_syncs_after_the_interval(tmp_path, fsyncs):
+    writer = DataWriter(SYNC_INTERVAL, sync_interval=3600)
+    writer.append_row(str(tmp_path / 'a.txt'), [0])
+    writer.commit()
+    assert fsyncs == []
+    writer._last_sync -= 3600
+    writer.commit()
+    assert len(fsyncs) == 1
+    writer.close()
+
+
+def test_shutdown_policy_syncs_on_close(tmp_path, fsyncs):
+    writer = DataWriter(SYNC_SHUTDOWN)
+    for name in ('a.txt', 'b.txt'):
+        writer.append_row(str(tmp_path / name), [0])
+    writer.commit()
+    assert fsyncs == []
+    writer.close()
+    assert len(fsyncs) == 2
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        DataWriter('never')
+
+
+def test_open_file_budget_splits_the_limit(monkeypatch):
+    resource = pytest.importorskip('resource')
+    monkeypatch.setattr(resource, 'getrlimit', lambda _: (1024, 4096))
+    assert datafiles.open_file_budget() == 256
+    assert datafiles.open_file_budget(4) == 128
+    assert datafiles.open_file_budget(100) == 16
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from growthrate import GrowthRateEstimator
+
+stats = pytest.importorskip('scipy.stats')
+
+VIALS = 3
+
+
+def growth_curve(rate, n=120, start=10.0):
+    rng = np.random.default_rng(0)
+    times = start + np.arange(n) / 60
+    od = 0.05 * np.exp(rate * (times - start)) * rng.normal(1, 0.01, n)
+    return times, od
+
+
+def test_slope_matches_linregress():
+    estimator = GrowthRateEstimator(VIALS)
+    times, od = growth_curve(0.8)
+    for vial in range(VIALS):
+        estimator.reset(vial, times[0] - 0.5)
+    for t, value in zip(times, od):
+        estimator.update(t, [value, value * 2, value])
+    expected = stats.linregress(times, np.log(od)).slope
+    assert estimator.slope(0) == pytest.approx(expected, rel=1e-9)
+    assert estimator.slope(1) == pytest.approx(expected, rel=1e-9)
+    window = stats.linregress(times[-60:], np.log(od[-60:])).slope
+    assert estimator.rolling[0] == pytest.approx(window, rel=1e-9)
+
+
+def test_points_before_the_start_and_invalid_od_are_skipped():
+    estimator = GrowthRateEstimator(VIALS)
+    times, od = growth_curve(0.5)
+    estimator.reset(0, times[40])
+    estimator.reset(1, times[0] - 1)
+    for t, value in zip(times, od):
+        estimator.update(t, [value, value, value])
+    estimator.update(times[-1] + 1 / 60, [np.nan, -0.1, 0.1])
+
+    expected = stats.linregress(times[41:], np.log(od[41:])).slope
+    assert estimator.slope(0) == pytest.approx(expected, rel=1e-9)
+    assert estimator.slope(1) == pytest.approx(
+        stats.linregress(times, np.log(od)).slope, rel=1e-9)
+    # no curve started
+    assert np.isnan(estimator.slope(2))
+
+
+def test_add_matches_update_and_restore():
+    times, od = growth_curve(0.3)
+    online = GrowthRateEstimator(1)
+    online.reset(0, times[0] - 1)
+    for t, value in zip(times, od):
+        online.update(t, [value])
+
+    batch = GrowthRateEstimator(1)
+    batch.reset(0, times[0] - 1)
+    batch.add(0, times[:60], od[:60])
+    restored = GrowthRateEstimator(1)
+    restored.restore(batch.snapshot())
+    restored.add(0, times[60:], od[60:])
+    restored.fill_history(0, np.column_stack([times, od]))
+    assert restored.tracking(0, times[0] - 1)
+    assert restored.slope(0) == pytest.approx(online.slope(0), rel=1e-9)
+    assert restored.rolling[0] == pytest.approx(online.rolling[0], rel=1e-9)
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from logpipeline import LogPipeline
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Stands in for the file handler: remembers what it wrote and from
+    which thread.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.threads.add(threading.current_thread())
+
+    def wait(self, n, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.messages) < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.messages
+
+    def flush(self):
+        self.threads.add(threading.current_thread())
+
+
+def make_logger(pipeline):
+    logger = logging.getLogger('test_logpipeline.%d' % id(pipeline))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(pipeline.handler)
+    return logger
+
+
+def test_queued_flush_writes_everything_on_the_listener():
+    target = RecordingHandler()
+    pipeline = LogPipeline(target, queued=True)
+    pipeline.start()
+    logger = make_logger(pipeline)
+    for i in range(100):
+        logger.info('record %d', i)
+    assert target.messages == []
+
+    pipeline.flush()
+    # the records queued before the flush are all written with it
+    assert target.wait(100) == ['record %d' % i for i in range(100)]
+    assert threading.current_thread() not in target.threads
+    pipeline.stop()
+
+
+def test_errors_are_written_without_waiting_for_a_flush():
+    target = RecordingHandler()
+    pipeline = LogPipeline(target, queued=True)
+    pipeline.start()
+    logger = make_logger(pipeline)
+    logger.info('before')
+    logger.error('failed')
+    assert target.wait(2) == ['before', 'failed']
+    pipeline.stop()
+
+
+def test_stop_drains_the_queue_and_can_be_repeated():
+    target = RecordingHandler()
+    pipeline = LogPipeline(target, queued=True)
+    pipeline.start()
+    logger = make_logger(pipeline)
+    logger.info('last words')
+    pipeline.stop()
+    assert target.messages == ['last words']
+    pipeline.stop()
+    # nothing left to ask for once stopped
+    pipeline.flush()
+
+
+def test_direct_mode_writes_right_away():
+    target = RecordingHandler()
+    pipeline = LogPipeline(target)
+    pipeline.start()
+    make_logger(pipeline).info('now')
+    assert target.messages == ['now']
+    pipeline.stop()
@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from metrics import Histogram, Metrics, MetricsServer, render_prometheus
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.01, 0.1, 1))
+    for seconds in [0.005, 0.01, 0.05, 0.5, 3]:
+        histogram.observe(seconds)
+    assert histogram.cumulative() == [(0.01, 2), (0.1, 3), (1, 4),
+                                      (float('inf'), 5)]
+    assert histogram.count == 5 and histogram.last == 3
+
+
+def test_write_replaces_the_json_file(tmp_path):
+    metrics = Metrics({'unit': 'a'})
+    metrics.inc('broadcasts')
+    metrics.observe('transform', 0.002)
+    path = str(tmp_path / 'metrics.json')
+    metrics.write(path)
+    with open(path) as f:
+        written = json.load(f)
+    assert written['labels'] == {'unit': 'a'}
+    assert written['counters']['broadcasts'] == 1
+    assert written['stages']['transform']['buckets'][-1] == ['+Inf', 1]
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_prometheus_exposition():
+    a = Metrics({'unit': 'a'})
+    b = Metrics({'unit': 'b'})
+    a.inc('broadcasts', 3)
+    b.inc('commands')
+    a.observe('save', 0.003)
+    lines = render_prometheus([a, b]).splitlines()
+    assert '# TYPE evolver_broadcasts_total counter' in lines
+    assert 'evolver_broadcasts_total{unit="a"} 3' in lines
+    assert 'evolver_broadcasts_total{unit="b"} 0' in lines
+    assert 'evolver_commands_total{unit="b"} 1' in lines
+    assert '# TYPE evolver_stage_seconds histogram' in lines
+    assert ('evolver_stage_seconds_bucket{le="0.0025",stage="save",unit="a"} 0'
+            in lines)
+    assert ('evolver_stage_seconds_bucket{le="0.005",stage="save",unit="a"} 1'
+            in lines)
+    assert ('evolver_stage_seconds_bucket{le="+Inf",stage="save",unit="a"} 1'
+            in lines)
+    assert 'evolver_stage_seconds_sum{stage="save",unit="a"} 0.003' in lines
+    assert 'evolver_stage_seconds_count{stage="save",unit="b"} 0' in lines
+
+
+def test_server_serves_metrics():
+    metrics = Metrics()
+    metrics.inc('pump_events', 2)
+
+    async def get(path):
+        server = MetricsServer([metrics], 0)
+        listening = await asyncio.start_server(server._handle, '127.0.0.1', 0)
+        port = listening.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('GET {0} HTTP/1.0\r\n\r\n'.format(path).encode())
+        response = await reader.read()
+        writer.close()
+        listening.close()
+        await listening.wait_closed()
+        return response.decode()
+
+    response = asyncio.run(get('/metrics'))
+    assert response.startswith('HTTP/1.0 200 OK')
+    assert 'evolver_pump_events_total 2\n' in response
+    assert asyncio.run(get('/other')).startswith('HTTP/1.0 404')
@@ -0,0 +1,65 @@
+import os
+import sys
+import pickle
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment'))
+
+from recalibrate import recalibrate
+from calibrations import LINEAR
+from datafiles import vial_file_path
+
+VIALS = 3
+# od = raw / 10000 - 1
+FIT = {'type': LINEAR, 'params': ['od_135'],
+       'coefficients': [[0.0001, -1]] * VIALS}
+
+
+def make_experiment(tmp_path, raw, blanked=True):
+    exp_dir = str(tmp_path / 'data')
+    os.makedirs(os.path.join(exp_dir, 'od_135_raw'))
+    for x in range(VIALS):
+        with open(vial_file_path(exp_dir, x, 'od_135_raw'), 'w') as f:
+            f.write('Experiment: data vial {0}\n'.format(x))
+            for i, value in enumerate(raw[x]):
+                f.write('{0},{1}\n'.format(i / 60, value))
+    with open(os.path.join(exp_dir, 'data.pickle'), 'wb') as f:
+        pickle.dump([0, np.full(VIALS, 0.1 if blanked else 0)], f)
+    return exp_dir
+
+
+def read_od(output, vial):
+    with open(vial_file_path(output, vial, 'OD')) as f:
+        f.readline()
+        return [float(line.split(',')[1]) for line in f]
+
+
+def test_new_fit_is_applied_and_blanked(tmp_path):
+    exp_dir = make_experiment(tmp_path, [[11000, 12000, 13000]] * VIALS)
+    output = str(tmp_path / 'out')
+    assert recalibrate(exp_dir, FIT, output, chunk_rows=2) == 3
+    assert np.allclose(read_od(output, 0), [0, 0.1, 0.2])
+
+    exp_dir = make_experiment(tmp_path / 'raw', [[11000, 12000]] * VIALS,
+                              blanked=False)
+    recalibrate(exp_dir, FIT, output)
+    assert np.allclose(read_od(output, 2), [0.1, 0.2])
+
+
+def test_blank_is_the_first_valid_od_of_each_vial(tmp_path, capsys):
+    raw = [[11000, 12000, 13000],
+           ['NaN', 12000, 13000],
+           ['NaN', 'NaN', 'NaN']]
+    exp_dir = make_experiment(tmp_path, raw)
+    output = str(tmp_path / 'out')
+    # the first valid reading of vial 1 is in the second chunk
+    recalibrate(exp_dir, FIT, output, chunk_rows=1)
+    assert np.allclose(read_od(output, 0), [0, 0.1, 0.2])
+    od = read_od(output, 1)
+    assert np.isnan(od[0]) and np.allclose(od[1:], [0, 0.1])
+    assert np.isnan(read_od(output, 2)).all()
+    errors = capsys.readouterr().err
+    assert 'vial 1 blanked with its first valid OD' in errors
+    assert 'vial 2 has no valid OD' in errors
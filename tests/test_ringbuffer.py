@@ -0,0 +1,50 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from ringbuffer import VialRingBuffer
+
+
+def test_recent_wraps_around_oldest_first():
+    buffer = VialRingBuffer(2, 3)
+    for i in range(5):
+        buffer.append(i, [i, 10 * i])
+    assert buffer.recent(3).tolist() == [[2, 3, 4], [20, 30, 40]]
+    assert buffer.recent(2).tolist() == [[3, 4], [30, 40]]
+    assert buffer.recent_times(10).tolist() == [[2, 3, 4], [2, 3, 4]]
+
+
+def test_recent_is_limited_to_recorded_samples():
+    buffer = VialRingBuffer(2, 4)
+    assert buffer.recent(4).shape == (2, 0)
+    buffer.append(0, [1, 2])
+    assert buffer.recent(4).tolist() == [[1], [2]]
+
+
+def test_fill_replaces_one_vial_and_keeps_appending():
+    buffer = VialRingBuffer(2, 3)
+    for i in range(3):
+        buffer.append(i, [0, 0])
+    buffer.fill(1, [[t, t / 10] for t in range(5)])
+    assert buffer.recent(3)[1].tolist() == [0.2, 0.3, 0.4]
+    buffer.append(3, [0, 0.5])
+    assert buffer.recent(3)[1].tolist() == [0.3, 0.4, 0.5]
+
+
+def test_snapshot_restore():
+    buffer = VialRingBuffer(2, 3)
+    for i in range(4):
+        buffer.append(i, [i, i])
+    snapshot = buffer.snapshot()
+    buffer.append(4, [4, 4])
+
+    restored = VialRingBuffer(2, 3)
+    restored.restore(snapshot)
+    assert restored.recent(3).tolist() == [[1, 2, 3], [1, 2, 3]]
+    with pytest.raises(ValueError):
+        VialRingBuffer(2, 5).restore(snapshot)
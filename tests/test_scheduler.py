@@ -0,0 +1,83 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from scheduler import Scheduler, ramp
+
+VIALS = 4
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_scheduler():
+    calls = []
+
+    def record(eVOLVER, vials, elapsed_time):
+        calls.append((vials, elapsed_time))
+    return Scheduler(VIALS, Clock()), calls, record
+
+
+def test_actions_run_in_order_once_due():
+    scheduler, calls, record = make_scheduler()
+    scheduler.at(2.0, record, vials=1)
+    scheduler.at(1.0, record, vials=0)
+    scheduler.clock.now = 0.5
+    scheduler.after(1.0, record, vials=2)
+    assert scheduler.next_due() == 1.0
+    assert not scheduler.due(0.9)
+
+    scheduler.run_due(None, 1.6)
+    assert calls == [(0, 1.6), (2, 1.6)]
+    scheduler.run_due(None, 2.0)
+    assert calls[-1] == (1, 2.0)
+    assert scheduler.fired == 3 and scheduler.next_due() is None
+
+
+def test_periodic_actions_skip_missed_periods():
+    scheduler, calls, record = make_scheduler()
+    scheduler.at(1.0, record, name='sample', every=0.5)
+    scheduler.run_due(None, 1.0)
+    assert scheduler.next_due() == 1.5
+    # paused for a while: runs once, then continues on its period
+    scheduler.run_due(None, 2.7)
+    assert len(calls) == 2
+    assert scheduler.next_due() == 3.0
+
+
+def test_cancel_by_name_and_vials():
+    scheduler, calls, record = make_scheduler()
+    scheduler.at(1.0, record, vials=0, name='ramp')
+    scheduler.at(1.0, record, vials=1, name='ramp')
+    scheduler.at(1.0, record, vials=1, name='other')
+    scheduler.cancel(name='ramp', vials=1)
+    assert [action.vials for action in scheduler.pending('ramp')] == [0]
+    scheduler.cancel(vials=0)
+    scheduler.run_due(None, 1.0)
+    assert calls == [(1, 1.0)]
+
+
+def test_hold_blocks_vials_until_the_given_time():
+    scheduler, _, _ = make_scheduler()
+    assert not scheduler.held('pump', 0).any()
+    scheduler.hold([1, 2], 'pump', 1.5)
+    assert scheduler.held('pump', 1.0).tolist() == [False, True, True, False]
+    assert scheduler.held('pump', 1.0, vials=[0, 1]).tolist() == [False, True]
+    assert not scheduler.held('pump', 1.5).any()
+    assert not scheduler.held('stir', 1.0).any()
+
+
+def test_ramp_ends_on_the_target():
+    program = ramp(0, 1, 30, 40, 0.25)
+    assert [t for t, _ in program] == [0, 0.25, 0.5, 0.75, 1]
+    assert program[2][1] == pytest.approx(35)
+    assert program[-1] == (1, 40.0)
@@ -0,0 +1,82 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from scriptreload import ScriptReloader
+
+SCRIPT = '''
+EXP_NAME = 'data'
+EVOLVER_PORT = 8081
+OPERATION_MODE = 'turbidostat'
+
+def turbidostat(eVOLVER, input_data, vials, elapsed_time):
+    return {0!r}
+
+def chemostat(eVOLVER, input_data, vials, elapsed_time):
+    pass
+'''
+
+
+@pytest.fixture
+def reloader(tmp_path, monkeypatch):
+    path = tmp_path / 'custom_script.py'
+    path.write_text(SCRIPT.format('v0'))
+    running = types.ModuleType('test_custom_script')
+    exec(SCRIPT.format('v0'), running.__dict__)
+    # load() registers new versions in sys.modules
+    monkeypatch.setitem(sys.modules, running.__name__, running)
+    return ScriptReloader(str(path), running, required=['chemostat'],
+                          fixed=['EXP_NAME'], startup=['EVOLVER_PORT'])
+
+
+def rewrite(reloader, source):
+    with open(reloader.path, 'w') as f:
+        f.write(source)
+    # a new size or mtime, whatever the file system's resolution
+    stat = os.stat(reloader.path)
+    os.utime(reloader.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_valid_version_replaces_the_running_one(reloader):
+    assert not reloader.changed()
+    rewrite(reloader, SCRIPT.format('v1').replace('8081', '8082'))
+    assert reloader.changed()
+    assert not reloader.changed()
+    module = reloader.load()
+    assert module.turbidostat(None, None, None, None) == 'v1'
+    assert reloader.module is module and reloader.version == 1
+    assert sys.modules[module.__name__] is module
+    assert b"'v1'" in reloader.source
+
+
+@pytest.mark.parametrize('source, problem', [
+    (SCRIPT.format('v1') + '\nraise RuntimeError("oops")\n', None),
+    (SCRIPT.format('v1').replace("'data'", "'other'"), 'EXP_NAME'),
+    (SCRIPT.format('v1').replace('def chemostat', 'def chemo'), 'chemostat'),
+    (SCRIPT.format('v1').replace("'turbidostat'", "'growth_curve'"),
+     'growth_curve'),
+    (SCRIPT.format('v1').replace('input_data, vials, elapsed_time):\n'
+                                 '    pass', 'vials):\n    pass'),
+     'chemostat'),
+])
+def test_invalid_versions_keep_the_running_one(reloader, source, problem):
+    running = reloader.module
+    rewrite(reloader, source)
+    if problem is not None:
+        module = types.ModuleType('check')
+        exec(source, module.__dict__)
+        assert any(problem in p for p in reloader.validate(module))
+    assert reloader.load() is None
+    assert reloader.module is running and reloader.version == 0
+    assert sys.modules[running.__name__] is running
+
+
+def test_missing_file_is_not_a_change(reloader):
+    os.remove(reloader.path)
+    assert not reloader.changed()
+    assert reloader.load() is None
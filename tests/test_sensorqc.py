@@ -0,0 +1,105 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from sensorqc import SensorQC
+
+VIALS = 8
+
+
+def readings(od=None, temp=None):
+    od = np.linspace(20000, 27000, VIALS) if od is None else od
+    temp = np.full(VIALS, 2000.0) if temp is None else temp
+    return np.asarray(od, dtype=float), np.asarray(temp, dtype=float)
+
+
+def rejected_vials(result, check):
+    return np.flatnonzero(result.rejected[check]).tolist()
+
+
+def warm_up(qc, n=5):
+    for _ in range(n):
+        assert qc.check(*readings()).valid.all()
+
+
+def test_missing_readings():
+    qc = SensorQC(VIALS)
+    od, temp = readings()
+    od[1] = np.nan
+    temp[2] = np.nan
+    result = qc.check(od, temp)
+    assert rejected_vials(result, 'missing') == [1, 2]
+    assert np.flatnonzero(~result.od_valid).tolist() == [1]
+    assert np.flatnonzero(~result.temp_valid).tolist() == [2]
+
+
+def test_readings_at_the_adc_rails():
+    qc = SensorQC(VIALS)
+    od, temp = readings()
+    od[0] = 65535
+    od[3] = 0
+    temp[5] = 4095
+    result = qc.check(od, temp)
+    assert rejected_vials(result, 'saturated') == [0, 3, 5]
+    assert qc.rejects['saturated'].sum() == 3
+
+
+def test_identical_od_across_all_vials():
+    qc = SensorQC(VIALS)
+    result = qc.check(*readings(od=np.full(VIALS, 31000.0)))
+    assert rejected_vials(result, 'stuck') == list(range(VIALS))
+    # temperatures of vials at the same setpoint may well be identical
+    assert result.temp_valid.all()
+
+
+def test_od_2_is_checked_with_the_od():
+    qc = SensorQC(VIALS)
+    od_2 = readings()[0]
+    od_2[4] = np.nan
+    result = qc.check(*readings(), od_2=od_2)
+    assert np.flatnonzero(~result.od_valid).tolist() == [4]
+
+
+def test_jump_away_from_recent_readings():
+    qc = SensorQC(VIALS)
+    warm_up(qc)
+    od, temp = readings()
+    od[6] *= 2
+    result = qc.check(od, temp)
+    assert rejected_vials(result, 'jump') == [6]
+    # the spike was not remembered, the next normal reading passes
+    assert qc.check(*readings()).valid.all()
+
+
+def test_shift_of_most_vials_is_accepted():
+    qc = SensorQC(VIALS)
+    warm_up(qc)
+    od, temp = readings()
+    od[:6] *= 2
+    result = qc.check(od, temp)
+    assert result.valid.all()
+
+
+def test_persistent_new_level_is_accepted():
+    qc = SensorQC(VIALS, persist=3)
+    warm_up(qc)
+    od, temp = readings()
+    od[2] *= 2
+    assert rejected_vials(qc.check(od, temp), 'jump') == [2]
+    assert rejected_vials(qc.check(od, temp), 'jump') == [2]
+    assert qc.check(od, temp).valid.all()
+    assert qc.check(od, temp).valid.all()
+    assert qc.rejects['jump'].tolist() == [0, 0, 2, 0, 0, 0, 0, 0]
+
+
+def test_reset_forgets_the_history_of_a_vial():
+    qc = SensorQC(VIALS)
+    warm_up(qc)
+    qc.reset([2])
+    od, temp = readings()
+    od[2] *= 2
+    assert qc.check(od, temp).valid.all()
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from datafiles import vial_file_path
+from setpoints import SetpointState
+
+
+def make_state(tmp_path, vials=2):
+    os.makedirs(os.path.join(str(tmp_path), 'temp_config'))
+    for x in range(vials):
+        with open(vial_file_path(str(tmp_path), x, 'temp_config'), 'w') as f:
+            f.write('Experiment: test vial {0}\n0,30\n'.format(x))
+    state = SetpointState(str(tmp_path), 'temp_config', range(vials))
+    state.load()
+    return state
+
+
+def append(tmp_path, vial, text):
+    with open(vial_file_path(str(tmp_path), vial, 'temp_config'), 'a') as f:
+        f.write(text)
+
+
+def test_refresh_picks_up_rows_appended_by_others(tmp_path):
+    state = make_state(tmp_path)
+    assert state.refresh() == []
+    append(tmp_path, 1, '1.5,37\n')
+    assert state.refresh() == [1]
+    assert state.values.tolist() == [30, 37]
+    assert state.refresh() == []
+
+
+def test_refresh_waits_for_a_complete_row(tmp_path):
+    state = make_state(tmp_path)
+    append(tmp_path, 0, '2.0,3')
+    state.refresh()
+    assert state.values[0] == 30
+    append(tmp_path, 0, '5\n')
+    assert state.refresh() == [0]
+    assert state.values[0] == 35
+
+
+def test_set_after_an_external_change(tmp_path):
+    state = make_state(tmp_path)
+    append(tmp_path, 0, '1.0,37\n')
+    # back to 30 has to be written although 30 was the value loaded
+    state.set([30, 30], 2.0)
+    assert state.values.tolist() == [30, 30]
+    rows = np.genfromtxt(vial_file_path(str(tmp_path), 0, 'temp_config'),
+                         delimiter=',', skip_header=1)
+    assert rows[-1].tolist() == [2.0, 30]
+    assert state.refresh() == []
+
+
+def test_rewritten_file_is_reloaded(tmp_path):
+    state = make_state(tmp_path)
+    with open(vial_file_path(str(tmp_path), 1, 'temp_config'), 'w') as f:
+        f.write('0,25\n')
+    assert state.refresh() == [1]
+    assert state.values[1] == 25
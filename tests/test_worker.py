@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'experiment', 'template'))
+
+from worker import BroadcastWorker, BROADCAST
+
+
+def on_broadcast(*args):
+    pass
+
+
+def on_calibrations(*args):
+    pass
+
+
+def test_take_broadcasts_stops_at_events_of_the_same_unit():
+    worker = BroadcastWorker(max_pending=10)
+    worker.submit(BROADCAST, on_broadcast, ('a', 1), key='a')
+    worker.submit(BROADCAST, on_broadcast, ('b', 1), key='b')
+    worker.submit('activecalibrations', on_calibrations, ('a',), key='a')
+    worker.submit(BROADCAST, on_broadcast, ('a', 2), key='a')
+    worker.submit(BROADCAST, on_broadcast, ('b', 2), key='b')
+
+    taken = worker.take_broadcasts(on_broadcast)
+    assert [args for args, _ in taken] == [('a', 1), ('b', 1), ('b', 2)]
+    # the unit's new calibrations come before its next broadcast
+    assert [item[2] for item in worker._queue] == [('a',), ('a', 2)]
+
+
+def test_take_broadcasts_stops_at_events_of_no_unit():
+    worker = BroadcastWorker(max_pending=10)
+    worker.submit(BROADCAST, on_broadcast, ('a', 1), key='a')
+    worker.submit('reload', on_calibrations, ())
+    worker.submit(BROADCAST, on_broadcast, ('b', 1), key='b')
+
+    taken = worker.take_broadcasts(on_broadcast)
+    assert [args for args, _ in taken] == [('a', 1)]
+    assert len(worker._queue) == 2
+
+
+def test_taken_broadcasts_are_accounted_for():
+    worker = BroadcastWorker(max_pending=10, late_after=0)
+    for i in range(3):
+        worker.submit(BROADCAST, on_broadcast, ('a', i), key='a')
+    taken = worker.take_broadcasts(on_broadcast)
+    for _, received in taken:
+        worker.record(received, received + 1)
+    assert worker.processed == 3
+    assert worker.late == 3
+    assert worker.max_lag >= 0 and worker.lag['queue'] == 1